@@ -1,14 +1,29 @@
+import time
+_import_start = time.perf_counter()
+
 import os
+import shutil
 from flask import Flask
 from flask_cors import CORS
 from dotenv import load_dotenv
-from ultralytics import YOLO
 from app.utils.background_thread_factory import BackgroundThreadFactory
+from app.utils.job_executor import JobExecutor
+from app.utils.process_inference_pool import ProcessInferencePool
+from app.utils.result_cache import ResultCache
+from app.utils.detection_tracks import DetectionTrackStore
+from app.utils import metrics
+from app.utils.video_uploads import ChunkedUploads
+from app.utils.job_store import create_job_store
+from app.utils.temp_storage import TempStorageManager
+from app.utils.startup import StartupTimer
+from app.utils.inference_profiles import ProfileSelector, fit_profiles
 from .logging_config import setup_logging
 
 
 load_dotenv()
 
+IMPORT_SECONDS = time.perf_counter() - _import_start
+
 
 def create_app():
     origins: list[str] = [
@@ -18,6 +33,7 @@ def create_app():
         "https://www.aishaeportfolio.com"
     ]
 
+    timer = StartupTimer()
     app = Flask(__name__)
     app.config['SECRET_KEY'] = os.getenv('FLASK_SECRET_KEY')
     CORS(app, origins=origins)
@@ -31,8 +47,137 @@ def create_app():
     app.config['CLASS_NAMES'] = ["afro", "bantu knots", "bob", "braids",
                                  "cornrows", "fade", "locs", "long", "sisterlocs", "twa"]
 
-    app.config['YOLO_MODEL'] = YOLO(
-        './app/models/best_quantized.onnx', task="detect")
+    app.config['MODEL_PATH'] = './app/models/best_quantized.onnx'
+
+    # 'thread' batches in this process, 'process' hosts the model in worker processes
+    app.config['INFERENCE_BACKEND_TYPE'] = os.getenv(
+        'INFERENCE_BACKEND', 'thread')
+    app.config['INFERENCE_PROCESSES'] = int(
+        os.getenv('INFERENCE_PROCESSES', os.cpu_count() or 1))
+
+    # 'ultralytics' wraps the model in YOLO(), 'onnxruntime' runs the session directly
+    app.config['ENGINE_SETTINGS'] = {
+        'engine': os.getenv('INFERENCE_ENGINE', 'ultralytics'),
+        'model_path': app.config['MODEL_PATH'],
+        'conf_threshold': float(os.getenv('DETECTION_CONF_THRESHOLD', 0.25)),
+        'iou_threshold': float(os.getenv('DETECTION_IOU_THRESHOLD', 0.7)),
+        'intra_op_threads': int(os.getenv('ORT_INTRA_OP_THREADS', 0)),
+        'inter_op_threads': int(os.getenv('ORT_INTER_OP_THREADS', 0)),
+        'graph_optimization': os.getenv('ORT_GRAPH_OPTIMIZATION', 'all'),
+        'execution_mode': os.getenv('ORT_EXECUTION_MODE', 'sequential'),
+        'providers': os.getenv('ORT_PROVIDERS', 'CPUExecutionProvider').split(','),
+        'enable_mem_arena': os.getenv('ORT_ENABLE_MEM_ARENA', 'true').lower() == 'true',
+    }
+
+    # The inference backend loads the engine on its own thread or processes and
+    # warms it up with blank batches. 'background' serves requests meanwhile
+    # (they queue until /ready turns green), 'eager' waits before returning.
+    app.config['INFERENCE_ENGINE'] = None
+    app.config['ENGINE_STARTUP'] = os.getenv('ENGINE_STARTUP', 'background')
+    app.config['WARMUP_BATCH_SIZE'] = int(os.getenv('WARMUP_BATCH_SIZE', 1))
+    app.config['WARMUP_RUNS'] = int(os.getenv('WARMUP_RUNS', 2))
+    app.config['ENGINE_STARTUP_TIMEOUT'] = int(
+        os.getenv('ENGINE_STARTUP_TIMEOUT', 120))
+    # Longest a request waits on the inference backend before answering 503
+    app.config['INFERENCE_TIMEOUT'] = float(os.getenv('INFERENCE_TIMEOUT', 60))
+
+    # Named input resolutions, each may point at its own model export. A model
+    # with a static input shape runs at its own size whatever the profile says.
+    app.config['INFERENCE_PROFILES'] = fit_profiles({
+        'live': {'size': int(os.getenv('PROFILE_LIVE_SIZE', 416)),
+                 'model_path': os.getenv('PROFILE_LIVE_MODEL') or app.config['MODEL_PATH']},
+        'quality': {'size': int(os.getenv('PROFILE_QUALITY_SIZE', 640)),
+                    'model_path': os.getenv('PROFILE_QUALITY_MODEL') or app.config['MODEL_PATH']},
+    })
+    # Profile used when a request does not pass ?profile=, 'auto' needs latency_budget_ms
+    app.config['ROUTE_PROFILES'] = {
+        'image': os.getenv('IMAGE_PROFILE', 'quality'),
+        'frame': os.getenv('FRAME_PROFILE', 'live'),
+        'video': os.getenv('VIDEO_PROFILE', 'quality'),
+    }
+    app.config['PROFILE_SELECTOR'] = ProfileSelector(app.config['INFERENCE_PROFILES'])
+
+    # The profiler endpoints only exist when the profiler is enabled or a
+    # token is set, and with a token every call must send it in X-Profiler-Token
+    app.config['PROFILER_ENABLED'] = os.getenv('PROFILER_ENABLED', 'false').lower() == 'true'
+    app.config['PROFILER_TOKEN'] = os.getenv('PROFILER_TOKEN')
+
+    # Inference runs live frames first, then images, then video frames. A live
+    # frame or image must get its result within its deadline, in milliseconds
+    # from when the request arrived (0 disables it, ?deadline_ms= overrides it).
+    # Frames whose deadline passes while queued are dropped, and requests the
+    # queue ahead could not serve in time are refused with a 503.
+    app.config['INFERENCE_DEADLINES_MS'] = {
+        'live': float(os.getenv('LIVE_DEADLINE_MS', 1000)),
+        'image': float(os.getenv('IMAGE_DEADLINE_MS', 10000)),
+    }
+
+    # Frames from all request threads and video jobs are batched in front of the model
+    app.config['INFERENCE_MAX_BATCH_SIZE'] = int(
+        os.getenv('INFERENCE_MAX_BATCH_SIZE', 8))
+    app.config['INFERENCE_MAX_WAIT_MS'] = float(
+        os.getenv('INFERENCE_MAX_WAIT_MS', 5))
+
+    # /api/process_images keeps this many images in flight, enough to fill a batch
+    app.config['BATCH_IMAGE_WORKERS'] = int(os.getenv(
+        'BATCH_IMAGE_WORKERS', app.config['INFERENCE_MAX_BATCH_SIZE']))
+    app.config['BATCH_MAX_IMAGES'] = int(os.getenv('BATCH_MAX_IMAGES', 200))
+    # Uncompressed size limits for images read from an uploaded archive
+    app.config['BATCH_MAX_IMAGE_BYTES'] = int(
+        os.getenv('BATCH_MAX_IMAGE_BYTES', 32 * 1024 * 1024))
+    app.config['BATCH_MAX_ARCHIVE_BYTES'] = int(
+        os.getenv('BATCH_MAX_ARCHIVE_BYTES', 512 * 1024 * 1024))
+
+    # Video jobs run on a fixed-size worker pool with a bounded pending queue
+    app.config['VIDEO_WORKERS'] = int(os.getenv('VIDEO_WORKERS', 2))
+    app.config['VIDEO_MAX_PENDING'] = int(os.getenv('VIDEO_MAX_PENDING', 8))
+    app.config['VIDEO_RETRY_AFTER'] = int(os.getenv('VIDEO_RETRY_AFTER', 10))
+
+    # Frames in flight between the decode, inference and encode stages of a video
+    app.config['VIDEO_PIPELINE_DEPTH'] = int(
+        os.getenv('VIDEO_PIPELINE_DEPTH', 16))
+
+    # Run the model on keyframes only: off, interval (every N frames) or diff (on visible change)
+    app.config['TEMPORAL_SETTINGS'] = {
+        'mode': os.getenv('TEMPORAL_MODE', 'off'),
+        'interval': int(os.getenv('TEMPORAL_INTERVAL', 3)),
+        'diff_threshold': float(os.getenv('TEMPORAL_DIFF_THRESHOLD', 12.0)),
+        'max_gap': int(os.getenv('TEMPORAL_MAX_GAP', 30)),
+        'motion': os.getenv('TEMPORAL_MOTION', 'velocity'),
+    }
+
+    # Streamed frames: JPEG quality, longest side (0 keeps the source size) and
+    # whether to lower both while a viewer's buffer backs up
+    app.config['VIDEO_ENCODING'] = {
+        'quality': int(os.getenv('VIDEO_JPEG_QUALITY', 95)),
+        'max_side': int(os.getenv('VIDEO_MAX_OUTPUT_SIDE', 0)),
+        'adaptive': os.getenv('VIDEO_ADAPTIVE_ENCODING', 'false').lower() == 'true',
+    }
+    # mp4 output is only offered when ffmpeg is installed
+    app.config['FFMPEG_PATH'] = os.getenv('FFMPEG_PATH') or shutil.which('ffmpeg')
+
+    # Processed frames waiting for a viewer: block, drop_oldest or latest
+    app.config['FRAME_BUFFER_POLICY'] = os.getenv(
+        'FRAME_BUFFER_POLICY', 'block')
+    app.config['FRAME_BUFFER_MAX_FRAMES'] = int(
+        os.getenv('FRAME_BUFFER_MAX_FRAMES', 64))
+    app.config['FRAME_BUFFER_MAX_BYTES'] = int(
+        os.getenv('FRAME_BUFFER_MAX_BYTES', 32 * 1024 * 1024))
+    app.config['VIDEO_STALL_TIMEOUT'] = int(
+        os.getenv('VIDEO_STALL_TIMEOUT', 120))
+
+    # Append processed output to a segment file so viewers can resume, share and download it
+    app.config['VIDEO_PERSIST_RESULTS'] = os.getenv(
+        'VIDEO_PERSIST_RESULTS', 'true').lower() == 'true'
+
+    # Uploads are streamed to disk in chunks and capped in size
+    app.config['VIDEO_MAX_UPLOAD_BYTES'] = int(
+        os.getenv('VIDEO_MAX_UPLOAD_BYTES', 200 * 1024 * 1024))
+    app.config['MAX_CONTENT_LENGTH'] = app.config['VIDEO_MAX_UPLOAD_BYTES'] + 1024 * 1024
+
+    # Finished jobs nobody polls or streams are evicted after JOB_TTL seconds
+    app.config['JOB_TTL'] = int(os.getenv('JOB_TTL', 300))
+    app.config['JOB_REAP_INTERVAL'] = int(os.getenv('JOB_REAP_INTERVAL', 30))
 
     temp_dir = './app/tmp'
     app.config['TEMP_DIR'] = temp_dir
@@ -43,18 +188,162 @@ def create_app():
     except Exception as e:
         logger.error(f"Failed to create temp directory: {str(e)}")
 
+    # Every file written under TEMP_DIR is indexed; unused ones expire after
+    # TEMP_MAX_AGE seconds and the least recently used go first above TEMP_MAX_BYTES
+    app.config['TEMP_SWEEP_INTERVAL'] = int(os.getenv('TEMP_SWEEP_INTERVAL', 60))
+    app.config['TEMP_STORAGE'] = TempStorageManager(
+        temp_dir,
+        max_bytes=int(os.getenv('TEMP_MAX_BYTES', 2 * 1024 * 1024 * 1024)),
+        max_age=int(os.getenv('TEMP_MAX_AGE', 3600)),
+        scratch_dirs=(os.path.join(temp_dir, 'uploads'), os.path.join(temp_dir, 'results')))
+
+    # 'memory' keeps jobs in this process, 'sqlite' lets every worker on the host serve them
+    app.config['JOB_STORE'] = create_job_store(
+        os.getenv('JOB_STORE', 'memory'),
+        os.getenv('JOB_STORE_PATH', os.path.join(temp_dir, 'jobs', 'jobs.sqlite3')))
+
+    # Cache entries are only valid for the exact model file that produced them
+    engine = app.config['ENGINE_SETTINGS']['engine']
+    model_id = model_identity(engine, app.config['MODEL_PATH'])
+    # Profiles may run their own model, and their size changes the detections too
+    app.config['PROFILE_MODEL_IDS'] = {
+        name: model_identity(engine, profile['model_path'])
+        for name, profile in app.config['INFERENCE_PROFILES'].items()}
+
+    cache_disk_dir = os.path.join(temp_dir, 'cache') if os.getenv(
+        'RESULT_CACHE_DISK', 'false').lower() == 'true' else None
+    app.config['RESULT_CACHE'] = ResultCache(
+        model_id=model_id,
+        max_bytes=int(os.getenv('RESULT_CACHE_MAX_BYTES', 64 * 1024 * 1024)),
+        disk_dir=cache_disk_dir, storage=app.config['TEMP_STORAGE'])
+
+    app.config['CHUNKED_UPLOADS'] = ChunkedUploads(
+        upload_dir=os.path.join(temp_dir, 'uploads'),
+        max_bytes=app.config['VIDEO_MAX_UPLOAD_BYTES'], storage=app.config['TEMP_STORAGE'],
+        store=app.config['JOB_STORE'])
+
+    # Precomputed per-frame detections of the example videos
+    app.config['DETECTION_TRACKS'] = DetectionTrackStore(
+        profile_ids={name: f"{app.config['PROFILE_MODEL_IDS'][name]}:{profile['size']}"
+                     for name, profile in app.config['INFERENCE_PROFILES'].items()},
+        track_dir=os.path.join(temp_dir, 'tracks'),
+        storage=app.config['TEMP_STORAGE'])
+    app.config['PRECOMPUTE_EXAMPLE_TRACKS'] = os.getenv(
+        'PRECOMPUTE_EXAMPLE_TRACKS', 'false').lower() == 'true'
+
+    timer.mark('config')
+
     with app.app_context():
         # Import routes
         from . import routes
         app.register_blueprint(routes.bp)
+        timer.mark('routes')
 
         backgroundThreadFactory = BackgroundThreadFactory(app)
         app.config['BACKGROUND_THREAD_FACTORY'] = backgroundThreadFactory
 
         # Start background tasks
         try:
-            backgroundThreadFactory.create('cleanup').start()
+            backgroundThreadFactory.create('temp_storage').start()
+        except Exception as e:
+            logger.error(f"Failed to start temp storage thread: {str(e)}")
+
+        try:
+            backgroundThreadFactory.create('job_reaper').start()
+        except Exception as e:
+            logger.error(f"Failed to start job reaper thread: {str(e)}")
+        timer.mark('maintenance_threads')
+
+        try:
+            if app.config['INFERENCE_BACKEND_TYPE'] == 'process':
+                inferenceBackend = ProcessInferencePool(app)
+            else:
+                inferenceBackend = backgroundThreadFactory.create(
+                    'inference_scheduler')
+            app.config['INFERENCE_BACKEND'] = inferenceBackend
+            inferenceBackend.start()
+        except Exception as e:
+            logger.error(f"Failed to start inference backend: {str(e)}")
+        timer.mark('inference_backend')
+
+        if app.config['ENGINE_STARTUP'] == 'eager' and 'INFERENCE_BACKEND' in app.config:
+            inferenceBackend = app.config['INFERENCE_BACKEND']
+            if not inferenceBackend.started.wait(app.config['ENGINE_STARTUP_TIMEOUT']):
+                logger.warning('Inference engine is not ready yet, serving anyway.')
+            elif inferenceBackend.startup_error is not None:
+                # Nothing could be served, fail like loading the model inline did
+                raise RuntimeError(
+                    f'Inference engine failed to start: {inferenceBackend.startup_error}')
+            timer.mark('engine_ready')
+
+        try:
+            jobExecutor = JobExecutor(app)
+            app.config['JOB_EXECUTOR'] = jobExecutor
+            jobExecutor.start()
+        except Exception as e:
+            logger.error(f"Failed to start job executor: {str(e)}")
+
+        register_gauges(app)
+
+        if app.config['PROFILER_ENABLED']:
+            profiler = backgroundThreadFactory.create(
+                'profiler', interval_ms=float(os.getenv('PROFILER_INTERVAL_MS', 10)))
+            app.config['PROFILER'] = profiler
+            profiler.start()
+
+        try:
+            backgroundThreadFactory.create('cache_warmup').start()
         except Exception as e:
-            logger.error(f"Failed to start cleanup thread: {str(e)}")
+            logger.error(f"Failed to start cache warm-up thread: {str(e)}")
+        timer.mark('background_threads')
+
+    app.config['STARTUP_TIMINGS'] = {'imports': IMPORT_SECONDS, **timer.stages}
+    logger.info(
+        f'Startup took {(IMPORT_SECONDS + timer.total()) * 1000:.0f}ms: imports {IMPORT_SECONDS * 1000:.0f}ms, '
+        f'{timer.summary()}')
 
     return app
+
+
+def model_identity(engine: str, model_path: str) -> str:
+    """
+    :return: engine, path and, if the file exists, its size and modification time
+    """
+    model_id = f"{engine}:{model_path}"
+    if os.path.exists(model_path):
+        model_stat = os.stat(model_path)
+        model_id = f"{model_id}:{model_stat.st_size}:{model_stat.st_mtime_ns}"
+    return model_id
+
+
+def register_gauges(app: Flask) -> None:
+    """
+    Point the /metrics gauges at the live objects so they are read at scrape time.
+    :return: None
+    """
+    factory = app.config['BACKGROUND_THREAD_FACTORY']
+
+    def frame_backlogs():
+        # Frames and bytes each video job holds for its slowest viewer
+        return [thread.buffered() for thread in list(factory.threads.values())
+                if hasattr(thread, 'buffered')]
+
+    def active_jobs():
+        counts = {}
+        for thread in list(factory.threads.values()):
+            key = (type(thread).__name__,)
+            counts[key] = counts.get(key, 0) + 1
+        return counts
+
+    metrics.ACTIVE_JOBS.set_function(active_jobs)
+    metrics.FRAME_QUEUE_DEPTH.set_function(
+        lambda: sum(frames for frames, _ in frame_backlogs()))
+    metrics.FRAME_QUEUE_BYTES.set_function(
+        lambda: sum(size for _, size in frame_backlogs()))
+    metrics.INFERENCE_QUEUE_DEPTH.set_function(
+        lambda: app.config['INFERENCE_BACKEND'].metrics()['queue_depth'])
+    metrics.TEMP_STORAGE_BYTES.set_function(lambda: {
+        (category,): usage['bytes']
+        for category, usage in app.config['TEMP_STORAGE'].usage()['categories'].items()})
+    metrics.VIDEO_JOBS_PENDING.set_function(
+        lambda: app.config['JOB_EXECUTOR'].stats()['pending'])
@@ -0,0 +1,341 @@
+import json
+import time
+import queue
+import asyncio
+import logging
+from urllib.parse import parse_qs
+
+from asgiref.wsgi import WsgiToAsgi
+from flask import Flask
+from .routes import STREAM_MIMETYPES, finish_stream, job_progress
+from .utils.background_thread_factory import ThreadNotFoundError
+from .utils.detector import img_detector, img_detections
+from .utils.detection_formats import OUTPUT_FORMATS, detections_to_dict, pack_detections
+from .utils.inference_priority import InferenceOverloadedError, DeadlineExceededError, InferenceUnavailableError
+from .utils.metrics import DROPPED_FRAMES, ERRORS
+
+logger = logging.getLogger(__name__)
+
+# Seconds a viewer waits for the next frame before checking the job again
+FRAME_WAIT_TIMEOUT = 30
+
+# Websocket close code for a policy violation, e.g. an unknown output format
+WS_POLICY_VIOLATION = 1008
+
+
+class LiveSession:
+    """
+    Latest-frame slot for one live websocket. A frame that arrives before
+    the previous one was picked up replaces it, so a slow detector skips
+    stale frames instead of queueing them.
+    """
+
+    def __init__(self, output: str, profile: str = None, budget_ms: float = None):
+        self.output = output
+        # 'auto' is kept as requested and resolved again for every frame
+        self.profile = profile
+        self.budget_ms = budget_ms
+        self.frame = None
+        self.seq = 0
+        self.skipped = 0
+        self.ready = asyncio.Event()
+
+    def put(self, frame: bytes):
+        if self.frame is not None:
+            self.skipped += 1
+            DROPPED_FRAMES.inc(policy='live')
+
+        self.frame = frame
+        self.seq += 1
+        self.ready.set()
+
+    async def take(self):
+        await self.ready.wait()
+        self.ready.clear()
+
+        frame, self.frame = self.frame, None
+        return frame, self.seq, self.output
+
+
+class AsyncStreamingApp:
+    """
+    ASGI entry point that serves the long-lived streaming and polling
+    endpoints as coroutines, so a viewer waiting on frames costs a pending
+    future instead of a blocked server thread. Every other request is
+    handed to the Flask app through asgiref's WSGI adapter.
+    """
+
+    def __init__(self, app: Flask):
+        self.app = app
+        self.wsgi = WsgiToAsgi(app)
+        self.routes = {
+            '/api/stream_frames': self.stream_frames,
+            '/api/stream_frames_progress': self.stream_frames_progress,
+            '/api/got_frames': self.got_frames,
+        }
+        self.websockets = {
+            '/ws/live': self.live,
+        }
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+
+        if scope['type'] == 'websocket':
+            handler = self.websockets.get(scope.get('path'))
+            params = parse_qs(scope.get('query_string', b'').decode())
+            if handler:
+                await handler({key: values[0] for key, values in params.items()}, receive, send)
+            else:
+                await receive()
+                await send({'type': 'websocket.close'})
+            return
+
+        handler = self.routes.get(scope.get('path'))
+        if scope['type'] == 'http' and scope['method'] == 'GET' and handler:
+            params = parse_qs(scope.get('query_string', b'').decode())
+            await handler({key: values[0] for key, values in params.items()}, receive, send)
+            return
+
+        await self.wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    @staticmethod
+    async def send_json(send, body: dict, status: int = 200):
+        payload = json.dumps(body).encode()
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(b'content-type', b'application/json'),
+                                (b'content-length', str(len(payload)).encode())]})
+        await send({'type': 'http.response.body', 'body': payload})
+
+    def get_job(self, job_id: str):
+        backgroundThreadFactory = self.app.config['BACKGROUND_THREAD_FACTORY']
+        try:
+            return backgroundThreadFactory.get_thread(job_id)
+        except ThreadNotFoundError:
+            return None
+
+    async def stream_frames(self, params: dict, receive, send):
+        job_id = params.get('id')
+
+        if not job_id:
+            await self.send_json(send, {'error': 'No id provided'}, 400)
+            return
+
+        # Job lookups and reads may go to a shared job store, so they stay off the event loop
+        job = await asyncio.to_thread(self.get_job, job_id)
+        if job is None:
+            await self.send_json(send, {'error': 'Thread not found'}, 404)
+            return
+
+        try:
+            from_frame = int(params.get('from_frame', 0))
+        except ValueError:
+            from_frame = 0
+
+        # An MP4 stream cannot be joined in the middle
+        if job.output == 'mp4':
+            from_frame = 0
+
+        backgroundThreadFactory = self.app.config['BACKGROUND_THREAD_FACTORY']
+        frame_queue = await asyncio.to_thread(job.open_stream, from_frame)
+
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': [(b'content-type', STREAM_MIMETYPES[job.output].encode())]})
+
+        # Stop waiting for frames as soon as the viewer goes away
+        disconnected = asyncio.ensure_future(self.wait_disconnect(receive))
+
+        try:
+            while True:
+                next_frame = asyncio.ensure_future(
+                    frame_queue.get_async(timeout=FRAME_WAIT_TIMEOUT))
+                done, _ = await asyncio.wait({next_frame, disconnected},
+                                             return_when=asyncio.FIRST_COMPLETED)
+
+                if next_frame not in done:
+                    next_frame.cancel()
+                    logger.info(f"Viewer of {job_id} disconnected.")
+                    return
+
+                try:
+                    frame_data = next_frame.result()
+                except queue.Empty:
+                    continue
+
+                if frame_data == 'DONE':
+                    await asyncio.to_thread(finish_stream, job, backgroundThreadFactory)
+                    break
+
+                await send({'type': 'http.response.body', 'body': frame_data, 'more_body': True})
+
+            await send({'type': 'http.response.body', 'body': b''})
+        except OSError as e:
+            logger.info(f"Viewer of {job_id} disconnected: {e}")
+        finally:
+            disconnected.cancel()
+
+    @staticmethod
+    async def wait_disconnect(receive):
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+
+    async def stream_frames_progress(self, params: dict, receive, send):
+        job_id = params.get('id')
+
+        if not job_id:
+            await self.send_json(send, {'error': 'No id provided'}, 400)
+            return
+
+        try:
+            await self.send_json(send, await asyncio.to_thread(job_progress, self.app, job_id))
+        except Exception:
+            await self.send_json(send, {'progress': 0})
+
+    async def got_frames(self, params: dict, receive, send):
+        job_id = params.get('id')
+
+        if not job_id:
+            await self.send_json(send, {'error': 'No id provided'}, 400)
+            return
+
+        job = await asyncio.to_thread(self.get_job, job_id)
+        if job is None:
+            await self.send_json(send, {'error': 'Thread not found'}, 404)
+            return
+
+        got_frames = await asyncio.to_thread(lambda: job.open_stream().qsize() > 0)
+        await self.send_json(send, {'got_frames': got_frames})
+
+    async def live(self, params: dict, receive, send):
+        """
+        Live webcam channel. The client sends encoded frames as binary
+        messages and may switch the output with a text message such as
+        {"output": "image"}, or the inference profile with {"profile": "auto",
+        "latency_budget_ms": 80}. Each result goes back on the same socket as
+        a JSON text message, a packed binary record or an annotated JPEG.
+        """
+        message = await receive()
+        if message['type'] != 'websocket.connect':
+            return
+
+        output = params.get('output', 'json')
+        profile = params.get('profile')
+        try:
+            budget_ms = float(params['latency_budget_ms']) if 'latency_budget_ms' in params else None
+            self.resolve_profile(profile, budget_ms)
+        except ValueError:
+            output = None
+
+        if output not in OUTPUT_FORMATS:
+            await send({'type': 'websocket.close', 'code': WS_POLICY_VIOLATION})
+            return
+
+        await send({'type': 'websocket.accept'})
+
+        session = LiveSession(output, profile, budget_ms)
+        worker = asyncio.ensure_future(self.live_worker(session, send))
+
+        try:
+            while True:
+                message = await receive()
+
+                if message['type'] == 'websocket.disconnect':
+                    break
+
+                if message.get('bytes'):
+                    session.put(message['bytes'])
+                elif message.get('text'):
+                    await self.live_control(session, message['text'], send)
+        finally:
+            worker.cancel()
+            logger.info(f"Live session closed after {session.seq} frames, {session.skipped} skipped.")
+
+    def resolve_profile(self, profile: str, budget_ms: float) -> str:
+        return self.app.config['PROFILE_SELECTOR'].resolve(
+            profile, self.app.config['ROUTE_PROFILES']['frame'], budget_ms)
+
+    async def live_control(self, session: LiveSession, text: str, send):
+        try:
+            control = json.loads(text)
+        except ValueError:
+            control = None
+        if not isinstance(control, dict):
+            control = {}
+
+        if 'profile' in control:
+            try:
+                budget_ms = control.get('latency_budget_ms')
+                budget_ms = float(budget_ms) if budget_ms is not None else None
+                self.resolve_profile(control['profile'], budget_ms)
+            except (TypeError, ValueError) as e:
+                await send({'type': 'websocket.send', 'text': json.dumps({'error': str(e)})})
+                return
+
+            session.profile, session.budget_ms = control['profile'], budget_ms
+            if 'output' not in control:
+                return
+
+        output = control.get('output')
+        if output not in OUTPUT_FORMATS:
+            await send({'type': 'websocket.send',
+                        'text': json.dumps({'error': f"output must be one of {', '.join(OUTPUT_FORMATS)}"})})
+            return
+
+        session.output = output
+
+    async def live_worker(self, session: LiveSession, send):
+        while True:
+            frame, seq, output = await session.take()
+            deadline_ms = self.app.config['INFERENCE_DEADLINES_MS']['live']
+            deadline = time.perf_counter() + deadline_ms / 1000 if deadline_ms > 0 else None
+
+            try:
+                profile = self.resolve_profile(session.profile, session.budget_ms)
+                result = await asyncio.to_thread(self.detect_live_frame, frame, seq, output, profile, deadline)
+            except (InferenceOverloadedError, DeadlineExceededError, InferenceUnavailableError):
+                # The client keeps sending, the next frame gets a fresh deadline
+                result = json.dumps({'error': 'Server is busy, frame skipped', 'frame': seq})
+            except Exception as e:
+                ERRORS.inc(where='live')
+                logger.error(f"Error processing live frame: {str(e)}")
+                result = json.dumps({'error': 'Error processing frame', 'frame': seq})
+
+            if isinstance(result, bytes):
+                await send({'type': 'websocket.send', 'bytes': result})
+            else:
+                await send({'type': 'websocket.send', 'text': result})
+
+    def detect_live_frame(self, frame: bytes, seq: int, output: str, profile: str, deadline: float):
+        # Webcam frames never repeat, so they skip the result cache
+        with self.app.app_context():
+            if output == 'image':
+                return img_detector(frame, use_cache=False, profile=profile,
+                                    priority='live', deadline=deadline).getvalue()
+
+            detections, width, height = img_detections(frame, use_cache=False, profile=profile,
+                                                       priority='live', deadline=deadline)
+
+        if output == 'binary':
+            return pack_detections(detections, frame=seq)
+
+        return json.dumps(detections_to_dict(
+            detections, self.app.config['CLASS_NAMES'], width, height, frame=seq))
+
+
+def create_asgi_app(app: Flask = None) -> AsyncStreamingApp:
+    if app is None:
+        from . import create_app
+        app = create_app()
+    return AsyncStreamingApp(app)
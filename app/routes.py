@@ -1,11 +1,26 @@
 import os
+import hmac
+import math
 import queue
 from tempfile import NamedTemporaryFile
-from PIL import Image
 import logging
 from dotenv import load_dotenv
-from flask import current_app, Blueprint, request, send_file, jsonify, Response
-from .utils.detector import img_detector
+import time
+from flask import current_app, Blueprint, request, send_file, jsonify, Response, g, stream_with_context
+from .utils.detector import img_detector, img_detections
+from .utils.detection_formats import OUTPUT_FORMATS, detections_to_dict, pack_detections
+from .utils.job_executor import ExecutorSaturatedError
+from .utils.inference_priority import InferenceOverloadedError, DeadlineExceededError, InferenceUnavailableError
+from .utils.background_thread_factory import ThreadNotFoundError
+from .utils.process_frames_job import ProcessFramesJob
+from .utils.job_store import StoredJob
+from .utils.frame_buffer import POLICIES
+from .utils.frame_encoders import VIDEO_OUTPUT_FORMATS
+from .utils.metrics import registry, REQUEST_SECONDS, ERRORS
+from .utils.batch_images import (BATCH_OUTPUTS, BATCH_MIMETYPES, BATCH_STREAMS, UnsupportedArchiveError,
+                                  archive_kind, iter_archive, process_batch)
+from .utils.video_uploads import (copy_stream, UploadTooLargeError, UnsupportedVideoError,
+                                  UploadOffsetError, UploadNotFoundError)
 
 load_dotenv()
 
@@ -14,6 +29,34 @@ logger = logging.getLogger(__name__)
 
 MAX_WAIT_TIME = 10
 
+STREAM_MIMETYPES = {
+    'image': 'multipart/x-mixed-replace; boundary=frame',
+    'json': 'application/x-ndjson',
+    'binary': 'application/octet-stream',
+    'mp4': 'video/mp4',
+}
+
+# Mimetype and file extension of a finished job's download
+DOWNLOAD_FORMATS = {
+    'image': ('video/x-motion-jpeg', 'mjpeg'),
+    'json': ('application/x-ndjson', 'ndjson'),
+    'binary': ('application/octet-stream', 'bin'),
+    'mp4': ('video/mp4', 'mp4'),
+}
+
+
+@bp.before_request
+def start_timer():
+    g.request_start = time.perf_counter()
+
+
+@bp.after_request
+def record_request(response):
+    if 'request_start' in g:
+        REQUEST_SECONDS.observe(time.perf_counter() - g.request_start,
+                                endpoint=request.endpoint, status=response.status_code)
+    return response
+
 
 @bp.errorhandler(404)
 def resource_not_found(e):
@@ -35,6 +78,148 @@ def hello_world():
     return "<h1 style='color:green'>Hello World! Are we live?</h1>"
 
 
+@bp.route("/ready")
+def ready():
+    # Unlike /ping, only green once the inference engine is loaded and warmed up
+    inferenceBackend = current_app.config.get('INFERENCE_BACKEND')
+
+    if inferenceBackend is None:
+        return jsonify({'ready': False, 'state': 'failed', 'error': 'Inference backend did not start'}), 503
+
+    if inferenceBackend.startup_error is not None:
+        return jsonify({'ready': False, 'state': 'failed', 'error': str(inferenceBackend.startup_error)}), 503
+
+    if not inferenceBackend.ready.is_set():
+        return jsonify({'ready': False, 'state': 'starting'}), 503
+
+    timings = {**current_app.config['STARTUP_TIMINGS'], **inferenceBackend.startup_timings}
+    return jsonify({'ready': True, 'state': 'ready',
+                    'startup_ms': {stage: round(seconds * 1000, 1) for stage, seconds in timings.items()}}), 200
+
+
+@bp.route("/metrics", methods=['GET'])
+def metrics():
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+
+@bp.before_request
+def check_profiler_access():
+    if not request.path.startswith('/api/profiler'):
+        return None
+
+    token = current_app.config['PROFILER_TOKEN']
+    if token:
+        if not hmac.compare_digest(request.headers.get('X-Profiler-Token', '').encode(), token.encode()):
+            return jsonify({'error': 'Invalid profiler token'}), 403
+    elif not current_app.config['PROFILER_ENABLED']:
+        return jsonify({'error': 'Not found'}), 404
+    return None
+
+
+@bp.route("/api/profiler", methods=['GET'])
+def profiler_report():
+    profiler = current_app.config.get('PROFILER')
+
+    if profiler is None:
+        return jsonify({'error': 'Profiler has not been started'}), 404
+
+    return Response(profiler.collapsed(), mimetype='text/plain')
+
+
+@bp.route("/api/profiler/start", methods=['POST'])
+def start_profiler():
+    profiler = current_app.config.get('PROFILER')
+
+    if profiler is not None and profiler.is_alive():
+        return jsonify({'error': 'Profiler is already running'}), 409
+
+    try:
+        interval_ms = float(request.args.get('interval_ms', 10))
+    except ValueError:
+        interval_ms = math.nan
+    if not math.isfinite(interval_ms) or interval_ms < 1:
+        return jsonify({'error': 'interval_ms must be a number of at least 1'}), 400
+
+    backgroundThreadFactory = current_app.config['BACKGROUND_THREAD_FACTORY']
+    profiler = backgroundThreadFactory.create(
+        'profiler', interval_ms=interval_ms)
+    current_app.config['PROFILER'] = profiler
+    profiler.start()
+
+    return jsonify({'running': True, 'interval_ms': interval_ms}), 200
+
+
+@bp.route("/api/profiler/stop", methods=['POST'])
+def stop_profiler():
+    profiler = current_app.config.get('PROFILER')
+
+    if profiler is None or not profiler.is_alive():
+        return jsonify({'error': 'Profiler is not running'}), 409
+
+    profiler.stop()
+    profiler.join()
+    current_app.config['BACKGROUND_THREAD_FACTORY'].delete(profiler.thread_id)
+
+    return Response(profiler.collapsed(), mimetype='text/plain')
+
+
+@bp.route("/api/inference_metrics", methods=['GET'])
+def inference_metrics():
+    inferenceBackend = current_app.config['INFERENCE_BACKEND']
+    jobExecutor = current_app.config['JOB_EXECUTOR']
+    resultCache = current_app.config['RESULT_CACHE']
+    backgroundThreadFactory = current_app.config['BACKGROUND_THREAD_FACTORY']
+    return jsonify({**inferenceBackend.metrics(), 'video_jobs': jobExecutor.stats(),
+                    'job_registry': backgroundThreadFactory.threads.stats(),
+                    'result_cache': resultCache.stats(),
+                    'temp_storage': current_app.config['TEMP_STORAGE'].usage(),
+                    'profiles': current_app.config['PROFILE_SELECTOR'].stats()}), 200
+
+
+def request_profile(values, route: str) -> str:
+    """
+    The inference profile a request asked for, the route's default otherwise.
+    'auto' picks the largest input expected to answer within latency_budget_ms.
+    :return: profile name
+    """
+    return current_app.config['PROFILE_SELECTOR'].resolve(
+        values.get('profile'), current_app.config['ROUTE_PROFILES'][route],
+        values.get('latency_budget_ms', type=float))
+
+
+def request_deadline(values, priority: str) -> float:
+    """
+    When the result of this request is needed by, counted from its arrival.
+    :return: time.perf_counter() value, None without a deadline
+    """
+    deadline_ms = values.get('deadline_ms', type=float)
+    if deadline_ms is None:
+        deadline_ms = current_app.config['INFERENCE_DEADLINES_MS'][priority]
+
+    return g.request_start + deadline_ms / 1000 if deadline_ms > 0 else None
+
+
+def shed_response(e: Exception) -> Response:
+    # Refused before inference ran, so the client can retry right away or elsewhere
+    error = 'Inference is unavailable.' if isinstance(e, InferenceUnavailableError) \
+        else 'Server is busy, please try again.'
+    response = jsonify({'error': error, 'reason': str(e)})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(getattr(e, 'retry_after', 1))
+    return response
+
+
+def detections_response(img: bytes, output: str, profile: str, priority: str,
+                        deadline: float) -> Response:
+    detections, width, height = img_detections(img, profile=profile, priority=priority,
+                                               deadline=deadline)
+
+    if output == 'binary':
+        return Response(pack_detections(detections), mimetype='application/octet-stream')
+
+    return jsonify(detections_to_dict(detections, current_app.config['CLASS_NAMES'], width, height))
+
+
 @bp.route("/api/process_image", methods=['POST'])
 def process_image():
 
@@ -46,14 +231,69 @@ def process_image():
     if file.filename == '' or not file.filename.lower().split(".")[-1] in ("jpg", "jpeg", "png", "webp"):
         return "Unsupported file format. Only JPG, JPEG, PNG, WEBP are supported.", 415
 
+    output = request.values.get('output', 'image')
+
+    if output not in OUTPUT_FORMATS:
+        return f"output must be one of {', '.join(OUTPUT_FORMATS)}", 400
+
     try:
-        img_io = img_detector(file.read())
+        profile = request_profile(request.values, 'image')
+    except ValueError as e:
+        return str(e), 400
+
+    deadline = request_deadline(request.values, 'image')
+
+    try:
+        if output != 'image':
+            return detections_response(file.read(), output, profile, 'image', deadline)
+
+        img_io = img_detector(file.read(), profile=profile, deadline=deadline)
         return send_file(img_io, mimetype='image/jpeg')
+    except (InferenceOverloadedError, DeadlineExceededError, InferenceUnavailableError) as e:
+        return shed_response(e)
     except Exception as e:
+        ERRORS.inc(where='process_image')
         logger.error(f"Error processing image: {str(e)}")
         return "Error processing image", 500
 
 
+@bp.route("/api/process_images", methods=['POST'])
+def process_images():
+    output = request.values.get('output', 'json')
+
+    if output not in BATCH_OUTPUTS:
+        return jsonify({"error": f"output must be one of {', '.join(BATCH_OUTPUTS)}"}), 400
+
+    try:
+        profile = request_profile(request.values, 'image')
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    files = request.files.getlist('images')
+    archive = request.files.get('archive')
+
+    if archive is not None:
+        try:
+            archive_kind(archive.stream)
+        except UnsupportedArchiveError as e:
+            return jsonify({"error": str(e)}), 415
+        images = iter_archive(archive.stream,
+                              max_member_bytes=current_app.config['BATCH_MAX_IMAGE_BYTES'],
+                              max_total_bytes=current_app.config['BATCH_MAX_ARCHIVE_BYTES'])
+    elif files:
+        images = ((file.filename, file.read()) for file in files)
+    else:
+        return jsonify({"error": "No images or archive provided"}), 400
+
+    results = process_batch(current_app._get_current_object(), images, output,
+                            workers=current_app.config['BATCH_IMAGE_WORKERS'],
+                            max_images=current_app.config['BATCH_MAX_IMAGES'], profile=profile)
+
+    # The request context keeps the uploaded files open while results stream out
+    return Response(stream_with_context(BATCH_STREAMS[output](results)),
+                    mimetype=BATCH_MIMETYPES[output])
+
+
 @bp.route("/api/process_example_image", methods=['GET', 'POST'])
 def process_example_image():
 
@@ -68,10 +308,20 @@ def process_example_image():
         return jsonify({'error': 'File not found'}), 404
 
     try:
-        image = Image.open(file_path)
-        img_io = img_detector(image, as_bytes=False)
+        profile = request_profile(request.values, 'image')
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    deadline = request_deadline(request.values, 'image')
+
+    try:
+        with open(file_path, 'rb') as f:
+            img_io = img_detector(f.read(), profile=profile, deadline=deadline)
         return send_file(img_io, mimetype='image/jpeg')
+    except (InferenceOverloadedError, DeadlineExceededError, InferenceUnavailableError) as e:
+        return shed_response(e)
     except Exception as e:
+        ERRORS.inc(where='process_example_image')
         logger.error(f"Error processing image: {str(e)}")
         return "Error processing image", 500
 
@@ -81,16 +331,36 @@ def process_frame():
     if 'frame' not in request.files:
         return jsonify({"error": "No frame file provided"}), 400
 
+    output = request.values.get('output', 'image')
+
+    if output not in OUTPUT_FORMATS:
+        return jsonify({"error": f"output must be one of {', '.join(OUTPUT_FORMATS)}"}), 400
+
+    try:
+        profile = request_profile(request.values, 'frame')
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    # Webcam frames go ahead of images and video, and are only useful while fresh
+    deadline = request_deadline(request.values, 'live')
+
     try:
         frame_file = request.files['frame']
-        img_io = img_detector(frame_file.read(), stream=True)
+
+        if output != 'image':
+            return detections_response(frame_file.read(), output, profile, 'live', deadline)
+
+        img_io = img_detector(frame_file.read(), profile=profile, priority='live', deadline=deadline)
 
         return send_file(
             img_io,
             mimetype='image/jpeg',
             as_attachment=False
         )
+    except (InferenceOverloadedError, DeadlineExceededError, InferenceUnavailableError) as e:
+        return shed_response(e)
     except Exception as e:
+        ERRORS.inc(where='process_frame')
         logger.error(f"Error processing frame: {str(e)}")
         return "Error processing frame", 500
 
@@ -100,20 +370,92 @@ def save_to_temp(file) -> str:
         delete=False, suffix=".mp4", dir=current_app.config['TEMP_DIR'])
 
     try:
-        contents = file.read()
+        # Stream in chunks so an upload never sits in memory as a whole
         with temp as f:
             temp_file_name = f.name
-            f.write(contents)
-            f.flush()
-            os.fsync(f.fileno())
+            copy_stream(file.stream, f,
+                        current_app.config['VIDEO_MAX_UPLOAD_BYTES'])
+
+        # Pinned until the job that processes it removes it
+        current_app.config['TEMP_STORAGE'].track(temp_file_name, 'uploads', pinned=True)
         return temp_file_name
+    except (UploadTooLargeError, UnsupportedVideoError):
+        os.remove(temp.name)
+        raise
     except Exception as e:
+        os.remove(temp.name)
         logger.error(f"Error uploading file: {str(e)}")
         raise Exception("Error uploading the file.")
     finally:
         file.close()
 
 
+def video_job_options(values) -> dict:
+    """
+    Validate the streaming options shared by the video routes.
+    :return: keyword arguments for submit_video_job
+    """
+    buffer_policy = values.get('buffer_policy')
+
+    if buffer_policy and buffer_policy not in POLICIES:
+        raise ValueError(f"buffer_policy must be one of {', '.join(POLICIES)}")
+
+    output = values.get('output', 'image')
+
+    if output not in VIDEO_OUTPUT_FORMATS:
+        raise ValueError(f"output must be one of {', '.join(VIDEO_OUTPUT_FORMATS)}")
+
+    if output == 'mp4' and not current_app.config['FFMPEG_PATH']:
+        raise ValueError("mp4 output is not available on this server")
+
+    encoding = {}
+
+    quality = values.get('quality', type=int)
+    if quality is not None:
+        if not 1 <= quality <= 100:
+            raise ValueError("quality must be between 1 and 100")
+        encoding['quality'] = quality
+
+    max_side = values.get('max_side', type=int)
+    if max_side is not None:
+        if max_side < 0:
+            raise ValueError("max_side must be 0 or a positive number of pixels")
+        encoding['max_side'] = max_side
+
+    adaptive = values.get('adaptive')
+    if adaptive is not None:
+        encoding['adaptive'] = adaptive.lower() in ('1', 'true', 'yes')
+
+    # 'auto' is resolved once, the whole video runs at the chosen size
+    profile = request_profile(values, 'video')
+
+    return {'buffer_policy': buffer_policy, 'output': output, 'encoding': encoding,
+            'profile': profile}
+
+
+def submit_video_job(file_path: str, file_id: str, **job_options) -> Response:
+    backgroundThreadFactory = current_app.config['BACKGROUND_THREAD_FACTORY']
+    jobExecutor = current_app.config['JOB_EXECUTOR']
+
+    job = backgroundThreadFactory.create(
+        thread_type="process_frames", file_path=file_path, file_id=file_id,
+        **job_options)
+
+    try:
+        position = jobExecutor.submit(job)
+    except ExecutorSaturatedError as e:
+        logger.warning(f"Rejecting video job for {file_id}: {str(e)}")
+        backgroundThreadFactory.delete(job.job_id)
+
+        response = jsonify(
+            {"error": "Too many videos are being processed, please try again later."})
+        response.status_code = 429
+        response.headers['Retry-After'] = str(jobExecutor.retry_after())
+        return response
+
+    return jsonify({'id': str(job.job_id), 'queue_position': position})
+
+
 @bp.route('/api/upload_video', methods=['POST'])
 def upload_video():
     if 'video' not in request.files:
@@ -124,6 +466,11 @@ def upload_video():
     if file.filename == '' or not file.content_type == 'video/mp4':
         return jsonify({"error": "File is not an MP4 video"}), 400
 
+    try:
+        job_options = video_job_options(request.values)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
     if file:
         try:
             tempFilePath = save_to_temp(file)
@@ -134,37 +481,137 @@ def upload_video():
 
             file_id = os.path.basename(tempFilePath)
 
-            backgroundThreadFactory = current_app.config['BACKGROUND_THREAD_FACTORY']
-            thread = backgroundThreadFactory.create(
-                thread_type="process_frames", file_path=tempFilePath, file_id=file_id)
-            thread.start()
-
-            return jsonify({'id': str(thread.thread_id)})
+            # A rejected job removes the upload along with itself
+            return submit_video_job(tempFilePath, file_id, delete_source=True, **job_options)
+        except UploadTooLargeError as e:
+            return jsonify({"error": str(e)}), 413
+        except UnsupportedVideoError as e:
+            return jsonify({"error": str(e)}), 415
         except Exception as e:
+            ERRORS.inc(where='upload_video')
             logger.error(f"Error uploading video: {str(e)}")
             return jsonify({"error": "Error uploading video"}), 500
 
 
-def generate_frames(thread, backgroundThreadFactory):
-    frame_queue = thread.get_frame_queue()
+@bp.route('/api/upload_video/chunked', methods=['POST'])
+def create_chunked_upload():
+    chunkedUploads = current_app.config['CHUNKED_UPLOADS']
+
+    try:
+        upload_id = chunkedUploads.create(
+            request.args.get('total_size', type=int))
+    except UploadTooLargeError as e:
+        return jsonify({"error": str(e)}), 413
+
+    return jsonify(chunkedUploads.status(upload_id)), 201
+
+
+@bp.route('/api/upload_video/chunked/<upload_id>', methods=['GET'])
+def chunked_upload_status(upload_id):
+    chunkedUploads = current_app.config['CHUNKED_UPLOADS']
+
+    try:
+        return jsonify(chunkedUploads.status(upload_id))
+    except UploadNotFoundError as e:
+        return jsonify({"error": str(e)}), 404
+
+
+@bp.route('/api/upload_video/chunked/<upload_id>', methods=['PUT', 'PATCH'])
+def append_chunked_upload(upload_id):
+    chunkedUploads = current_app.config['CHUNKED_UPLOADS']
+    offset = request.args.get('offset', type=int)
+
+    if offset is None:
+        return jsonify({"error": "No offset provided"}), 400
+
+    try:
+        new_offset = chunkedUploads.append(upload_id, offset, request.stream)
+        return jsonify({'upload_id': upload_id, 'offset': new_offset})
+    except UploadNotFoundError as e:
+        return jsonify({"error": str(e)}), 404
+    except UploadOffsetError as e:
+        return jsonify({"error": str(e), **chunkedUploads.status(upload_id)}), 409
+    except UploadTooLargeError as e:
+        chunkedUploads.discard(upload_id)
+        return jsonify({"error": str(e)}), 413
+    except UnsupportedVideoError as e:
+        chunkedUploads.discard(upload_id)
+        return jsonify({"error": str(e)}), 415
+
+
+@bp.route('/api/upload_video/chunked/<upload_id>/complete', methods=['POST'])
+def complete_chunked_upload(upload_id):
+    chunkedUploads = current_app.config['CHUNKED_UPLOADS']
+
+    try:
+        job_options = video_job_options(request.values)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        file_path = chunkedUploads.complete(
+            upload_id, current_app.config['TEMP_DIR'])
+    except UploadNotFoundError as e:
+        return jsonify({"error": str(e)}), 404
+    except UploadOffsetError as e:
+        return jsonify({"error": str(e), **chunkedUploads.status(upload_id)}), 409
+
+    try:
+        return submit_video_job(
+            file_path, os.path.basename(file_path), delete_source=True, **job_options)
+    except Exception as e:
+        ERRORS.inc(where='upload_video')
+        logger.error(f"Error uploading video: {str(e)}")
+        return jsonify({"error": "Error uploading video"}), 500
+
+
+def generate_frames(job, backgroundThreadFactory, start_frame: int = 0):
+    frame_queue = job.open_stream(start_frame)
 
     while True:
         try:
             frame_data = frame_queue.get(timeout=2)
 
             if frame_data == "DONE":
-                backgroundThreadFactory.delete(thread.thread_id)
                 break
             else:
                 yield frame_data
         except queue.Empty:
-            print("No frame retrieved within the timeout period.")
+            logger.debug("No frame retrieved within the timeout period.")
             continue
 
+    finish_stream(job, backgroundThreadFactory)
+
+
+def finish_stream(job, backgroundThreadFactory) -> None:
+    # Persisted output stays for other viewers and downloads until the
+    # job reaper evicts it
+    if job.persisted:
+        return
+
+    # The job may still be queued when streaming starts, so its uploaded
+    # source is only removed once the stream has reached the end
+    backgroundThreadFactory.delete(job.job_id)
+
+
+def job_progress(app, id: str) -> dict:
+    backgroundThreadFactory = app.config['BACKGROUND_THREAD_FACTORY']
+    thread = backgroundThreadFactory.get_thread(id)
+
+    if thread:
+        jobExecutor = app.config['JOB_EXECUTOR']
+        return {'progress': thread.progress,
+                'state': thread.state,
+                'queue_position': jobExecutor.position(id),
+                **thread.open_stream().stats()}
+
+    return {'progress': 0}
+
 
 @bp.route('/api/stream_frames', methods=['GET'])
 def stream_input_frames():
     thread_id = request.args.get('id')
+    from_frame = request.args.get('from_frame', 0, type=int)
 
     if not thread_id:
         return jsonify({'error': 'No id provided'}), 400
@@ -176,20 +623,15 @@ def stream_input_frames():
         if thread is None:
             return jsonify({'error': 'Thread not found'}), 404
 
-        file_path = thread.file_path
-
-        delect_src = False if thread.file_id.startswith('hair') else True
+        # An MP4 stream cannot be joined in the middle
+        if thread.output == 'mp4':
+            from_frame = 0
 
-        return Response(generate_frames(thread, backgroundThreadFactory), mimetype='multipart/x-mixed-replace; boundary=frame')
+        return Response(generate_frames(thread, backgroundThreadFactory, from_frame),
+                        mimetype=STREAM_MIMETYPES[thread.output])
 
     except Exception as e:
         return jsonify({'error': str(e)}), 500
-    finally:
-        if os.path.exists(file_path) and delect_src:
-            try:
-                os.remove(file_path)
-            except Exception as e:
-                logger.error(f"Failed to delete source video file: {e}")
 
 
 @bp.route('/api/process_video_example', methods=['GET'])
@@ -205,17 +647,74 @@ def process_video_example():
         return jsonify({'error': 'File not found'}), 404
 
     try:
-        backgroundThreadFactory = current_app.config['BACKGROUND_THREAD_FACTORY']
-        thread = backgroundThreadFactory.create(
-            thread_type="process_frames", file_path=file_path, file_id=file_id)
-        thread.start()
+        job_options = video_job_options(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    start_frame = request.args.get('start_frame', 0, type=int)
 
-        return jsonify({'id': str(thread.thread_id)})
+    try:
+        return submit_video_job(file_path, file_id, start_frame=start_frame,
+                                cache_track=True, **job_options)
     except Exception as e:
+        ERRORS.inc(where='process_video_example')
         logger.error(f"Error uploading video: {str(e)}")
         return jsonify({"error": "Error uploading video"}), 500
 
 
+@bp.route('/api/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    backgroundThreadFactory = current_app.config['BACKGROUND_THREAD_FACTORY']
+
+    try:
+        job = backgroundThreadFactory.get_thread(job_id)
+    except ThreadNotFoundError:
+        return jsonify({'error': 'Job not found'}), 404
+
+    if not isinstance(job, (ProcessFramesJob, StoredJob)):
+        return jsonify({'error': 'Job not found'}), 404
+
+    current_app.config['JOB_EXECUTOR'].cancel(job_id)
+    job.cancel()
+
+    return jsonify({'id': job_id, 'state': job.state})
+
+
+def mjpeg_frame(part: bytes) -> bytes:
+    # Strip the multipart headers and trailing CRLF around the JPEG
+    return part.split(b'\r\n\r\n', 1)[1][:-2]
+
+
+@bp.route('/api/jobs/<job_id>/download', methods=['GET'])
+def download_job(job_id):
+    backgroundThreadFactory = current_app.config['BACKGROUND_THREAD_FACTORY']
+
+    try:
+        job = backgroundThreadFactory.get_thread(job_id)
+    except ThreadNotFoundError:
+        return jsonify({'error': 'Job not found'}), 404
+
+    if not isinstance(job, (ProcessFramesJob, StoredJob)) or not job.persisted:
+        return jsonify({'error': 'Job output is not stored'}), 404
+
+    if job.state != 'done':
+        return jsonify({'error': f'Job is {job.state}', 'state': job.state}), 409
+
+    reader = job.open_stream()
+    chunks = reader.chunks()
+    if job.output == 'image':
+        chunks = map(mjpeg_frame, chunks)
+
+    mimetype, extension = DOWNLOAD_FORMATS[job.output]
+    filename = f"{os.path.splitext(job.file_id)[0]}-detections.{extension}"
+
+    headers = {'Content-Disposition': f'attachment; filename="{filename}"'}
+    if job.output != 'image':
+        headers['Content-Length'] = str(reader.stats()['stored_bytes'])
+
+    return Response(chunks, mimetype=mimetype, headers=headers)
+
+
 @bp.route('/api/got_frames', methods=['GET'])
 def got_frames():
     thread_id = request.args.get('id')
@@ -231,7 +730,7 @@ def got_frames():
 
         if thread:
             # Return whether frames exist in the queue
-            frame_queue = thread.get_frame_queue()
+            frame_queue = thread.open_stream()
             got_frames = frame_queue.qsize() > 0
 
         else:
@@ -250,13 +749,7 @@ def get_progress():
         return jsonify({'error': 'No id provided'}), 400
 
     try:
-        backgroundThreadFactory = current_app.config['BACKGROUND_THREAD_FACTORY']
-        thread = backgroundThreadFactory.get_thread(id)
-
-        if thread:
-            return jsonify({'progress': thread.progress}), 200
-
-        return jsonify({'progress': 0}), 200
+        return jsonify(job_progress(current_app, id)), 200
     except Exception as e:
         return jsonify({'progress': 0}), 200
         # logger.error(f"Error fetching progress: {str(e)}")
@@ -1,10 +1,16 @@
+import time
 import uuid
 import logging
 
-from flask import Flask
+from flask import Flask, current_app
 from app.utils.background_thread import BackgroundThread
-from app.utils.clean_up_thread import CleanUpThread
-from app.utils.process_frames_thread import ProcessFramesThread
+from app.utils.temp_storage_thread import TempStorageThread
+from app.utils.process_frames_job import ProcessFramesJob
+from app.utils.inference_scheduler import InferenceScheduler
+from app.utils.cache_warmup_thread import CacheWarmupThread
+from app.utils.sampling_profiler import SamplingProfiler
+from app.utils.job_reaper_thread import JobReaperThread
+from app.utils.job_registry import JobRegistry
 
 
 class ThreadTypeNotImplementedError(Exception):
@@ -17,47 +23,90 @@ class ThreadNotFoundError(Exception):
 
 class BackgroundThreadFactory:
     def __init__(self, app: Flask):
-        self.threads = {}
         self.app = app
         self.logger = logging.getLogger(__name__)
 
-    def create(self, thread_type: str, daemon: bool = True, file_path: str = None, file_id: str = None) -> BackgroundThread:
+        with app.app_context():
+            self.threads = JobRegistry(ttl=current_app.config['JOB_TTL'])
+
+    def create(self, thread_type: str, daemon: bool = True, file_path: str = None, file_id: str = None,
+               **options) -> BackgroundThread:
         try:
             thread_id = uuid.uuid4()
 
-            if thread_type == "cleanup":
-                thread = CleanUpThread(thread_id=thread_id, app=self.app)
+            if thread_type == "temp_storage":
+                thread = TempStorageThread(thread_id=thread_id, app=self.app)
+            elif thread_type == "cache_warmup":
+                thread = CacheWarmupThread(thread_id=thread_id, app=self.app)
+            elif thread_type == "inference_scheduler":
+                thread = InferenceScheduler(thread_id=thread_id, app=self.app)
             elif thread_type == "process_frames":
-                thread = ProcessFramesThread(
-                    thread_id=thread_id, app=self.app,
-                    file_path=file_path, file_id=file_id)
+                thread = ProcessFramesJob(
+                    job_id=thread_id, app=self.app,
+                    file_path=file_path, file_id=file_id, **options)
+            elif thread_type == "profiler":
+                thread = SamplingProfiler(
+                    thread_id=thread_id, app=self.app, **options)
+            elif thread_type == "job_reaper":
+                thread = JobReaperThread(
+                    thread_id=thread_id, app=self.app, factory=self)
             else:
                 raise ThreadTypeNotImplementedError(
                     f"Thread type '{thread_type}' is not implemented.")
 
             if thread:
-                thread.daemon = daemon
-                self.threads[thread_id] = thread
+                if isinstance(thread, BackgroundThread):
+                    thread.daemon = daemon
+                self.threads.add(thread_id, thread)
                 return thread
         except Exception as e:
             self.logger.info(
                 f"Failed to create {thread_type} thread: {str(e)}")
 
     def get_thread(self, thread_id: str):
-        for id, thread_object in self.threads.items():
-            if thread_id == str(id):
-                return thread_object
-        raise ThreadNotFoundError(
-            f'Thread {thread_id} not found')
+        thread = self.threads.get(thread_id)
 
-    def delete(self, thread_id: str) -> None:
-        try:
-            thread = self.get_thread(thread_id)
+        if thread is None:
+            # A job another worker process is running, if the job store is shared
+            with self.app.app_context():
+                thread = current_app.config['JOB_STORE'].load(str(thread_id))
+
+        if thread is None:
+            raise ThreadNotFoundError(
+                f'Thread {thread_id} not found')
+        return thread
+
+    def delete(self, thread_id: str, evicted: bool = False) -> None:
+        thread = self.threads.remove(thread_id, evicted=evicted)
+
+        if thread is None:
+            with self.app.app_context():
+                thread = current_app.config['JOB_STORE'].load(str(thread_id))
 
-            if thread and thread.is_alive():
-                thread.stop()
-        except ThreadNotFoundError:
-            ...
+        if thread is None:
+            return
+
+        thread.stop()
+
+        # Jobs also drop their buffered frames and uploaded source file
+        if hasattr(thread, 'cleanup'):
+            thread.cleanup()
 
-        del self.threads[thread_id]
         self.logger.info(f"Thread with ID {thread_id} has been deleted.")
+
+    def evict_expired(self) -> int:
+        """
+        Delete finished jobs that nobody has polled or streamed within the TTL.
+        :return: number of evicted jobs
+        """
+        with self.app.app_context():
+            jobStore = current_app.config['JOB_STORE']
+
+        # Viewers on other workers only show up as reads in a shared store
+        deadline = time.time() - self.threads.ttl
+        expired = [thread_id for thread_id in self.threads.expired()
+                   if (jobStore.last_access(thread_id) or 0) < deadline]
+
+        for thread_id in expired:
+            self.delete(thread_id, evicted=True)
+        return len(expired)
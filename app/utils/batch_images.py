@@ -0,0 +1,222 @@
+import io
+import json
+import os
+import tarfile
+import zipfile
+import logging
+from collections import deque
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import Flask
+from .detector import img_detector, img_detections
+from .detection_formats import detections_to_dict
+from .metrics import ERRORS
+
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = ("jpg", "jpeg", "png", "webp")
+BATCH_OUTPUTS = ('json', 'image', 'zip')
+
+MULTIPART_BOUNDARY = 'image'
+BATCH_MIMETYPES = {
+    'json': 'application/x-ndjson',
+    'image': f'multipart/mixed; boundary={MULTIPART_BOUNDARY}',
+    'zip': 'application/zip',
+}
+
+
+class UnsupportedArchiveError(Exception):
+    pass
+
+
+class ArchiveMemberError(Exception):
+    # An archive member that was not extracted, reported in place of its result
+    pass
+
+
+def archive_kind(file) -> str:
+    """
+    :return: 'zip' or 'tar', the file is rewound afterwards
+    """
+    try:
+        if zipfile.is_zipfile(file):
+            return 'zip'
+        file.seek(0)
+        if tarfile.is_tarfile(file):
+            return 'tar'
+    finally:
+        file.seek(0)
+
+    raise UnsupportedArchiveError("archive must be a zip or tar file")
+
+
+def iter_archive(file, max_member_bytes: int, max_total_bytes: int):
+    """
+    Read the regular files of a zip or (optionally compressed) tar archive
+    one at a time, a tar is read as a stream. Uncompressed sizes are checked
+    against the limits before a member is read: a member over
+    max_member_bytes is skipped, and once the members add up to more than
+    max_total_bytes the rest of the archive is not read.
+    :return: iterator of (name, bytes or ArchiveMemberError)
+    """
+    total = 0
+
+    def check(size: int):
+        nonlocal total
+        total += size
+        if total > max_total_bytes:
+            return ArchiveMemberError(f"Archive is limited to {max_total_bytes} bytes uncompressed")
+        if size > max_member_bytes:
+            return ArchiveMemberError(f"Image is limited to {max_member_bytes} bytes")
+        return None
+
+    # The sizes are the ones the archive declares, and neither format reads past them
+    if archive_kind(file) == 'zip':
+        with zipfile.ZipFile(file) as archive:
+            for info in archive.infolist():
+                if info.is_dir():
+                    continue
+                error = check(info.file_size)
+                yield info.filename, error or archive.read(info)
+                if total > max_total_bytes:
+                    return
+        return
+
+    with tarfile.open(fileobj=file, mode='r|*') as archive:
+        for member in archive:
+            if not member.isfile():
+                continue
+            error = check(member.size)
+            yield member.name, error or archive.extractfile(member).read()
+            if total > max_total_bytes:
+                return
+
+
+def supported_image(name: str) -> bool:
+    return name.lower().split(".")[-1] in IMAGE_EXTENSIONS
+
+
+def process_batch(app: Flask, images, output: str, workers: int, max_images: int,
+                  profile: str = 'quality'):
+    """
+    Run detection on many images, keeping `workers` of them decoding and
+    waiting on the inference backend at once so the scheduler can fill its
+    batches. Results come back in input order as soon as they are ready,
+    and one failing image does not stop the others.
+    :return: iterator of (name, result, error), result is a dict for json and JPEG bytes otherwise
+    """
+    class_names = app.config['CLASS_NAMES']
+
+    def work(name: str, data):
+        if isinstance(data, ArchiveMemberError):
+            return name, None, str(data)
+        if not supported_image(name):
+            return name, None, "Unsupported file format. Only JPG, JPEG, PNG, WEBP are supported."
+
+        try:
+            with app.app_context():
+                # Bulk work queues behind interactive requests, like video frames
+                if output == 'json':
+                    detections, width, height = img_detections(data, profile=profile, priority='video')
+                    return name, detections_to_dict(detections, class_names, width, height), None
+                return name, img_detector(data, profile=profile, priority='video').getvalue(), None
+        except Exception as e:
+            ERRORS.inc(where='process_images')
+            logger.error(f"Error processing image {name}: {str(e)}")
+            return name, None, "Error processing image"
+
+    inflight = deque()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='batch-image') as executor:
+        for count, (name, data) in enumerate(images):
+            if count == max_images:
+                yield name, None, f"Batch is limited to {max_images} images"
+                break
+
+            inflight.append(executor.submit(work, name, data))
+            if len(inflight) >= workers:
+                yield inflight.popleft().result()
+
+        while inflight:
+            yield inflight.popleft().result()
+
+
+def ndjson_stream(results):
+    for name, result, error in results:
+        line = {'name': name, 'error': error} if error else {'name': name, **result}
+        yield json.dumps(line).encode() + b'\n'
+
+
+def content_disposition(name: str) -> str:
+    """
+    :return: an attachment header for a client-supplied file name, with a
+        plain ASCII filename and the original name encoded as in RFC 5987
+    """
+    name = os.path.basename(name)
+    fallback = ''.join(c for c in name if c.isascii() and c.isprintable() and c not in '"\\')
+    return f"attachment; filename=\"{fallback or 'image'}\"; filename*=UTF-8''{quote(name, safe='')}"
+
+
+def multipart_stream(results):
+    for name, result, error in results:
+        if error:
+            body = json.dumps({'name': name, 'error': error}).encode()
+            content_type = 'application/json'
+        else:
+            body = result
+            content_type = 'image/jpeg'
+
+        yield (f'--{MULTIPART_BOUNDARY}\r\nContent-Type: {content_type}\r\n'
+               f'Content-Disposition: {content_disposition(name)}\r\n'
+               f'Content-Length: {len(body)}\r\n\r\n').encode() + body + b'\r\n'
+
+    yield f'--{MULTIPART_BOUNDARY}--\r\n'.encode()
+
+
+class _ChunkSink(io.RawIOBase):
+    # Unseekable target, so zipfile writes data descriptors and never seeks back
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def take(self) -> bytes:
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def zip_stream(results):
+    """
+    Stream a zip of annotated JPEGs as it is written. JPEGs are stored
+    uncompressed, failed images are listed in errors.ndjson at the end.
+    """
+    sink = _ChunkSink()
+    errors = []
+
+    with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_STORED) as archive:
+        for index, (name, result, error) in enumerate(results):
+            if error:
+                errors.append({'name': name, 'error': error})
+                continue
+
+            stem = os.path.splitext(os.path.basename(name))[0]
+            archive.writestr(f'{index:04d}_{stem}.jpg', result)
+            yield sink.take()
+
+        if errors:
+            archive.writestr('errors.ndjson', ''.join(json.dumps(e) + '\n' for e in errors))
+
+    yield sink.take()
+
+
+BATCH_STREAMS = {
+    'json': ndjson_stream,
+    'image': multipart_stream,
+    'zip': zip_stream,
+}
@@ -0,0 +1,48 @@
+import os
+import logging
+
+from flask import Flask, current_app
+from app.utils.background_thread import BackgroundThread
+from .detector import img_detector, add_video_detections
+
+
+class CacheWarmupThread(BackgroundThread):
+    def __init__(self, thread_id: str, app: Flask):
+        super().__init__(thread_id, app)
+        self.logger = logging.getLogger(__name__)
+        self.app = app
+
+        with self.app.app_context():
+            self.example_dir = current_app.config['EXAMPLE_IMG_DIR']
+            self.example_video_dir = current_app.config['EXAMPLE_VIDEO_DIR']
+            self.precompute_tracks = current_app.config['PRECOMPUTE_EXAMPLE_TRACKS']
+            # Warm the entries the routes' default profiles will look up
+            self.image_profile = current_app.config['ROUTE_PROFILES']['image']
+            self.video_profile = current_app.config['ROUTE_PROFILES']['video']
+
+    def startup(self) -> None:
+        self.logger.info('Pre-warming result cache with example images...')
+
+    def shutdown(self) -> None:
+        self.logger.info('Result cache warm-up finished.')
+
+    def handle(self) -> None:
+        with self.app.app_context():
+            for file_name in sorted(os.listdir(self.example_dir)):
+                file_path = os.path.join(self.example_dir, file_name)
+                try:
+                    with open(file_path, 'rb') as f:
+                        img_detector(f.read(), profile=self.image_profile)
+                except Exception as e:
+                    self.logger.error(f"Failed to pre-warm {file_path}: {e}")
+
+            if self.precompute_tracks:
+                trackStore = current_app.config['DETECTION_TRACKS']
+                for file_name in sorted(os.listdir(self.example_video_dir)):
+                    file_path = os.path.join(self.example_video_dir, file_name)
+                    if trackStore.get(file_path, self.video_profile) is None:
+                        for _ in add_video_detections(file_path, file_id=file_name, cache_track=True,
+                                                      profile=self.video_profile):
+                            pass
+
+        self.stop()
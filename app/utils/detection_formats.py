@@ -0,0 +1,50 @@
+import json
+import struct
+
+import numpy as np
+from app.utils.detections import Detections
+
+OUTPUT_FORMATS = ('image', 'json', 'binary')
+
+BINARY_HEADER = struct.Struct('<II')
+
+
+def detections_to_dict(detections: Detections, class_names: list[str], width: int, height: int,
+                       frame: int = None) -> dict:
+    result = {
+        'width': width,
+        'height': height,
+        'detections': [
+            {
+                'box': [round(float(v), 1) for v in box],
+                'class_id': int(cls),
+                'class_name': class_names[cls],
+                'confidence': round(float(conf), 4),
+            }
+            for box, conf, cls in zip(*detections)
+        ],
+    }
+
+    if frame is not None:
+        result['frame'] = frame
+
+    return result
+
+
+def detections_to_ndjson(detections: Detections, class_names: list[str], width: int, height: int,
+                         frame: int) -> bytes:
+    return json.dumps(detections_to_dict(detections, class_names, width, height, frame)).encode() + b'\n'
+
+
+def pack_detections(detections: Detections, frame: int = 0) -> bytes:
+    """
+    Pack detections as a little-endian record: uint32 frame index, uint32
+    detection count, then one row of float32 x1, y1, x2, y2, confidence,
+    class_id per detection.
+    :return: bytes
+    """
+    rows = np.empty((len(detections.class_ids), 6), dtype='<f4')
+    rows[:, :4] = detections.boxes
+    rows[:, 4] = detections.confidences
+    rows[:, 5] = detections.class_ids
+    return BINARY_HEADER.pack(frame, len(rows)) + rows.tobytes()
@@ -0,0 +1,126 @@
+import os
+import hashlib
+import threading
+import logging
+
+import numpy as np
+from app.utils.detections import Detections
+
+
+class DetectionTrack:
+    """
+    Per-frame detections of one video in a compact columnar layout. The
+    detections of frame i are rows offsets[i]:offsets[i + 1] of the
+    boxes, confidences and class_ids columns.
+    """
+
+    def __init__(self, offsets: np.ndarray, boxes: np.ndarray, confidences: np.ndarray, class_ids: np.ndarray):
+        self.offsets = offsets
+        self.boxes = boxes
+        self.confidences = confidences
+        self.class_ids = class_ids
+
+    @property
+    def frame_count(self) -> int:
+        return len(self.offsets) - 1
+
+    def frame(self, index: int) -> Detections:
+        start, end = self.offsets[index], self.offsets[index + 1]
+        return Detections(self.boxes[start:end].astype(np.float32),
+                          self.confidences[start:end].astype(np.float32),
+                          self.class_ids[start:end].astype(np.int32))
+
+    @classmethod
+    def from_frames(cls, frames: list[Detections]) -> 'DetectionTrack':
+        offsets = np.zeros(len(frames) + 1, dtype=np.int32)
+        offsets[1:] = np.cumsum([len(d.class_ids) for d in frames])
+
+        if frames:
+            boxes = np.concatenate([d.boxes for d in frames])
+            confidences = np.concatenate([d.confidences for d in frames])
+            class_ids = np.concatenate([d.class_ids for d in frames])
+        else:
+            boxes, confidences, class_ids = Detections.empty()
+
+        # Half precision is well under a pixel at the 640px model resolution
+        return cls(offsets, boxes.astype(np.float16),
+                   confidences.astype(np.float16), class_ids.astype(np.uint8))
+
+    @classmethod
+    def load(cls, path: str) -> 'DetectionTrack':
+        with np.load(path) as data:
+            return cls(data['offsets'], data['boxes'], data['confidences'], data['class_ids'])
+
+    def save(self, path: str) -> None:
+        temp_path = f'{path}.{threading.get_ident()}.tmp'
+        with open(temp_path, 'wb') as f:
+            np.savez_compressed(f, offsets=self.offsets, boxes=self.boxes,
+                                confidences=self.confidences, class_ids=self.class_ids)
+        os.replace(temp_path, path)
+
+
+class DetectionTrackStore:
+    def __init__(self, profile_ids: dict, track_dir: str, storage=None):
+        """
+        :param profile_ids: {profile name: identity of the model and input size it runs at}
+        """
+        self.logger = logging.getLogger(__name__)
+        self.profile_ids = {name: hashlib.sha256(profile_id.encode()).hexdigest()[:12]
+                            for name, profile_id in profile_ids.items()}
+        self.track_dir = track_dir
+        self.storage = storage
+        self.tracks = {}
+        self.lock = threading.Lock()
+
+        os.makedirs(self.track_dir, exist_ok=True)
+        if self.storage:
+            self.storage.adopt(self.track_dir, 'tracks')
+
+    def __path(self, video_path: str, profile: str) -> str:
+        stat = os.stat(video_path)
+        name = os.path.basename(video_path)
+        return os.path.join(self.track_dir,
+                            f'{name}.{stat.st_size}.{self.profile_ids[profile]}.{profile}.npz')
+
+    def get(self, video_path: str, profile: str = 'quality'):
+        """
+        :return: the DetectionTrack recorded for the video with that profile or None if not precomputed
+        """
+        path = self.__path(video_path, profile)
+
+        with self.lock:
+            if path in self.tracks:
+                return self.tracks[path]
+
+        if not os.path.exists(path):
+            return None
+
+        try:
+            track = DetectionTrack.load(path)
+        except Exception as e:
+            self.logger.error(f"Failed to load detection track {path}: {e}")
+            return None
+
+        if self.storage:
+            self.storage.touch(path)
+
+        with self.lock:
+            self.tracks[path] = track
+        return track
+
+    def put(self, video_path: str, track: DetectionTrack, profile: str = 'quality') -> None:
+        path = self.__path(video_path, profile)
+
+        try:
+            track.save(path)
+        except Exception as e:
+            self.logger.error(f"Failed to save detection track {path}: {e}")
+            return
+
+        if self.storage:
+            self.storage.track(path, 'tracks')
+
+        with self.lock:
+            self.tracks[path] = track
+        self.logger.info(
+            f"Saved detection track for {video_path} ({track.frame_count} frames).")
@@ -0,0 +1,47 @@
+from typing import NamedTuple
+
+import numpy as np
+
+
+class Detections(NamedTuple):
+    boxes: np.ndarray
+    confidences: np.ndarray
+    class_ids: np.ndarray
+
+    @classmethod
+    def empty(cls) -> 'Detections':
+        return cls(np.zeros((0, 4), dtype=np.float32),
+                   np.zeros((0,), dtype=np.float32),
+                   np.zeros((0,), dtype=np.int32))
+
+    def scaled(self, width: int, height: int, size: int = 640) -> 'Detections':
+        """
+        Map boxes from the size x size model input back to a width x height image.
+        :return: Detections
+        """
+        factors = np.array([width / size, height / size, width / size, height / size],
+                           dtype=np.float32)
+        return self._replace(boxes=self.boxes * factors)
+
+    def unletterboxed(self, letterbox, size: int = 640) -> 'Detections':
+        """
+        Map boxes from a letterboxed model input to the size x size frame the
+        source image is stretched to, the space scaled() maps from.
+        :return: Detections
+        """
+        pads = np.array([letterbox.pad_x, letterbox.pad_y] * 2, dtype=np.float32)
+        factors = np.array([size / letterbox.width, size / letterbox.height] * 2, dtype=np.float32)
+        boxes = (self.boxes - pads) / letterbox.scale * factors
+        return self._replace(boxes=boxes.clip(0, size).astype(np.float32))
+
+    @classmethod
+    def from_result(cls, result) -> 'Detections':
+        """
+        Convert an ultralytics Results object into plain numpy arrays
+        so results can be passed between threads without holding tensors.
+        :return: Detections
+        """
+        boxes = result.boxes.cpu().numpy()
+        return cls(boxes.xyxy.astype(np.float32),
+                   boxes.conf.astype(np.float32),
+                   boxes.cls.astype(np.int32))
@@ -4,111 +4,215 @@ import io
 import time
 from flask import current_app
 import numpy as np
-from PIL import Image
-from io import BytesIO
 from dotenv import load_dotenv
-from ultralytics.utils.plotting import Annotator
 import logging
-import threading
+from .video_pipeline import VideoPipeline
+from .frame_encoders import create_encoder
+from .image_io import buffer_pool, decode_image, image_size, letterbox
+from .detection_tracks import DetectionTrack
+from .detection_formats import detections_to_ndjson, pack_detections
+from .metrics import STAGE_SECONDS, ERRORS
 
 logger = logging.getLogger(__name__)
 
 load_dotenv()
 
+# OpenCV draws on BGR images
+BOX_COLOR = (21, 21, 232)
+TEXT_COLOR = (255, 255, 255)
 
-def img_detector(img, stream: bool = False, as_bytes: bool = True):
 
-    if as_bytes:
-        image = Image.open(BytesIO(img))
+def cache_options(profile: str) -> dict:
+    """
+    :return: what identifies a profile's results in the result cache, beyond the image
+    """
+    return {'profile': profile,
+            'size': current_app.config['INFERENCE_PROFILES'][profile]['size'],
+            'model': current_app.config['PROFILE_MODEL_IDS'][profile]}
+
+
+def img_detector(img, as_bytes: bool = True, use_cache: bool = True, profile: str = 'quality',
+                 priority: str = 'image', deadline: float = None):
+
+    # Identical uploads and the example images are served from the result cache
+    resultCache = current_app.config['RESULT_CACHE']
+    cache_key = resultCache.key(img, **cache_options(profile)) if as_bytes and use_cache else None
+    cached = resultCache.get(cache_key) if cache_key else None
+
+    if cached is not None and cached[1] is not None:
+        return io.BytesIO(cached[1])
+
+    with STAGE_SECONDS.time(path='image', stage='decode'):
+        if as_bytes:
+            image, width, height = decode_image(img)
+        else:
+            # PIL images are RGB, everything downstream works in BGR like cv2
+            image = cv2.cvtColor(np.asarray(img.convert('RGB')), cv2.COLOR_RGB2BGR)
+            height, width = image.shape[:2]
+
+    if cached is not None:
+        # Detections were cached by a JSON request, only the drawing is missing
+        detections = cached[0]
     else:
-        image = img
+        detections = __infer(image, 'image', profile, priority, deadline)
 
-    width = image.width
-    height = image.height
+    # Boxes are drawn on the decoded image at its own resolution
+    with STAGE_SECONDS.time(path='image', stage='annotate'):
+        image = annotate_img(image, detections.scaled(width, height),
+                             current_app.config['CLASS_NAMES'])
 
-    image = np.array(image)
+    with STAGE_SECONDS.time(path='image', stage='encode'):
+        _, img_encoded = cv2.imencode('.jpg', image)
+        img_bytes = img_encoded.tobytes()
 
-    image = __process_img(image, stream=stream)
-    image = cv2.resize(image, (width, height))
-    image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-    _, img_encoded = cv2.imencode('.jpg', image)
+    if cache_key:
+        resultCache.put(cache_key, detections, img_bytes)
 
-    return io.BytesIO(img_encoded.tobytes())
+    return io.BytesIO(img_bytes)
 
 
-def add_video_detections(videoPath, file_id):
-    try:
-        cap = cv2.VideoCapture(videoPath)
+def img_detections(img: bytes, use_cache: bool = True, profile: str = 'quality',
+                   priority: str = 'image', deadline: float = None):
+    """
+    Run detection without drawing or encoding anything.
+    :param deadline: time.perf_counter() value the result is needed by, see LoadShedder
+    :return: (detections scaled to the source image, width, height)
+    """
+    resultCache = current_app.config['RESULT_CACHE']
+    cache_key = resultCache.key(img, **cache_options(profile)) if use_cache else None
+    cached = resultCache.get(cache_key) if cache_key else None
 
-        if not cap.isOpened():
-            raise IOError(f"Cannot open video file: {videoPath}")
+    if cached is not None:
+        detections = cached[0]
+        width, height, _ = image_size(img)
+    else:
+        # Nothing is drawn, so large JPEGs only need decoding near the model resolution
+        input_size = current_app.config['INFERENCE_PROFILES'][profile]['size']
+        with STAGE_SECONDS.time(path='json', stage='decode'):
+            image, width, height = decode_image(img, min_side=input_size)
 
-        width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-        height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        detections = __infer(image, 'json', profile, priority, deadline)
 
-        total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-        if total_frames == 0:
-            raise ValueError(f"Video file {videoPath} has no frames.")
+        if cache_key:
+            resultCache.put(cache_key, detections, None)
 
-        frame_count = 0
-        boundary = 'frame'
+    return detections.scaled(width, height), width, height
 
-        while True:
-            success, frame = cap.read()
 
-            if success:
-                frame_count += 1
+def __infer(image, path: str, profile: str, priority: str, deadline: float):
+    """
+    Letterbox into a pooled buffer of the profile's input size and run it
+    through the inference backend.
+    :raises InferenceOverloadedError, DeadlineExceededError: if the backend sheds the frame
+    :return: Detections in the MODEL_SIZE frame the image is stretched to
+    """
+    inferenceBackend = current_app.config['INFERENCE_BACKEND']
+    input_size = current_app.config['INFERENCE_PROFILES'][profile]['size']
 
-                progress = int(
-                    (frame_count / total_frames) * 100)
+    with buffer_pool.borrow((input_size, input_size, 3)) as test_image:
+        with STAGE_SECONDS.time(path=path, stage='resize'):
+            box = letterbox(image, test_image)
 
-                processed_frame = __process_img(frame, stream=True)
-                processed_frame = cv2.resize(
-                    processed_frame, (width, height))
+        start = time.perf_counter()
+        with STAGE_SECONDS.time(path=path, stage='inference'):
+            detections = inferenceBackend.infer(test_image, profile, priority=priority, deadline=deadline)
+        current_app.config['PROFILE_SELECTOR'].observe(profile, time.perf_counter() - start)
 
-                # convert processed frame to JPEG
-                _, buffer = cv2.imencode('.jpg', processed_frame)
-                frame_bytes = buffer.tobytes()
+    return detections.unletterboxed(box)
 
-                data = b'--%s\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n%s\r\n' % (
-                    boundary.encode(), len(frame_bytes), frame_bytes)
-                yield data, progress
+
+def add_video_detections(videoPath, file_id, start_frame: int = 0, cache_track: bool = False,
+                         output: str = 'image', encoding: dict = None, backlog=None,
+                         profile: str = 'quality'):
+    inferenceBackend = current_app.config['INFERENCE_BACKEND']
+    ffmpeg = current_app.config['FFMPEG_PATH']
+    encoding = {**current_app.config['VIDEO_ENCODING'], **(encoding or {})}
+    class_names = current_app.config['CLASS_NAMES']
+    trackStore = current_app.config['DETECTION_TRACKS']
+
+    # Example videos replay precomputed detections, or record them on the first run
+    track = trackStore.get(videoPath, profile) if cache_track else None
+    record = cache_track and track is None and start_frame == 0
+
+    try:
+        pipeline = VideoPipeline(
+            videoPath, inferenceBackend,
+            annotate=(lambda img, detections: annotate_img(
+                img, detections, class_names)) if output in ('image', 'mp4') else None,
+            depth=current_app.config['VIDEO_PIPELINE_DEPTH'],
+            profile=profile, input_size=current_app.config['INFERENCE_PROFILES'][profile]['size'],
+            track=track, start_frame=start_frame, record=record,
+            # Recorded tracks are replayed later, so they keep every frame's own detections
+            temporal=None if record else current_app.config['TEMPORAL_SETTINGS'],
+            encoder=lambda width, height, fps: create_encoder(
+                output, width, height, fps, encoding, ffmpeg=ffmpeg, backlog=backlog))
+
+        frame_count = pipeline.start_frame
+        progress = 0
+        boundary = 'frame'
+
+        for frame_output in pipeline:
+            frame_count += 1
+
+            progress = int(
+                (frame_count / pipeline.total_frames) * 100)
+
+            if output == 'json':
+                data = detections_to_ndjson(frame_output, class_names, pipeline.width,
+                                            pipeline.height, frame=frame_count - 1)
+            elif output == 'binary':
+                data = pack_detections(frame_output, frame=frame_count - 1)
+            elif output == 'mp4':
+                # Fragments do not line up with frames, ffmpeg emits them as they fill
+                data = frame_output
             else:
-                break
+                data = b'--%s\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n%s\r\n' % (
+                    boundary.encode(), len(frame_output), frame_output)
+            yield data, progress
 
         # Ensure the progress reaches 100% after the loop
-        if frame_count >= total_frames:
+        if frame_count >= pipeline.total_frames:
             progress = 100
 
-        data = b'--%s--\r\n' % boundary.encode()
-
-        yield data, progress
+        if pipeline.tail:
+            yield pipeline.tail, progress
 
-    except Exception as e:
-        logger.error(f"An error occurred during video processing: {e}")
-    finally:
-        cap.release()
-        cv2.destroyAllWindows()
+        if record and pipeline.detections:
+            trackStore.put(videoPath, DetectionTrack.from_frames(
+                pipeline.detections), profile)
 
+        timings = ', '.join(
+            f'{stage} {ms:.1f}' for stage, ms in pipeline.stats().items())
+        logger.info(
+            f"Processed {pipeline.frames} frames of {file_id} ({pipeline.inferred_frames} inferred), "
+            f"per-frame stage timings: {timings}")
 
-def __process_img(img, stream: bool = False):
+        # None marks the end of the stream for the job
+        yield None, progress
 
-    test_image = cv2.resize(img, (640, 640))
+    except Exception as e:
+        ERRORS.inc(where='video_processing')
+        logger.error(f"An error occurred during video processing: {e}")
 
-    model = current_app.config['YOLO_MODEL']
-    results = model([test_image], stream=stream)
 
-    for r in results:
-        annotator = Annotator(test_image)
-        boxes = r.boxes
+def annotate_img(img, detections, class_names):
+    # Same look as ultralytics' Annotator.box_label, drawn with cv2 so the
+    # request path never imports ultralytics
+    line_width = max(round(sum(img.shape) / 2 * 0.003), 2)
+    font_scale = line_width / 3
+    font_thickness = max(line_width - 1, 1)
 
-        for box in boxes:
-            box_coords = box.xyxy[0]
-            conf = float(box.conf[0])
-            cls = int(box.cls[0])
+    for box_coords, conf, cls in zip(*detections):
+        label = f'{class_names[cls]} {conf:.2f}'
+        p1 = (int(box_coords[0]), int(box_coords[1]))
+        p2 = (int(box_coords[2]), int(box_coords[3]))
+        cv2.rectangle(img, p1, p2, BOX_COLOR, thickness=line_width, lineType=cv2.LINE_AA)
 
-            class_names = current_app.config['CLASS_NAMES']
-            label = f'{class_names[cls]} {conf:.2f}'
-            annotator.box_label(box_coords, label, color=(232, 21, 21))
+        w, h = cv2.getTextSize(label, 0, fontScale=font_scale, thickness=font_thickness)[0]
+        outside = p1[1] - h >= 3
+        label_p2 = (p1[0] + w, p1[1] - h - 3 if outside else p1[1] + h + 3)
+        cv2.rectangle(img, p1, label_p2, BOX_COLOR, -1, cv2.LINE_AA)
+        cv2.putText(img, label, (p1[0], p1[1] - 2 if outside else p1[1] + h + 2), 0,
+                    font_scale, TEXT_COLOR, thickness=font_thickness, lineType=cv2.LINE_AA)
 
-    return annotator.result()
+    return img
@@ -0,0 +1,164 @@
+import queue
+import asyncio
+import threading
+from collections import deque
+from .metrics import DROPPED_FRAMES
+
+POLICIES = ('block', 'drop_oldest', 'latest')
+
+
+class FrameBuffer:
+    """
+    Bounded replacement for the queue.Queue between a video job and its
+    stream. Limits are counted both in frames and in bytes, and the policy
+    decides what happens when a slow consumer lets it fill up:
+
+    - block: the producer waits for space (backpressure)
+    - drop_oldest: the oldest buffered frames are discarded
+    - latest: only the most recent frame is kept
+    """
+
+    def __init__(self, policy: str = 'block', max_frames: int = 64, max_bytes: int = 32 * 1024 * 1024):
+        if policy not in POLICIES:
+            raise ValueError(
+                f"Unknown frame buffer policy '{policy}', expected one of {POLICIES}.")
+
+        self.policy = policy
+        self.max_frames = max_frames
+        self.max_bytes = max_bytes
+        self.frames = deque()
+        self.bytes_buffered = 0
+        self.dropped = 0
+        self.closed = False
+        self.condition = threading.Condition()
+        self.async_waiters = []
+
+    def __full(self, size: int) -> bool:
+        # A single oversized frame is still let through into an empty buffer
+        if not self.frames:
+            return False
+        return len(self.frames) >= self.max_frames or self.bytes_buffered + size > self.max_bytes
+
+    @staticmethod
+    def __resolve(waiter: asyncio.Future) -> None:
+        if not waiter.done():
+            waiter.set_result(None)
+
+    def __notify(self) -> None:
+        # Wake thread consumers and any coroutines waiting in get_async
+        self.condition.notify_all()
+        for loop, waiter in self.async_waiters:
+            loop.call_soon_threadsafe(self.__resolve, waiter)
+        self.async_waiters.clear()
+
+    def __drop_oldest(self) -> None:
+        data = self.frames.popleft()
+        self.bytes_buffered -= len(data)
+        self.dropped += 1
+        DROPPED_FRAMES.inc(policy=self.policy)
+
+    def put(self, data, timeout: float = None) -> bool:
+        """
+        Add a frame, or the "DONE" marker which is never dropped or blocked.
+        :return: False if the block policy timed out waiting for space
+        """
+        with self.condition:
+            if data == 'DONE':
+                self.frames.append(data)
+                self.__notify()
+                return True
+
+            size = len(data)
+
+            if self.policy == 'block':
+                if not self.condition.wait_for(lambda: self.closed or not self.__full(size), timeout):
+                    return False
+            elif self.policy == 'drop_oldest':
+                while self.__full(size):
+                    self.__drop_oldest()
+            else:
+                while self.frames:
+                    self.__drop_oldest()
+
+            if self.closed:
+                return True
+
+            self.frames.append(data)
+            self.bytes_buffered += size
+            self.__notify()
+            return True
+
+    def __pop(self):
+        data = self.frames.popleft()
+        if data != 'DONE':
+            self.bytes_buffered -= len(data)
+        self.condition.notify_all()
+        return data
+
+    def get(self, timeout: float = None):
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.frames, timeout):
+                raise queue.Empty
+            return self.__pop()
+
+    async def get_async(self, timeout: float = None):
+        """
+        Coroutine version of get() that waits on the event loop instead of
+        blocking a thread.
+        """
+        loop = asyncio.get_running_loop()
+
+        while True:
+            with self.condition:
+                if self.frames:
+                    return self.__pop()
+                waiter = loop.create_future()
+                self.async_waiters.append((loop, waiter))
+
+            try:
+                await asyncio.wait_for(waiter, timeout)
+            except asyncio.TimeoutError:
+                with self.condition:
+                    if (loop, waiter) in self.async_waiters:
+                        self.async_waiters.remove((loop, waiter))
+                raise queue.Empty
+
+    def qsize(self) -> int:
+        with self.condition:
+            return len(self.frames)
+
+    def clear(self) -> None:
+        """
+        Release every buffered frame of a job nobody is going to stream.
+        :return: None
+        """
+        with self.condition:
+            self.frames.clear()
+            self.bytes_buffered = 0
+            self.__notify()
+
+    def fill(self) -> float:
+        """
+        :return: how full the buffer is, 0.0 to 1.0, by frames or bytes whichever is higher
+        """
+        with self.condition:
+            return min(max(len(self.frames) / self.max_frames,
+                           self.bytes_buffered / self.max_bytes), 1.0)
+
+    def close(self) -> None:
+        """
+        Release a producer blocked on a consumer that went away.
+        :return: None
+        """
+        with self.condition:
+            self.closed = True
+            self.__notify()
+
+    def stats(self) -> dict:
+        with self.condition:
+            return {
+                'policy': self.policy,
+                'buffered_frames': len(self.frames),
+                'buffered_bytes': self.bytes_buffered,
+                'dropped_frames': self.dropped,
+            }
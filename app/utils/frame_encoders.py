@@ -0,0 +1,169 @@
+import queue
+import logging
+import threading
+import subprocess
+
+import cv2
+import numpy as np
+from .detection_formats import OUTPUT_FORMATS
+
+# Video jobs can additionally stream annotated frames as fragmented MP4
+VIDEO_OUTPUT_FORMATS = OUTPUT_FORMATS + ('mp4',)
+
+# Steps of (quality reduction, scale) the adaptive mode walks through as the viewer falls behind
+ADAPTIVE_LADDER = ((0, 1.0), (15, 1.0), (30, 0.75), (40, 0.5))
+BACKLOG_HIGH = 0.5
+BACKLOG_LOW = 0.2
+ADAPT_EVERY = 10
+MIN_QUALITY = 10
+
+MP4_READ_SIZE = 64 * 1024
+
+
+def output_size(width: int, height: int, max_side: int = 0) -> tuple[int, int]:
+    """
+    Fit width x height within max_side on the longest side, 0 keeps the source size.
+    :return: (width, height)
+    """
+    if not max_side or max(width, height) <= max_side:
+        return width, height
+
+    scale = max_side / max(width, height)
+    return max(round(width * scale), 1), max(round(height * scale), 1)
+
+
+def resize_to(frame: np.ndarray, size: tuple[int, int]) -> np.ndarray:
+    if (frame.shape[1], frame.shape[0]) == size:
+        return frame
+
+    shrinking = size[0] < frame.shape[1]
+    return cv2.resize(frame, size, interpolation=cv2.INTER_AREA if shrinking else cv2.INTER_LINEAR)
+
+
+class JpegEncoder:
+    """
+    Encodes annotated frames for the MJPEG stream at a fixed JPEG quality,
+    capped to max_side. In adaptive mode `backlog` reports how full the
+    viewer's buffer is: every ADAPT_EVERY frames the encoder steps down
+    ADAPTIVE_LADDER while it is above BACKLOG_HIGH and back up once it
+    drains below BACKLOG_LOW.
+    """
+
+    def __init__(self, width: int, height: int, quality: int = 95, max_side: int = 0,
+                 adaptive: bool = False, backlog=None):
+        self.size = output_size(width, height, max_side)
+        self.quality = quality
+        self.adaptive = adaptive and backlog is not None
+        self.backlog = backlog
+        self.level = 0
+        self.frames = 0
+
+    def __adapt(self) -> None:
+        fill = self.backlog()
+
+        if fill > BACKLOG_HIGH and self.level < len(ADAPTIVE_LADDER) - 1:
+            self.level += 1
+        elif fill < BACKLOG_LOW and self.level > 0:
+            self.level -= 1
+
+    def encode(self, frame: np.ndarray) -> bytes:
+        if self.adaptive and self.frames % ADAPT_EVERY == 0:
+            self.__adapt()
+        self.frames += 1
+
+        reduction, scale = ADAPTIVE_LADDER[self.level]
+        size = (max(round(self.size[0] * scale), 1),
+                max(round(self.size[1] * scale), 1))
+
+        _, buffer = cv2.imencode('.jpg', resize_to(frame, size),
+                                 [cv2.IMWRITE_JPEG_QUALITY, max(self.quality - reduction, MIN_QUALITY)])
+        return buffer.tobytes()
+
+    def finish(self) -> bytes:
+        return b''
+
+    def close(self) -> None:
+        pass
+
+
+class Mp4Encoder:
+    """
+    Pipes raw BGR frames through an ffmpeg subprocess that encodes H.264
+    into fragmented MP4, so the stream plays while it is still being
+    produced. ffmpeg buffers a few frames, so encode() may return nothing
+    and the last fragments only come out of finish(). The resolution is
+    fixed for the whole stream, adaptive mode does not apply.
+    """
+
+    def __init__(self, ffmpeg: str, width: int, height: int, fps: float, quality: int = 95,
+                 max_side: int = 0, **_):
+        self.logger = logging.getLogger(__name__)
+        width, height = output_size(width, height, max_side)
+        # yuv420p needs even dimensions
+        self.size = (max(width - width % 2, 2), max(height - height % 2, 2))
+        crf = round(51 - 0.33 * quality)
+
+        self.process = subprocess.Popen(
+            [ffmpeg, '-loglevel', 'error',
+             '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', f'{self.size[0]}x{self.size[1]}',
+             '-r', f'{fps or 25:g}', '-i', 'pipe:0',
+             '-c:v', 'libx264', '-preset', 'veryfast', '-tune', 'zerolatency',
+             '-crf', str(crf), '-pix_fmt', 'yuv420p',
+             '-movflags', 'frag_keyframe+empty_moov+default_base_moof',
+             '-f', 'mp4', 'pipe:1'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+        self.chunks = queue.Queue()
+        threading.Thread(target=self.__read, daemon=True).start()
+
+    def __read(self) -> None:
+        # Reading on a separate thread keeps ffmpeg from blocking on a full stdout pipe
+        for chunk in iter(lambda: self.process.stdout.read1(MP4_READ_SIZE), b''):
+            self.chunks.put(chunk)
+        self.chunks.put(None)
+
+    def __drain(self) -> bytes:
+        chunks = []
+        while True:
+            try:
+                chunk = self.chunks.get_nowait()
+            except queue.Empty:
+                break
+            if chunk is None:
+                # Leave the end marker for finish()
+                self.chunks.put(None)
+                break
+            chunks.append(chunk)
+        return b''.join(chunks)
+
+    def encode(self, frame: np.ndarray) -> bytes:
+        frame = np.ascontiguousarray(resize_to(frame, self.size))
+        self.process.stdin.write(frame.tobytes())
+        return self.__drain()
+
+    def finish(self) -> bytes:
+        self.process.stdin.close()
+
+        chunks = []
+        for chunk in iter(self.chunks.get, None):
+            chunks.append(chunk)
+
+        if self.process.wait() != 0:
+            self.logger.error(
+                f"ffmpeg exited with status {self.process.returncode}")
+        return b''.join(chunks)
+
+    def close(self) -> None:
+        if self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+
+
+def create_encoder(output: str, width: int, height: int, fps: float, settings: dict,
+                   ffmpeg: str = None, backlog=None):
+    if output == 'mp4':
+        if not ffmpeg:
+            raise ValueError("mp4 output needs ffmpeg, which is not available.")
+        return Mp4Encoder(ffmpeg, width, height, fps, **settings)
+
+    return JpegEncoder(width, height, backlog=backlog, **settings)
@@ -0,0 +1,129 @@
+import threading
+from io import BytesIO
+from typing import NamedTuple
+from contextlib import contextmanager
+
+import cv2
+import numpy as np
+from PIL import Image
+
+# Detections are kept in a MODEL_SIZE x MODEL_SIZE frame the source image is
+# stretched to, whatever the input size of the profile that produced them
+MODEL_SIZE = 640
+LETTERBOX_FILL = 114
+
+# JPEGs can be decoded at 1/8, 1/4 or 1/2 scale without touching the full-size pixels
+REDUCED_FLAGS = ((8, cv2.IMREAD_REDUCED_COLOR_8),
+                 (4, cv2.IMREAD_REDUCED_COLOR_4),
+                 (2, cv2.IMREAD_REDUCED_COLOR_2))
+
+
+class BufferPool:
+    """
+    Reusable scratch arrays keyed by shape and dtype, so concurrent requests
+    recycle their model-input buffers instead of allocating new ones.
+    """
+
+    def __init__(self, max_per_shape: int = 8):
+        self.max_per_shape = max_per_shape
+        self.free = {}
+        self.lock = threading.Lock()
+        self.allocated = 0
+        self.reused = 0
+
+    @contextmanager
+    def borrow(self, shape: tuple, dtype=np.uint8):
+        key = (tuple(shape), np.dtype(dtype).str)
+
+        with self.lock:
+            buffers = self.free.setdefault(key, [])
+            buffer = buffers.pop() if buffers else None
+            if buffer is None:
+                self.allocated += 1
+            else:
+                self.reused += 1
+
+        if buffer is None:
+            buffer = np.empty(shape, dtype=dtype)
+
+        try:
+            yield buffer
+        finally:
+            with self.lock:
+                if len(self.free[key]) < self.max_per_shape:
+                    self.free[key].append(buffer)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'allocated': self.allocated,
+                'reused': self.reused,
+                'free': sum(len(buffers) for buffers in self.free.values()),
+            }
+
+
+# Shared by the request threads of this process
+buffer_pool = BufferPool()
+
+
+def image_size(data: bytes) -> tuple[int, int, str]:
+    """
+    Read the dimensions from the image header without decoding any pixels.
+    :return: (width, height, format)
+    """
+    with Image.open(BytesIO(data)) as image:
+        return image.width, image.height, image.format
+
+
+def decode_image(data: bytes, min_side: int = None) -> tuple[np.ndarray, int, int]:
+    """
+    Decode straight into a BGR array, the layout cv2 and the video path use.
+    With `min_side`, a JPEG large enough is decoded at a reduced scale that
+    keeps both sides at or above `min_side`. EXIF orientation is ignored so
+    the pixels line up with the header dimensions.
+    :return: (image, source width, source height)
+    """
+    width, height, image_format = image_size(data)
+
+    flags = cv2.IMREAD_COLOR
+    if min_side and image_format == 'JPEG':
+        for factor, reduced in REDUCED_FLAGS:
+            if min(width, height) // factor >= min_side:
+                flags = reduced
+                break
+
+    image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8),
+                         flags | cv2.IMREAD_IGNORE_ORIENTATION)
+
+    if image is None:
+        raise ValueError("Cannot decode image.")
+
+    return image, width, height
+
+
+class Letterbox(NamedTuple):
+    scale: float
+    pad_x: int
+    pad_y: int
+    width: int
+    height: int
+
+
+def letterbox(image: np.ndarray, out: np.ndarray) -> Letterbox:
+    """
+    Fit the image into the square buffer `out` keeping its aspect ratio,
+    centred on grey padding like ultralytics does.
+    :return: Letterbox geometry to map detections back with
+    """
+    size = out.shape[0]
+    height, width = image.shape[:2]
+    scale = min(size / width, size / height)
+    new_w, new_h = max(round(width * scale), 1), max(round(height * scale), 1)
+    pad_x, pad_y = (size - new_w) // 2, (size - new_h) // 2
+
+    out.fill(LETTERBOX_FILL)
+    interpolation = cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR
+    out[pad_y:pad_y + new_h, pad_x:pad_x + new_w] = cv2.resize(
+        image, (new_w, new_h), interpolation=interpolation)
+
+    return Letterbox(scale, pad_x, pad_y, width, height)
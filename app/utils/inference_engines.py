@@ -0,0 +1,314 @@
+import os
+import logging
+from abc import ABC, abstractmethod
+
+import cv2
+import numpy as np
+from app.utils.detections import Detections
+
+ENGINES = ('ultralytics', 'onnxruntime')
+
+
+def _read_varint(f) -> int:
+    value = shift = 0
+    while True:
+        byte = f.read(1)
+        if not byte:
+            raise EOFError("Truncated protobuf message")
+        value |= (byte[0] & 0x7F) << shift
+        if not byte[0] & 0x80:
+            return value
+        shift += 7
+
+
+def _fields(f, end: int):
+    """
+    Walk the fields of a protobuf message that ends at offset `end`, seeking
+    over the ones the caller does not descend into.
+    :return: iterator of (field number, value), value is the end offset of a length-delimited field
+    """
+    while f.tell() < end:
+        key = _read_varint(f)
+        number, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            yield number, _read_varint(f)
+        elif wire_type == 2:
+            length = _read_varint(f)
+            field_end = f.tell() + length
+            yield number, field_end
+            f.seek(field_end)
+        elif wire_type in (1, 5):
+            f.seek(8 if wire_type == 1 else 4, os.SEEK_CUR)
+        else:
+            raise ValueError(f"Unsupported protobuf wire type {wire_type}")
+
+
+def _message(f, end: int, number: int) -> int:
+    """
+    :return: end offset of the first field `number`, with the file positioned at its content
+    """
+    for field, value in _fields(f, end):
+        if field == number:
+            return value
+    raise ValueError(f"Missing protobuf field {number}")
+
+
+def static_input_size(model_path: str):
+    """
+    Read the input shape of an ONNX export without importing onnx or creating
+    a session for it. Only the path down to the first graph input is parsed,
+    the weights are skipped over.
+    :return: the side of a static square input, None for a dynamic shape, another model format or an unreadable file
+    """
+    if not model_path.endswith('.onnx') or not os.path.exists(model_path):
+        return None
+
+    try:
+        with open(model_path, 'rb') as f:
+            end = os.fstat(f.fileno()).st_size
+            # ModelProto.graph -> GraphProto.input[0] -> ValueInfoProto.type
+            # -> TypeProto.tensor_type -> Tensor.shape
+            for number in (7, 11, 2, 1, 2):
+                end = _message(f, end, number)
+
+            dims = []
+            for field, dim_end in _fields(f, end):
+                if field == 1:
+                    # Dimension.dim_value, absent for a named (dynamic) dimension
+                    dims.append(next((value for number, value in _fields(f, dim_end) if number == 1), None))
+    except (OSError, ValueError, EOFError) as e:
+        logging.getLogger(__name__).warning(
+            f"Could not read the input shape of {model_path}, using the configured size: {e}")
+        return None
+
+    if len(dims) != 4:
+        return None
+    height, width = dims[2:4]
+    # A negative dim_value comes out of the varint as a huge number, and is no more static than a missing one
+    if not height or height != width or height >= 1 << 63:
+        return None
+    return height
+
+
+class InferenceEngine(ABC):
+    name = None
+
+    def __init__(self):
+        self.logger = logging.getLogger(__name__)
+        self.batching_supported = True
+
+    @abstractmethod
+    def predict(self, images: list[np.ndarray]) -> list[Detections]:
+        """
+        Run detection on a batch of BGR images.
+        :return: one Detections per image, in image pixel coordinates
+        """
+        raise NotImplementedError()
+
+
+class UltralyticsEngine(InferenceEngine):
+    name = 'ultralytics'
+
+    def __init__(self, model_path: str, conf_threshold: float, iou_threshold: float):
+        super().__init__()
+        from ultralytics import YOLO
+
+        self.model = YOLO(model_path, task="detect")
+        self.conf_threshold = conf_threshold
+        self.iou_threshold = iou_threshold
+        # None for a dynamic input shape, which runs at each profile's own size
+        self.input_size = static_input_size(model_path)
+
+    def __call_model(self, images):
+        # Images arrive letterboxed to their profile's square input size
+        results = self.model(images, imgsz=self.input_size or images[0].shape[0],
+                             conf=self.conf_threshold, iou=self.iou_threshold, verbose=False)
+        return [Detections.from_result(r) for r in results]
+
+    def predict(self, images: list[np.ndarray]) -> list[Detections]:
+        if len(images) > 1 and self.batching_supported:
+            try:
+                return self.__call_model(images)
+            except Exception as e:
+                # Models exported with a static batch dimension reject batched input
+                self.batching_supported = False
+                self.logger.warning(
+                    f'Batched inference not supported by model, running frames one by one: {e}')
+
+        detections = []
+        for image in images:
+            detections.extend(self.__call_model([image]))
+        return detections
+
+
+class OnnxRuntimeEngine(InferenceEngine):
+    """
+    Runs the exported YOLO graph directly on an onnxruntime session, with
+    letterbox preprocessing and NMS done in numpy instead of ultralytics.
+    """
+    name = 'onnxruntime'
+
+    GRAPH_OPTIMIZATIONS = {
+        'disabled': 'ORT_DISABLE_ALL',
+        'basic': 'ORT_ENABLE_BASIC',
+        'extended': 'ORT_ENABLE_EXTENDED',
+        'all': 'ORT_ENABLE_ALL',
+    }
+
+    def __init__(self, model_path: str, conf_threshold: float, iou_threshold: float,
+                 intra_op_threads: int = 0, inter_op_threads: int = 0, graph_optimization: str = 'all',
+                 execution_mode: str = 'sequential', providers: list[str] = None,
+                 enable_mem_arena: bool = True, max_detections: int = 300):
+        super().__init__()
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = intra_op_threads
+        options.inter_op_num_threads = inter_op_threads
+        options.graph_optimization_level = getattr(
+            ort.GraphOptimizationLevel, self.GRAPH_OPTIMIZATIONS[graph_optimization])
+        options.execution_mode = ort.ExecutionMode.ORT_PARALLEL if execution_mode == 'parallel' \
+            else ort.ExecutionMode.ORT_SEQUENTIAL
+        options.enable_cpu_mem_arena = enable_mem_arena
+
+        self.session = ort.InferenceSession(
+            model_path, sess_options=options,
+            providers=providers or ['CPUExecutionProvider'])
+        self.conf_threshold = conf_threshold
+        self.iou_threshold = iou_threshold
+        self.max_detections = max_detections
+
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        batch, _, height, width = model_input.shape
+        # None for a dynamic input shape, which runs at each profile's own size
+        self.input_size = (height, width) if isinstance(height, int) and isinstance(width, int) else None
+        self.batching_supported = not isinstance(batch, int) or batch > 1
+        self.fixed_batch = batch if isinstance(batch, int) else None
+
+    def letterbox(self, images: list[np.ndarray]):
+        """
+        Resize each image into the model input keeping its aspect ratio and
+        padding the rest with grey, like ultralytics does.
+        :return: (NCHW float32 RGB batch, per-image scale, per-image (pad_x, pad_y))
+        """
+        input_h, input_w = self.input_size or images[0].shape[:2]
+        batch = np.full((len(images), input_h, input_w, 3), 114, dtype=np.uint8)
+        scales = np.empty(len(images), dtype=np.float32)
+        pads = np.empty((len(images), 2), dtype=np.float32)
+
+        for i, image in enumerate(images):
+            h, w = image.shape[:2]
+            scale = min(input_h / h, input_w / w)
+            new_w, new_h = round(w * scale), round(h * scale)
+            pad_x, pad_y = (input_w - new_w) // 2, (input_h - new_h) // 2
+
+            if (new_w, new_h) != (w, h):
+                image = cv2.resize(image, (new_w, new_h),
+                                   interpolation=cv2.INTER_LINEAR)
+            batch[i, pad_y:pad_y + new_h, pad_x:pad_x + new_w] = image
+            scales[i] = scale
+            pads[i] = (pad_x, pad_y)
+
+        # BGR HWC uint8 -> RGB CHW float in one vectorized pass
+        tensor = np.ascontiguousarray(
+            batch[..., ::-1].transpose(0, 3, 1, 2), dtype=np.float32)
+        tensor /= 255.0
+        return tensor, scales, pads
+
+    def __nms(self, boxes: np.ndarray, scores: np.ndarray) -> np.ndarray:
+        x1, y1, x2, y2 = boxes.T
+        areas = (x2 - x1) * (y2 - y1)
+        order = scores.argsort()[::-1]
+        keep = []
+
+        while order.size and len(keep) < self.max_detections:
+            i = order[0]
+            keep.append(i)
+            rest = order[1:]
+
+            w = np.clip(np.minimum(x2[i], x2[rest]) -
+                        np.maximum(x1[i], x1[rest]), 0, None)
+            h = np.clip(np.minimum(y2[i], y2[rest]) -
+                        np.maximum(y1[i], y1[rest]), 0, None)
+            inter = w * h
+            iou = inter / (areas[i] + areas[rest] - inter + 1e-7)
+            order = rest[iou <= self.iou_threshold]
+
+        return np.array(keep, dtype=np.int64)
+
+    def postprocess(self, output: np.ndarray, scale: float, pad: np.ndarray, shape) -> Detections:
+        # YOLOv8 output is (4 + classes, anchors) with boxes as cx, cy, w, h
+        predictions = output.T
+        class_scores = predictions[:, 4:]
+        class_ids = class_scores.argmax(axis=1)
+        confidences = class_scores[np.arange(len(class_ids)), class_ids]
+
+        mask = confidences > self.conf_threshold
+        if not mask.any():
+            return Detections.empty()
+
+        predictions = predictions[mask]
+        class_ids = class_ids[mask]
+        confidences = confidences[mask]
+
+        cx, cy, w, h = predictions[:, :4].T
+        boxes = np.stack([cx - w / 2, cy - h / 2, cx + w / 2, cy + h / 2], axis=1)
+
+        # Offset boxes per class so NMS never suppresses across classes
+        offsets = class_ids[:, None].astype(np.float32) * 7680
+        keep = self.__nms(boxes + offsets, confidences)
+
+        boxes = (boxes[keep] - np.tile(pad, 2)) / scale
+        boxes[:, [0, 2]] = boxes[:, [0, 2]].clip(0, shape[1])
+        boxes[:, [1, 3]] = boxes[:, [1, 3]].clip(0, shape[0])
+
+        return Detections(boxes.astype(np.float32),
+                          confidences[keep].astype(np.float32),
+                          class_ids[keep].astype(np.int32))
+
+    def __run(self, images: list[np.ndarray]) -> list[Detections]:
+        tensor, scales, pads = self.letterbox(images)
+        output = self.session.run(None, {self.input_name: tensor})[0]
+        return [self.postprocess(output[i], scales[i], pads[i], image.shape)
+                for i, image in enumerate(images)]
+
+    def predict(self, images: list[np.ndarray]) -> list[Detections]:
+        step = self.fixed_batch or len(images)
+        if not self.batching_supported:
+            step = 1
+
+        detections = []
+        for start in range(0, len(images), step):
+            chunk = images[start:start + step]
+            if self.fixed_batch and len(chunk) < self.fixed_batch:
+                # Pad a static batch with copies and discard their results
+                padded = chunk + [chunk[-1]] * (self.fixed_batch - len(chunk))
+                detections.extend(self.__run(padded)[:len(chunk)])
+            else:
+                detections.extend(self.__run(chunk))
+        return detections
+
+
+def create_engine(settings: dict) -> InferenceEngine:
+    """
+    Build the engine named in settings['engine'] from plain settings so the
+    same call works in the Flask process and in spawned inference workers.
+    :return: InferenceEngine
+    """
+    engine = settings['engine']
+
+    if engine == 'ultralytics':
+        return UltralyticsEngine(settings['model_path'], settings['conf_threshold'],
+                                 settings['iou_threshold'])
+    if engine == 'onnxruntime':
+        return OnnxRuntimeEngine(settings['model_path'], settings['conf_threshold'],
+                                 settings['iou_threshold'],
+                                 intra_op_threads=settings['intra_op_threads'],
+                                 inter_op_threads=settings['inter_op_threads'],
+                                 graph_optimization=settings['graph_optimization'],
+                                 execution_mode=settings['execution_mode'],
+                                 providers=settings['providers'],
+                                 enable_mem_arena=settings['enable_mem_arena'])
+
+    raise ValueError(f"Unknown inference engine '{engine}', expected one of {ENGINES}.")
@@ -0,0 +1,112 @@
+import math
+import time
+import threading
+
+from .metrics import SHED_REQUESTS
+
+# Lower rank runs first: webcam frames, then single images, then video frames and bulk batches
+PRIORITIES = ('live', 'image', 'video')
+PRIORITY_RANKS = {name: rank for rank, name in enumerate(PRIORITIES)}
+
+# Weight of the newest batch time in the moving average
+BATCH_TIME_ALPHA = 0.2
+
+
+class InferenceOverloadedError(Exception):
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class DeadlineExceededError(Exception):
+    pass
+
+
+class InferenceUnavailableError(Exception):
+    # The backend failed to start or stopped, or did not answer in time
+    pass
+
+
+class LoadShedder:
+    """
+    Admission control in front of an inference backend. Counts the frames
+    queued at each priority and projects how long a new frame would wait
+    behind the ones that run before it, from a moving average of the batch
+    time. Work with a deadline is refused up front when that projection
+    already misses it, and dropped from the queue if it expires there.
+    """
+
+    def __init__(self, batch_capacity: int):
+        # Frames the backend runs per average batch time, over all its workers
+        self.batch_capacity = batch_capacity
+        self.queued = [0] * len(PRIORITIES)
+        self.batch_seconds = None
+        self.lock = threading.Lock()
+
+        self.shed = {'overloaded': 0, 'deadline': 0}
+
+    def observe_batch(self, seconds: float) -> None:
+        with self.lock:
+            self.batch_seconds = seconds if self.batch_seconds is None \
+                else self.batch_seconds + BATCH_TIME_ALPHA * (seconds - self.batch_seconds)
+
+    def __projected_wait(self, rank: int, in_flight: int) -> float:
+        if self.batch_seconds is None:
+            return 0.0
+
+        ahead = sum(self.queued[:rank + 1]) + in_flight
+        return math.floor(ahead / self.batch_capacity) * self.batch_seconds + self.batch_seconds
+
+    def admit(self, priority: str, deadline: float = None, in_flight: int = 0) -> int:
+        """
+        Count a frame as queued, unless it cannot finish before its deadline.
+        :param deadline: time.perf_counter() value the result is needed by, None to always admit
+        :param in_flight: frames already handed to the model, which run before anything queued
+        :return: priority rank to queue the frame at
+        """
+        rank = PRIORITY_RANKS[priority]
+
+        with self.lock:
+            if deadline is not None:
+                now = time.perf_counter()
+                if now >= deadline:
+                    self.__count_shed('deadline', priority)
+                    raise DeadlineExceededError('Deadline passed before inference.')
+
+                wait = self.__projected_wait(rank, in_flight)
+                if now + wait > deadline:
+                    self.__count_shed('overloaded', priority)
+                    raise InferenceOverloadedError(
+                        f'Projected inference wait of {wait * 1000:.0f}ms exceeds the deadline.',
+                        retry_after=max(1, math.ceil(wait)))
+
+            self.queued[rank] += 1
+        return rank
+
+    def taken(self, rank: int) -> None:
+        with self.lock:
+            self.queued[rank] -= 1
+
+    def expired(self, rank: int, deadline: float) -> bool:
+        """
+        Check a frame leaving the queue, counting it as shed if its deadline passed meanwhile.
+        :return: True if it should be dropped instead of run
+        """
+        if deadline is None or time.perf_counter() < deadline:
+            return False
+
+        with self.lock:
+            self.__count_shed('deadline', PRIORITIES[rank])
+        return True
+
+    def __count_shed(self, reason: str, priority: str) -> None:
+        self.shed[reason] += 1
+        SHED_REQUESTS.inc(reason=reason, priority=priority)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'queued': dict(zip(PRIORITIES, self.queued)),
+                'avg_batch_time_ms': self.batch_seconds * 1000 if self.batch_seconds is not None else None,
+                'shed': dict(self.shed),
+            }
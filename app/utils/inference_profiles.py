@@ -0,0 +1,110 @@
+import logging
+import threading
+
+from app.utils.inference_engines import InferenceEngine, create_engine, static_input_size
+
+PROFILE_NAMES = ('live', 'quality')
+AUTO_PROFILE = 'auto'
+
+# Weight of the newest latency sample in the moving average
+LATENCY_ALPHA = 0.2
+
+
+class ProfileSelector:
+    """
+    Tracks a moving average of each profile's inference latency and, for
+    requests with a latency budget, picks the largest input size expected
+    to answer within it. A profile without samples yet is assumed to fit,
+    so its first requests measure it.
+    """
+
+    def __init__(self, profiles: dict):
+        self.profiles = profiles
+        self.latency = {}
+        self.lock = threading.Lock()
+
+    def observe(self, profile: str, seconds: float) -> None:
+        with self.lock:
+            previous = self.latency.get(profile)
+            self.latency[profile] = seconds if previous is None \
+                else previous + LATENCY_ALPHA * (seconds - previous)
+
+    def choose(self, budget_ms: float) -> str:
+        by_size = sorted(self.profiles, key=lambda name: self.profiles[name]['size'], reverse=True)
+
+        with self.lock:
+            for name in by_size:
+                if self.latency.get(name, 0) * 1000 <= budget_ms:
+                    return name
+
+        # Nothing fits, the smallest input is the best effort
+        return by_size[-1]
+
+    def resolve(self, requested: str, default: str, budget_ms: float = None) -> str:
+        """
+        Validate a requested profile name, resolving 'auto' against the budget.
+        :return: profile name
+        """
+        profile = requested or default
+
+        if profile == AUTO_PROFILE:
+            if budget_ms is None:
+                raise ValueError("profile=auto needs latency_budget_ms")
+            return self.choose(budget_ms)
+
+        if profile not in self.profiles:
+            raise ValueError(
+                f"profile must be one of {', '.join((*self.profiles, AUTO_PROFILE))}")
+        return profile
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {name: {'size': settings['size'],
+                           'latency_ms': round(self.latency[name] * 1000, 2) if name in self.latency else None}
+                    for name, settings in self.profiles.items()}
+
+
+def fit_profiles(profiles: dict) -> dict:
+    """
+    Replace the size of each profile whose model was exported with a static
+    input shape by that shape, so its frames are letterboxed once, straight
+    to the size the model runs at.
+    :return: the profiles, with their sizes fitted
+    """
+    logger = logging.getLogger(__name__)
+    sizes = {}
+    fitted = {}
+
+    for name, profile in profiles.items():
+        model_path = profile['model_path']
+        if model_path not in sizes:
+            sizes[model_path] = static_input_size(model_path)
+
+        size = sizes[model_path]
+        if size is not None and size != profile['size']:
+            logger.warning(
+                f"Model {model_path} has a static {size}px input, running profile '{name}' "
+                f"at {size}px instead of {profile['size']}px.")
+            profile = {**profile, 'size': size}
+        fitted[name] = profile
+
+    return fitted
+
+
+def create_profile_engines(settings: dict, profiles: dict, engine: InferenceEngine = None) -> dict:
+    """
+    Load one engine per distinct model file among the profiles, so profiles
+    sharing a model share its session. `engine`, if given, is an already
+    loaded engine for settings['model_path'].
+    :return: {profile name: InferenceEngine}
+    """
+    loaded = {settings['model_path']: engine} if engine is not None else {}
+    engines = {}
+
+    for name, profile in profiles.items():
+        model_path = profile['model_path']
+        if model_path not in loaded:
+            loaded[model_path] = create_engine({**settings, 'model_path': model_path})
+        engines[name] = loaded[model_path]
+
+    return engines
@@ -0,0 +1,239 @@
+import queue
+import itertools
+import threading
+import time
+import logging
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+from flask import Flask, current_app
+from app.utils.background_thread import BackgroundThread
+from app.utils.detections import Detections
+from app.utils.inference_engines import create_engine
+from app.utils.inference_profiles import create_profile_engines
+from app.utils.inference_priority import LoadShedder, DeadlineExceededError, InferenceUnavailableError
+from app.utils.startup import warm_up
+from app.utils.metrics import INFERENCE_QUEUE_SECONDS, INFERENCE_BATCH_SIZE, STAGE_SECONDS, ERRORS
+
+
+class InferenceScheduler(BackgroundThread):
+    def __init__(self, thread_id: str, app: Flask):
+        super().__init__(thread_id, app)
+        self.logger = logging.getLogger(__name__)
+        self.app = app
+        # Ordered by priority rank, then arrival
+        self.pending = queue.PriorityQueue()
+        self.sequence = itertools.count()
+        self.lock = threading.Lock()
+        self.in_flight = 0
+
+        self.batches_run = 0
+        self.frames_run = 0
+        self.max_queue_depth = 0
+        self.batch_size_counts = {}
+        self.total_batch_time = 0.0
+
+        # Set once the engine is loaded and warmed up. `started` is also set
+        # when that failed, with the reason in startup_error.
+        self.ready = threading.Event()
+        self.started = threading.Event()
+        self.startup_error = None
+        self.startup_timings = {}
+        # Set when the scheduler stops taking frames, the reason new submits fail with
+        self.unavailable = None
+        self.engines = {}
+
+        with self.app.app_context():
+            self.engine = current_app.config['INFERENCE_ENGINE']
+            self.profiles = current_app.config['INFERENCE_PROFILES']
+            self.engine_settings = current_app.config['ENGINE_SETTINGS']
+            self.warmup_batch_size = current_app.config['WARMUP_BATCH_SIZE']
+            self.warmup_runs = current_app.config['WARMUP_RUNS']
+            self.max_batch_size = current_app.config['INFERENCE_MAX_BATCH_SIZE']
+            self.max_wait = current_app.config['INFERENCE_MAX_WAIT_MS'] / 1000
+            self.default_timeout = current_app.config['INFERENCE_TIMEOUT']
+
+        self.shedder = LoadShedder(batch_capacity=self.max_batch_size)
+
+    def startup(self) -> None:
+        self.logger.info(
+            f'Starting inference scheduler (max batch {self.max_batch_size}, '
+            f'max wait {self.max_wait * 1000:.1f}ms)...')
+
+        # Frames submitted meanwhile wait in the queue
+        try:
+            self.__load_engines()
+        except Exception as e:
+            self.startup_error = e
+            self.logger.error(f'Inference engine failed to start: {e}')
+            self.started.set()
+            # BackgroundThread.run skips the loop and calls shutdown(), which fails the queued frames
+            raise
+
+        self.ready.set()
+        self.started.set()
+
+        self.logger.info('Inference engine ready: ' + ', '.join(
+            f'{stage} {seconds * 1000:.0f}ms' for stage, seconds in self.startup_timings.items()))
+
+    def __load_engines(self) -> None:
+        if self.engine is None:
+            start = time.perf_counter()
+            self.engine = create_engine(self.engine_settings)
+            self.app.config['INFERENCE_ENGINE'] = self.engine
+            self.startup_timings['engine_load'] = time.perf_counter() - start
+
+        # Profiles with their own model file get their own engine
+        start = time.perf_counter()
+        self.engines = create_profile_engines(self.engine_settings, self.profiles, self.engine)
+        if len(set(map(id, self.engines.values()))) > 1:
+            self.startup_timings['profile_engines_load'] = time.perf_counter() - start
+
+        for name, profile in self.profiles.items():
+            self.startup_timings[f'warm_up_{name}'] = warm_up(
+                self.engines[name], self.warmup_batch_size, self.warmup_runs, profile['size'])
+
+    def shutdown(self) -> None:
+        self.logger.info('Stopping inference scheduler...')
+
+        # Taken under the lock submit() queues under, so nothing is queued after the drain
+        with self.lock:
+            if self.startup_error is not None:
+                self.unavailable = InferenceUnavailableError(
+                    f'Inference engine failed to start: {self.startup_error}')
+            else:
+                self.unavailable = InferenceUnavailableError('Inference scheduler stopped.')
+
+        while True:
+            try:
+                *_, future, _, _ = self.pending.get_nowait()
+            except queue.Empty:
+                break
+            future.set_exception(self.unavailable)
+
+    def submit(self, image, profile: str = 'quality', priority: str = 'image',
+               deadline: float = None) -> Future:
+        """
+        Queue an image letterboxed to the profile's input size. Higher
+        priority frames are batched first; a frame whose deadline (a
+        time.perf_counter() value) passes while queued is dropped.
+        :raises InferenceOverloadedError: if the queue ahead would not clear before the deadline
+        :raises InferenceUnavailableError: if the engine failed to start or the scheduler stopped
+        :return: Future resolving to Detections in that letterboxed image
+        """
+        if self.unavailable is not None:
+            raise self.unavailable
+
+        rank = self.shedder.admit(priority, deadline, in_flight=self.in_flight)
+
+        future = Future()
+        with self.lock:
+            if self.unavailable is not None:
+                self.shedder.taken(rank)
+                raise self.unavailable
+            self.pending.put((rank, next(self.sequence), deadline, image, future,
+                              time.perf_counter(), profile))
+            self.max_queue_depth = max(self.max_queue_depth, self.pending.qsize())
+
+        return future
+
+    def infer(self, image, profile: str = 'quality', timeout: float = None,
+              priority: str = 'image', deadline: float = None) -> Detections:
+        """
+        :param timeout: seconds to wait for the result, INFERENCE_TIMEOUT by default
+        """
+        future = self.submit(image, profile, priority, deadline)
+        try:
+            return future.result(timeout=self.default_timeout if timeout is None else timeout)
+        except FutureTimeoutError:
+            raise InferenceUnavailableError('Inference did not answer in time.')
+
+    def __take(self, timeout: float):
+        """
+        :return: the next queued frame still within its deadline
+        """
+        while True:
+            rank, _, deadline, image, future, submitted, profile = self.pending.get(timeout=timeout)
+            self.shedder.taken(rank)
+
+            if not self.shedder.expired(rank, deadline):
+                return image, future, submitted, profile
+            future.set_exception(DeadlineExceededError('Deadline passed while queued for inference.'))
+
+    def handle(self) -> None:
+        try:
+            batch = [self.__take(timeout=0.5)]
+        except queue.Empty:
+            return
+
+        # Close the batch when it is full or the oldest frame has waited long enough
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.__take(timeout=remaining))
+            except queue.Empty:
+                break
+
+        self.in_flight = len(batch)
+
+        # Each profile runs at its own input size, so mixed batches are split
+        by_profile = {}
+        for item in batch:
+            by_profile.setdefault(item[3], []).append(item)
+        for profile, items in by_profile.items():
+            self.__run_batch(profile, items)
+        self.in_flight = 0
+
+    def __run_batch(self, profile: str, batch) -> None:
+        images = [image for image, _, _, _ in batch]
+        futures = [future for _, future, _, _ in batch]
+
+        start = time.perf_counter()
+        for _, _, submitted, _ in batch:
+            INFERENCE_QUEUE_SECONDS.observe(start - submitted)
+        INFERENCE_BATCH_SIZE.observe(len(batch))
+
+        try:
+            detections = self.engines[profile].predict(images)
+        except Exception as e:
+            ERRORS.inc(where='inference')
+            self.logger.error(f'Inference failed for {profile} batch of {len(batch)}: {e}')
+            for future in futures:
+                future.set_exception(e)
+            return
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, path='batch', stage='forward')
+        self.shedder.observe_batch(elapsed)
+
+        for future, result in zip(futures, detections):
+            future.set_result(result)
+
+        with self.lock:
+            self.batches_run += 1
+            self.frames_run += len(batch)
+            self.total_batch_time += elapsed
+            self.batch_size_counts[len(batch)] = self.batch_size_counts.get(
+                len(batch), 0) + 1
+
+    def metrics(self) -> dict:
+        with self.lock:
+            return {
+                'backend': 'thread',
+                'engine': self.engine_settings['engine'],
+                'profiles': {name: profile['size'] for name, profile in self.profiles.items()},
+                'ready': self.ready.is_set(),
+                'startup_error': str(self.startup_error) if self.startup_error else None,
+                'queue_depth': self.pending.qsize(),
+                'max_queue_depth': self.max_queue_depth,
+                'batches_run': self.batches_run,
+                'frames_run': self.frames_run,
+                'avg_batch_size': self.frames_run / self.batches_run if self.batches_run else 0,
+                'avg_batch_time_ms': self.total_batch_time / self.batches_run * 1000 if self.batches_run else 0,
+                'batch_size_counts': dict(self.batch_size_counts),
+                'max_batch_size': self.max_batch_size,
+                'max_wait_ms': self.max_wait * 1000,
+                'batching_supported': self.engine.batching_supported if self.engine else None,
+                'scheduling': self.shedder.stats(),
+            }
@@ -0,0 +1,163 @@
+import math
+import threading
+import time
+import logging
+from collections import deque
+
+from flask import Flask, current_app
+from app.utils.background_thread import BackgroundThread
+
+
+class ExecutorSaturatedError(Exception):
+    pass
+
+
+class JobWorkerThread(BackgroundThread):
+    def __init__(self, thread_id: str, app: Flask, executor: 'JobExecutor'):
+        super().__init__(thread_id, app)
+        self.logger = logging.getLogger(__name__)
+        self.executor = executor
+
+    def startup(self) -> None:
+        self.logger.info(f'Starting job worker {self.thread_id}...')
+
+    def shutdown(self) -> None:
+        self.logger.info(f'Stopping job worker {self.thread_id}...')
+
+    def handle(self) -> None:
+        job = self.executor.next_job(timeout=0.5)
+
+        if job is None:
+            return
+
+        start = time.monotonic()
+        try:
+            job.run()
+        finally:
+            self.executor.job_finished(job, time.monotonic() - start)
+
+
+class JobExecutor:
+    def __init__(self, app: Flask):
+        self.app = app
+        self.logger = logging.getLogger(__name__)
+        self.pending = deque()
+        self.running = {}
+        self.condition = threading.Condition()
+        self.workers = []
+
+        self.jobs_completed = 0
+        self.jobs_rejected = 0
+        self.total_job_time = 0.0
+
+        with self.app.app_context():
+            self.pool_size = current_app.config['VIDEO_WORKERS']
+            self.max_pending = current_app.config['VIDEO_MAX_PENDING']
+            self.min_retry_after = current_app.config['VIDEO_RETRY_AFTER']
+
+    def start(self) -> None:
+        for i in range(self.pool_size):
+            worker = JobWorkerThread(
+                thread_id=f'video-worker-{i}', app=self.app, executor=self)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+        self.logger.info(
+            f'Job executor started with {self.pool_size} workers and {self.max_pending} pending slots.')
+
+    def stop(self) -> None:
+        for worker in self.workers:
+            worker.stop()
+
+    def submit(self, job) -> int:
+        """
+        Queue a job for the worker pool.
+        :return: 1-based position of the job in the pending queue
+        """
+        with self.condition:
+            if len(self.pending) >= self.max_pending:
+                self.jobs_rejected += 1
+                raise ExecutorSaturatedError(
+                    f'{len(self.pending)} jobs already pending.')
+
+            self.pending.append(job)
+            self.condition.notify()
+            return len(self.pending)
+
+    def next_job(self, timeout: float):
+        with self.condition:
+            if not self.pending:
+                self.condition.wait(timeout)
+            if not self.pending:
+                return None
+
+            job = self.pending.popleft()
+            self.running[str(job.job_id)] = job
+            return job
+
+    def job_finished(self, job, elapsed: float) -> None:
+        with self.condition:
+            self.running.pop(str(job.job_id), None)
+            self.jobs_completed += 1
+            self.total_job_time += elapsed
+
+    def cancel(self, job_id: str) -> bool:
+        """
+        Take a job out of the pending queue before a worker picks it up.
+        :return: True if the job was still pending
+        """
+        with self.condition:
+            for job in self.pending:
+                if str(job.job_id) == str(job_id):
+                    self.pending.remove(job)
+                    return True
+        return False
+
+    def drop_cancelled(self) -> int:
+        """
+        Cancel pending jobs that another worker asked to cancel through a shared job store.
+        :return: number of jobs cancelled
+        """
+        with self.condition:
+            pending = list(self.pending)
+
+        cancelled = 0
+        for job in pending:
+            if job.store.cancel_requested(str(job.job_id)) and self.cancel(job.job_id):
+                job.cancel()
+                cancelled += 1
+        return cancelled
+
+    def position(self, job_id: str):
+        """
+        :return: 1-based queue position, 0 while running, None if unknown
+        """
+        with self.condition:
+            if str(job_id) in self.running:
+                return 0
+            for index, job in enumerate(self.pending):
+                if str(job.job_id) == str(job_id):
+                    return index + 1
+        return None
+
+    def retry_after(self) -> int:
+        with self.condition:
+            if not self.jobs_completed:
+                return self.min_retry_after
+
+            # Time until one pending slot frees up on average
+            avg_job_time = self.total_job_time / self.jobs_completed
+            estimate = avg_job_time / self.pool_size
+            return max(self.min_retry_after, math.ceil(estimate))
+
+    def stats(self) -> dict:
+        with self.condition:
+            return {
+                'pool_size': self.pool_size,
+                'max_pending': self.max_pending,
+                'pending': len(self.pending),
+                'running': len(self.running),
+                'jobs_completed': self.jobs_completed,
+                'jobs_rejected': self.jobs_rejected,
+            }
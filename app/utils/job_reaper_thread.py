@@ -0,0 +1,42 @@
+import threading
+import logging
+
+from flask import Flask, current_app
+from app.utils.background_thread import BackgroundThread
+
+
+class JobReaperThread(BackgroundThread):
+    def __init__(self, thread_id: str, app: Flask, factory):
+        super().__init__(thread_id, app)
+        self.logger = logging.getLogger(__name__)
+        self.app = app
+        self.factory = factory
+        self.wakeup = threading.Event()
+
+        with app.app_context():
+            self.interval = current_app.config['JOB_REAP_INTERVAL']
+
+    def stop(self) -> None:
+        super().stop()
+        self.wakeup.set()
+
+    def startup(self) -> None:
+        self.logger.info('Starting job reaper...')
+
+    def shutdown(self) -> None:
+        self.logger.info('Stopping job reaper...')
+
+    def handle(self) -> None:
+        if self.wakeup.wait(self.interval):
+            return
+
+        with self.app.app_context():
+            jobExecutor = current_app.config.get('JOB_EXECUTOR')
+        if jobExecutor is not None:
+            cancelled = jobExecutor.drop_cancelled()
+            if cancelled:
+                self.logger.info(f'Cancelled {cancelled} queued jobs on request of another worker.')
+
+        evicted = self.factory.evict_expired()
+        if evicted:
+            self.logger.info(f'Evicted {evicted} abandoned jobs.')
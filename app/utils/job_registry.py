@@ -0,0 +1,72 @@
+import time
+import threading
+
+JOB_STATES = ('queued', 'running', 'done', 'failed', 'cancelled')
+FINISHED_STATES = ('done', 'failed', 'cancelled')
+
+
+class JobRegistry:
+    """
+    Thread-safe index of the factory's threads and jobs by string id.
+    Every lookup refreshes the entry's last access, so finished jobs that
+    no client has polled or streamed for `ttl` seconds can be found by
+    expired() and evicted together with their buffered frames.
+    """
+
+    def __init__(self, ttl: float = 300):
+        self.ttl = ttl
+        self.entries = {}
+        self.last_seen = {}
+        self.lock = threading.Lock()
+        self.evicted = 0
+
+    def add(self, thread_id, thread) -> None:
+        with self.lock:
+            self.entries[str(thread_id)] = thread
+            self.last_seen[str(thread_id)] = time.monotonic()
+
+    def get(self, thread_id):
+        """
+        :return: the registered thread or job, None if unknown
+        """
+        with self.lock:
+            thread = self.entries.get(str(thread_id))
+            if thread is not None:
+                self.last_seen[str(thread_id)] = time.monotonic()
+            return thread
+
+    def remove(self, thread_id, evicted: bool = False):
+        """
+        :return: the removed thread or job, None if it was already gone
+        """
+        with self.lock:
+            self.last_seen.pop(str(thread_id), None)
+            thread = self.entries.pop(str(thread_id), None)
+            if thread is not None and evicted:
+                self.evicted += 1
+            return thread
+
+    def values(self) -> list:
+        with self.lock:
+            return list(self.entries.values())
+
+    def expired(self) -> list[str]:
+        """
+        :return: ids of finished jobs idle for longer than the TTL
+        """
+        deadline = time.monotonic() - self.ttl
+        with self.lock:
+            return [thread_id for thread_id, thread in self.entries.items()
+                    if getattr(thread, 'state', None) in FINISHED_STATES
+                    and self.last_seen[thread_id] < deadline]
+
+    def stats(self) -> dict:
+        with self.lock:
+            states = {state: 0 for state in JOB_STATES}
+            for thread in self.entries.values():
+                state = getattr(thread, 'state', None)
+                if state in states:
+                    states[state] += 1
+
+            return {'entries': len(self.entries), 'evicted': self.evicted,
+                    'jobs': states}
@@ -0,0 +1,549 @@
+import os
+import time
+import queue
+import asyncio
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+
+from .frame_buffer import FrameBuffer, POLICIES
+from .job_registry import FINISHED_STATES
+from .metrics import DROPPED_FRAMES
+from .result_segments import SegmentReader, finish_empty_segment, remove_segment
+
+JOB_STORES = ('memory', 'sqlite')
+
+# Seconds between checks while a stored frame buffer waits for frames or space
+POLL_INTERVAL = 0.02
+
+
+class JobStore(ABC):
+    """
+    Keeps video job metadata, progress and produced frames. A shared store
+    lets any worker process answer polls and stream a job that another
+    worker is processing.
+    """
+
+    shared = False
+
+    @abstractmethod
+    def create(self, job_id: str, file_id: str, file_path: str, output: str,
+               delete_source: bool, policy: str, segment_path: str = None) -> None:
+        raise NotImplementedError()
+
+    @abstractmethod
+    def update(self, job_id: str, **fields) -> None:
+        """
+        Set any of state, progress or cancel_requested.
+        :return: None
+        """
+        raise NotImplementedError()
+
+    @abstractmethod
+    def get(self, job_id: str):
+        """
+        :return: the job's fields as a dict, None if unknown
+        """
+        raise NotImplementedError()
+
+    @abstractmethod
+    def delete(self, job_id: str) -> None:
+        raise NotImplementedError()
+
+    @abstractmethod
+    def frame_buffer(self, job_id: str, policy: str, max_frames: int, max_bytes: int):
+        """
+        :return: the buffer the job writes its frames to
+        """
+        raise NotImplementedError()
+
+    def load(self, job_id: str):
+        """
+        :return: a StoredJob view of a job processed by another worker, None if unavailable
+        """
+        return None
+
+    def cancel_requested(self, job_id: str) -> bool:
+        return False
+
+    def last_access(self, job_id: str):
+        """
+        :return: wall-clock time a viewer last read from the job, None if never
+        """
+        return None
+
+    def touch(self, job_id: str) -> None:
+        """
+        Record that a viewer read from the job, which keeps it from being evicted.
+        :return: None
+        """
+        pass
+
+    @abstractmethod
+    def create_upload(self, upload_id: str, total_size: int = None) -> None:
+        raise NotImplementedError()
+
+    @abstractmethod
+    def get_upload(self, upload_id: str):
+        """
+        :return: the chunked upload session as a dict, None if unknown
+        """
+        raise NotImplementedError()
+
+    @abstractmethod
+    def delete_upload(self, upload_id: str) -> None:
+        raise NotImplementedError()
+
+
+class MemoryJobStore(JobStore):
+    """
+    Process-local store, the default. Frames stay in the job's FrameBuffer,
+    so only the worker running a job can serve it.
+    """
+
+    def __init__(self):
+        self.jobs = {}
+        self.uploads = {}
+        self.lock = threading.Lock()
+
+    def create(self, job_id: str, file_id: str, file_path: str, output: str,
+               delete_source: bool, policy: str, segment_path: str = None) -> None:
+        with self.lock:
+            self.jobs[job_id] = {'job_id': job_id, 'file_id': file_id, 'file_path': file_path,
+                                 'output': output, 'delete_source': delete_source,
+                                 'policy': policy, 'segment_path': segment_path,
+                                 'state': 'queued', 'progress': 0,
+                                 'cancel_requested': False, 'accessed_at': None}
+
+    def update(self, job_id: str, **fields) -> None:
+        with self.lock:
+            if job_id in self.jobs:
+                self.jobs[job_id].update(fields)
+
+    def get(self, job_id: str):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job else None
+
+    def delete(self, job_id: str) -> None:
+        with self.lock:
+            self.jobs.pop(job_id, None)
+
+    def frame_buffer(self, job_id: str, policy: str, max_frames: int, max_bytes: int):
+        return FrameBuffer(policy=policy, max_frames=max_frames, max_bytes=max_bytes)
+
+    def last_access(self, job_id: str):
+        job = self.get(job_id)
+        return job['accessed_at'] if job else None
+
+    def touch(self, job_id: str) -> None:
+        self.update(job_id, accessed_at=time.time())
+
+    def create_upload(self, upload_id: str, total_size: int = None) -> None:
+        with self.lock:
+            self.uploads[upload_id] = {'upload_id': upload_id, 'total_size': total_size}
+
+    def get_upload(self, upload_id: str):
+        with self.lock:
+            upload = self.uploads.get(upload_id)
+            return dict(upload) if upload else None
+
+    def delete_upload(self, upload_id: str) -> None:
+        with self.lock:
+            self.uploads.pop(upload_id, None)
+
+
+class SqliteJobStore(JobStore):
+    """
+    Store in a SQLite database shared by every worker process on one host.
+    Frames are rows that the reading viewer deletes as it consumes them, so
+    the database only holds what is buffered.
+    """
+
+    shared = True
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS jobs (
+            job_id TEXT PRIMARY KEY,
+            file_id TEXT,
+            file_path TEXT,
+            output TEXT,
+            delete_source INTEGER,
+            policy TEXT,
+            segment_path TEXT,
+            state TEXT DEFAULT 'queued',
+            progress INTEGER DEFAULT 0,
+            cancel_requested INTEGER DEFAULT 0,
+            finished INTEGER DEFAULT 0,
+            written_seq INTEGER DEFAULT 0,
+            dropped INTEGER DEFAULT 0,
+            accessed_at REAL
+        );
+        CREATE TABLE IF NOT EXISTS frames (
+            job_id TEXT,
+            seq INTEGER,
+            data BLOB,
+            PRIMARY KEY (job_id, seq)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS uploads (
+            upload_id TEXT PRIMARY KEY,
+            total_size INTEGER
+        );
+    """
+
+    FIELDS = ('state', 'progress', 'cancel_requested')
+
+    def __init__(self, path: str):
+        self.path = path
+        self.local = threading.local()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.connection().executescript(self.SCHEMA)
+
+    def connection(self) -> sqlite3.Connection:
+        # sqlite3 connections must not be shared between threads
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(
+                self.path, timeout=30, isolation_level=None)
+            connection.row_factory = sqlite3.Row
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self.local.connection = connection
+        return connection
+
+    def create(self, job_id: str, file_id: str, file_path: str, output: str,
+               delete_source: bool, policy: str, segment_path: str = None) -> None:
+        self.connection().execute(
+            'INSERT OR REPLACE INTO jobs '
+            '(job_id, file_id, file_path, output, delete_source, policy, segment_path) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (job_id, file_id, file_path, output, int(delete_source), policy, segment_path))
+
+    def update(self, job_id: str, **fields) -> None:
+        columns = [name for name in fields if name in self.FIELDS]
+        if not columns:
+            return
+
+        self.connection().execute(
+            f"UPDATE jobs SET {', '.join(f'{name} = ?' for name in columns)} WHERE job_id = ?",
+            [fields[name] for name in columns] + [job_id])
+
+    def get(self, job_id: str):
+        row = self.connection().execute(
+            'SELECT * FROM jobs WHERE job_id = ?', (job_id,)).fetchone()
+        return dict(row) if row else None
+
+    def delete(self, job_id: str) -> None:
+        connection = self.connection()
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            connection.execute('DELETE FROM frames WHERE job_id = ?', (job_id,))
+            connection.execute('DELETE FROM jobs WHERE job_id = ?', (job_id,))
+
+    def frame_buffer(self, job_id: str, policy: str, max_frames: int, max_bytes: int):
+        return StoredFrameBuffer(self, job_id, policy, max_frames, max_bytes)
+
+    def load(self, job_id: str):
+        job = self.get(job_id)
+        return StoredJob(self, job) if job else None
+
+    def cancel_requested(self, job_id: str) -> bool:
+        job = self.get(job_id)
+        return bool(job and job['cancel_requested'])
+
+    def last_access(self, job_id: str):
+        job = self.get(job_id)
+        return job['accessed_at'] if job else None
+
+    def touch(self, job_id: str) -> None:
+        self.connection().execute(
+            'UPDATE jobs SET accessed_at = ? WHERE job_id = ?', (time.time(), job_id))
+
+    def create_upload(self, upload_id: str, total_size: int = None) -> None:
+        self.connection().execute(
+            'INSERT INTO uploads (upload_id, total_size) VALUES (?, ?)', (upload_id, total_size))
+
+    def get_upload(self, upload_id: str):
+        row = self.connection().execute(
+            'SELECT * FROM uploads WHERE upload_id = ?', (upload_id,)).fetchone()
+        return dict(row) if row else None
+
+    def delete_upload(self, upload_id: str) -> None:
+        self.connection().execute('DELETE FROM uploads WHERE upload_id = ?', (upload_id,))
+
+    def clear_frames(self, job_id: str) -> None:
+        """
+        Delete the job's buffered frames, keeping the job itself.
+        :return: None
+        """
+        self.connection().execute('DELETE FROM frames WHERE job_id = ?', (job_id,))
+
+    def buffered(self, job_id: str) -> tuple[int, int]:
+        """
+        :return: (frames, bytes) waiting for a viewer
+        """
+        row = self.connection().execute(
+            'SELECT COUNT(*), COALESCE(SUM(LENGTH(data)), 0) FROM frames WHERE job_id = ?',
+            (job_id,)).fetchone()
+        return row[0], row[1]
+
+    def frame_sizes(self, job_id: str) -> list[int]:
+        """
+        :return: sizes of the buffered frames, oldest first
+        """
+        rows = self.connection().execute(
+            'SELECT LENGTH(data) FROM frames WHERE job_id = ? ORDER BY seq', (job_id,)).fetchall()
+        return [row[0] for row in rows]
+
+    def append(self, job_id: str, data: bytes, drop: int = 0) -> None:
+        """
+        Append a frame, first deleting the `drop` oldest buffered ones.
+        :return: None
+        """
+        connection = self.connection()
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            if drop:
+                connection.execute(
+                    'DELETE FROM frames WHERE job_id = ? AND seq IN '
+                    '(SELECT seq FROM frames WHERE job_id = ? ORDER BY seq LIMIT ?)',
+                    (job_id, job_id, drop))
+            connection.execute(
+                'UPDATE jobs SET written_seq = written_seq + 1, dropped = dropped + ? WHERE job_id = ?',
+                (drop, job_id))
+            connection.execute(
+                'INSERT INTO frames (job_id, seq, data) '
+                'SELECT job_id, written_seq, ? FROM jobs WHERE job_id = ?',
+                (data, job_id))
+
+    def finish(self, job_id: str) -> None:
+        self.connection().execute(
+            'UPDATE jobs SET finished = 1 WHERE job_id = ?', (job_id,))
+
+    def pop(self, job_id: str):
+        """
+        Take the oldest buffered frame.
+        :return: frame bytes, 'DONE' once finished and drained, None if nothing is ready
+        """
+        connection = self.connection()
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            connection.execute(
+                'UPDATE jobs SET accessed_at = ? WHERE job_id = ?', (time.time(), job_id))
+            row = connection.execute(
+                'SELECT seq, data FROM frames WHERE job_id = ? ORDER BY seq LIMIT 1',
+                (job_id,)).fetchone()
+
+            if row is not None:
+                connection.execute(
+                    'DELETE FROM frames WHERE job_id = ? AND seq = ?', (job_id, row['seq']))
+                return row['data']
+
+            job = connection.execute(
+                'SELECT finished FROM jobs WHERE job_id = ?', (job_id,)).fetchone()
+
+        # A deleted job has nothing more to send either
+        if job is None or job['finished']:
+            return 'DONE'
+        return None
+
+
+class StoredFrameBuffer:
+    """
+    FrameBuffer counterpart backed by a SqliteJobStore, with the same
+    policies and limits, so producer and viewer can be different processes.
+    """
+
+    def __init__(self, store: SqliteJobStore, job_id: str, policy: str = 'block',
+                 max_frames: int = 64, max_bytes: int = 32 * 1024 * 1024):
+        if policy not in POLICIES:
+            raise ValueError(
+                f"Unknown frame buffer policy '{policy}', expected one of {POLICIES}.")
+
+        self.store = store
+        self.job_id = job_id
+        self.policy = policy
+        self.max_frames = max_frames
+        self.max_bytes = max_bytes
+        self.closed = False
+
+    def __full(self, size: int) -> bool:
+        frames, buffered = self.store.buffered(self.job_id)
+        if not frames:
+            return False
+        return frames >= self.max_frames or buffered + size > self.max_bytes
+
+    def put(self, data, timeout: float = None) -> bool:
+        """
+        Add a frame, or the "DONE" marker which is never dropped or blocked.
+        :return: False if the block policy timed out waiting for space
+        """
+        if data == 'DONE':
+            self.store.finish(self.job_id)
+            return True
+
+        size = len(data)
+        drop = 0
+
+        if self.policy == 'block':
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while not self.closed and self.__full(size):
+                if deadline is not None and time.monotonic() >= deadline:
+                    return False
+                time.sleep(POLL_INTERVAL)
+        elif self.policy == 'drop_oldest':
+            sizes = self.store.frame_sizes(self.job_id)
+            buffered = sum(sizes)
+            while drop < len(sizes) and (len(sizes) - drop >= self.max_frames
+                                         or buffered + size > self.max_bytes):
+                buffered -= sizes[drop]
+                drop += 1
+        else:
+            drop = self.store.buffered(self.job_id)[0]
+
+        if self.closed:
+            return True
+
+        if drop:
+            DROPPED_FRAMES.inc(drop, policy=self.policy)
+        self.store.append(self.job_id, data, drop)
+        return True
+
+    def get(self, timeout: float = None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        while True:
+            data = self.store.pop(self.job_id)
+            if data is not None:
+                return data
+            if deadline is not None and time.monotonic() >= deadline:
+                raise queue.Empty
+            time.sleep(POLL_INTERVAL)
+
+    async def get_async(self, timeout: float = None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        while True:
+            # SQLite may wait on another writer, which must not block the event loop
+            data = await asyncio.to_thread(self.store.pop, self.job_id)
+            if data is not None:
+                return data
+            if deadline is not None and time.monotonic() >= deadline:
+                raise queue.Empty
+            await asyncio.sleep(POLL_INTERVAL)
+
+    def qsize(self) -> int:
+        return self.store.buffered(self.job_id)[0]
+
+    @property
+    def bytes_buffered(self) -> int:
+        return self.store.buffered(self.job_id)[1]
+
+    def fill(self) -> float:
+        frames, buffered = self.store.buffered(self.job_id)
+        return min(max(frames / self.max_frames, buffered / self.max_bytes), 1.0)
+
+    def close(self) -> None:
+        self.closed = True
+
+    def clear(self) -> None:
+        self.store.clear_frames(self.job_id)
+
+    def stats(self) -> dict:
+        frames, buffered = self.store.buffered(self.job_id)
+        job = self.store.get(self.job_id)
+        return {
+            'policy': self.policy,
+            'buffered_frames': frames,
+            'buffered_bytes': buffered,
+            'dropped_frames': job['dropped'] if job else 0,
+        }
+
+
+class StoredJob:
+    """
+    Read-side view of a job another worker process is running, with the
+    attributes the streaming and polling routes use from ProcessFramesJob.
+    """
+
+    def __init__(self, store: SqliteJobStore, job: dict):
+        self.store = store
+        self.job_id = job['job_id']
+        self.file_id = job['file_id']
+        self.file_path = job['file_path']
+        self.output = job['output']
+        self.delete_source = bool(job['delete_source'])
+        self.segment_path = job['segment_path']
+        self.frame_queue = StoredFrameBuffer(store, self.job_id, job['policy'])
+
+    def __field(self, name: str, default):
+        job = self.store.get(self.job_id)
+        return job[name] if job else default
+
+    @property
+    def progress(self) -> int:
+        return self.__field('progress', 0)
+
+    @property
+    def state(self) -> str:
+        job = self.store.get(self.job_id)
+        if job is None:
+            return 'done'
+
+        # The worker running the job has not picked up the cancellation yet
+        if job['cancel_requested'] and job['state'] not in FINISHED_STATES:
+            return 'cancelling'
+        return job['state']
+
+    @property
+    def persisted(self) -> bool:
+        return self.segment_path is not None
+
+    def get_frame_queue(self) -> StoredFrameBuffer:
+        return self.frame_queue
+
+    def open_stream(self, start_frame: int = 0):
+        if self.persisted:
+            return SegmentReader(self.segment_path, start_frame, policy=self.frame_queue.policy,
+                                 on_read=lambda: self.store.touch(self.job_id))
+        return self.frame_queue
+
+    def cancel(self) -> None:
+        queued = self.state == 'queued'
+
+        # The worker running the job checks for this between frames
+        self.store.update(self.job_id, cancel_requested=1)
+
+        # A job that never started will not release its viewers itself
+        if queued:
+            if self.persisted:
+                finish_empty_segment(self.segment_path)
+            else:
+                self.frame_queue.put('DONE')
+
+    def stop(self) -> None:
+        pass
+
+    def cleanup(self) -> None:
+        self.store.delete(self.job_id)
+        if self.persisted:
+            remove_segment(self.segment_path)
+
+        if self.delete_source and os.path.exists(self.file_path):
+            try:
+                os.remove(self.file_path)
+            except OSError:
+                # The worker that ran the job may have removed it first
+                pass
+
+
+def create_job_store(kind: str, path: str = None) -> JobStore:
+    if kind == 'sqlite':
+        return SqliteJobStore(path)
+    if kind == 'memory':
+        return MemoryJobStore()
+    raise ValueError(f"Job store must be one of {', '.join(JOB_STORES)}")
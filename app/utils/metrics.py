@@ -0,0 +1,202 @@
+import time
+import threading
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(labelnames: tuple, values: tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def samples(self) -> list[str]:
+        raise NotImplementedError()
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.documentation}',
+                 f'# TYPE {self.name} {self.type}']
+        lines.extend(self.samples())
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        super().__init__(name, documentation, labelnames)
+        self.values = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self) -> list[str]:
+        with self.lock:
+            return [f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}'
+                    for key, value in self.values.items()]
+
+
+class Gauge(Metric):
+    """
+    A gauge is either set directly or read from a callback at scrape time,
+    which suits values like queue depths that already live elsewhere.
+    """
+    type = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        super().__init__(name, documentation, labelnames)
+        self.values = {}
+        self.callback = None
+
+    def set(self, value: float, **labels) -> None:
+        with self.lock:
+            self.values[self._key(labels)] = value
+
+    def set_function(self, callback) -> None:
+        """
+        :param callback: returns a number, or a dict of label tuples to numbers
+        """
+        self.callback = callback
+
+    def samples(self) -> list[str]:
+        with self.lock:
+            values = dict(self.values)
+
+        if self.callback is not None:
+            try:
+                result = self.callback()
+            except Exception:
+                result = {}
+            if isinstance(result, dict):
+                values.update(result)
+            else:
+                values[()] = result
+
+        return [f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}'
+                for key, value in values.items()]
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        self.values = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self.values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> list[str]:
+        lines = []
+        with self.lock:
+            for key, (counts, total) in self.values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    le = _format_labels(self.labelnames, key,
+                                        f'le="{_format_value(bound)}"')
+                    lines.append(f'{self.name}_bucket{le} {cumulative}')
+                labels = _format_labels(self.labelnames, key)
+                lines.append(f'{self.name}_sum{labels} {_format_value(total)}')
+                lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def __register(self, metric: Metric) -> Metric:
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, documentation: str, labelnames: tuple = ()) -> Counter:
+        return self.__register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: tuple = ()) -> Gauge:
+        return self.__register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: tuple = (),
+                  buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        return self.__register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+
+# Process-wide registry, shared by request threads, video workers and schedulers
+registry = MetricsRegistry()
+
+STAGE_SECONDS = registry.histogram(
+    'hair_detection_stage_seconds', 'Time spent in each processing stage.', ('path', 'stage'))
+REQUEST_SECONDS = registry.histogram(
+    'hair_detection_request_seconds', 'HTTP request latency by endpoint.', ('endpoint', 'status'))
+INFERENCE_QUEUE_SECONDS = registry.histogram(
+    'hair_detection_inference_queue_seconds', 'Time frames wait before their batch runs.')
+INFERENCE_BATCH_SIZE = registry.histogram(
+    'hair_detection_inference_batch_size', 'Frames per forward pass.',
+    buckets=(1, 2, 4, 8, 16, 32, 64))
+ERRORS = registry.counter(
+    'hair_detection_errors_total', 'Errors by where they happened.', ('where',))
+DROPPED_FRAMES = registry.counter(
+    'hair_detection_dropped_frames_total', 'Frames dropped by full frame buffers.', ('policy',))
+REUSED_FRAMES = registry.counter(
+    'hair_detection_reused_frames_total', 'Video frames whose boxes were carried forward instead of inferred.',
+    ('motion',))
+ACTIVE_JOBS = registry.gauge(
+    'hair_detection_active_jobs', 'Entries in the background thread factory by type.', ('type',))
+FRAME_QUEUE_DEPTH = registry.gauge(
+    'hair_detection_frame_queue_frames', 'Frames buffered for video viewers.')
+FRAME_QUEUE_BYTES = registry.gauge(
+    'hair_detection_frame_queue_bytes', 'Bytes buffered for video viewers.')
+INFERENCE_QUEUE_DEPTH = registry.gauge(
+    'hair_detection_inference_queue_depth', 'Frames waiting for the inference backend.')
+TEMP_STORAGE_BYTES = registry.gauge(
+    'hair_detection_temp_storage_bytes', 'Bytes of indexed temp files by category.', ('category',))
+VIDEO_JOBS_PENDING = registry.gauge(
+    'hair_detection_video_jobs_pending', 'Video jobs waiting for a worker.')
+SHED_REQUESTS = registry.counter(
+    'hair_detection_shed_requests_total', 'Frames refused or dropped before inference to keep latency bounded.',
+    ('reason', 'priority'))
@@ -0,0 +1,244 @@
+import os
+import weakref
+import threading
+import logging
+
+from flask import Flask, current_app
+from .detector import add_video_detections
+from .frame_buffer import FrameBuffer
+from .job_registry import FINISHED_STATES
+from .result_segments import (SegmentReader, SegmentWriter, finish_empty_segment, remove_segment,
+                              segment_paths)
+
+
+class ProcessFramesJob:
+    def __init__(self, job_id: str, app: Flask, file_path: str, file_id: str, buffer_policy: str = None,
+                 start_frame: int = 0, cache_track: bool = False, output: str = 'image',
+                 encoding: dict = None, delete_source: bool = False, profile: str = 'quality'):
+        self.logger = logging.getLogger(__name__)
+        self.job_id = job_id
+        self.file_path = file_path
+        self.file_id = file_id
+        self.app = app
+        self.start_frame = start_frame
+        self.cache_track = cache_track
+        self.output = output
+        self.encoding = encoding
+        self.profile = profile
+        self.delete_source = delete_source
+        self.__progress = 0
+        self.__state = 'queued'
+        self.__stop_event = threading.Event()
+        # Readers of persisted output, dropped once their viewer's stream is gone
+        self.__readers = weakref.WeakSet()
+        self.__readers_lock = threading.Lock()
+
+        with self.app.app_context():
+            # Dropping fragments would corrupt an MP4 stream
+            if output == 'mp4':
+                buffer_policy = 'block'
+            policy = buffer_policy or current_app.config['FRAME_BUFFER_POLICY']
+
+            # Persisted output is appended to a segment file that any number of viewers can replay
+            self.segment_path = None
+            if current_app.config['VIDEO_PERSIST_RESULTS']:
+                self.segment_path = os.path.join(
+                    current_app.config['TEMP_DIR'], 'results', str(job_id))
+
+            # The store decides where frames are buffered, and who else can read them
+            self.store = current_app.config['JOB_STORE']
+            self.store.create(str(job_id), file_id, file_path, output, delete_source, policy,
+                              self.segment_path)
+            self.policy = policy
+            self.max_frames = current_app.config['FRAME_BUFFER_MAX_FRAMES']
+            self.max_bytes = current_app.config['FRAME_BUFFER_MAX_BYTES']
+            self.frame_queue = self.store.frame_buffer(
+                str(job_id), policy=policy, max_frames=self.max_frames, max_bytes=self.max_bytes)
+            self.stall_timeout = current_app.config['VIDEO_STALL_TIMEOUT']
+            self.storage = current_app.config['TEMP_STORAGE']
+
+    @property
+    def state(self) -> str:
+        return self.__state
+
+    @state.setter
+    def state(self, state: str) -> None:
+        self.__state = state
+        self.store.update(str(self.job_id), state=state)
+
+    @property
+    def progress(self) -> int:
+        return self.__progress
+
+    @progress.setter
+    def progress(self, progress: int) -> None:
+        if progress != self.__progress:
+            self.store.update(str(self.job_id), progress=progress)
+        self.__progress = progress
+
+    @property
+    def persisted(self) -> bool:
+        return self.segment_path is not None
+
+    def stop(self) -> None:
+        self.__stop_event.set()
+        self.frame_queue.close()
+
+    def cancel(self) -> None:
+        if self.state in FINISHED_STATES:
+            return
+
+        queued = self.state == 'queued'
+        self.state = 'cancelled'
+        self.stop()
+
+        # A job that never started will not release its viewers itself
+        if queued:
+            if self.persisted:
+                finish_empty_segment(self.segment_path)
+            self.frame_queue.put('DONE')
+
+    def cleanup(self) -> None:
+        """
+        Drop buffered frames and remove an uploaded source video. Called once
+        the job has been deleted from the factory.
+        :return: None
+        """
+        self.frame_queue.clear()
+        self.store.delete(str(self.job_id))
+        if self.persisted:
+            self.storage.release(segment_paths(self.segment_path)[0])
+            remove_segment(self.segment_path)
+
+        if self.delete_source and os.path.exists(self.file_path):
+            try:
+                self.storage.remove(self.file_path)
+            except Exception as e:
+                self.logger.error(f"Failed to delete source video file: {e}")
+
+    def __segment_evicted(self, path: str) -> None:
+        # Without its output the job cannot be replayed any more
+        with self.app.app_context():
+            current_app.config['BACKGROUND_THREAD_FACTORY'].delete(self.job_id, evicted=True)
+
+    def _stopped(self) -> bool:
+        return self.__stop_event.is_set()
+
+    def __cancelled(self) -> bool:
+        # Workers sharing the job store cancel through it
+        return self._stopped() or self.store.cancel_requested(str(self.job_id))
+
+    def get_frame_queue(self) -> FrameBuffer:
+        return self.frame_queue
+
+    def open_stream(self, start_frame: int = 0):
+        """
+        :return: a reader for one viewer, from start_frame on if the output is persisted
+        """
+        if self.persisted:
+            self.storage.touch(segment_paths(self.segment_path)[0])
+            reader = SegmentReader(self.segment_path, start_frame, policy=self.policy,
+                                   max_frames=self.max_frames, max_bytes=self.max_bytes,
+                                   on_read=self.__read)
+            with self.__readers_lock:
+                self.__readers.add(reader)
+            return reader
+        return self.frame_queue
+
+    def __read(self) -> None:
+        # A viewer still streaming keeps the job and its segment from being evicted
+        self.store.touch(str(self.job_id))
+        self.storage.touch(segment_paths(self.segment_path)[0])
+
+    def __viewers(self) -> list:
+        with self.__readers_lock:
+            return list(self.__readers)
+
+    def backlog(self) -> float:
+        """
+        Persisted output never waits for its viewers, so the backlog is how far
+        the slowest viewer streaming from this worker lags behind the writer.
+        :return: 0.0 to 1.0, as FrameBuffer.fill
+        """
+        if not self.persisted:
+            return self.frame_queue.fill()
+        return max((reader.fill() for reader in self.__viewers()), default=0.0)
+
+    def buffered(self) -> tuple[int, int]:
+        """
+        :return: frames and bytes waiting for the slowest viewer
+        """
+        if not self.persisted:
+            return self.frame_queue.qsize(), self.frame_queue.bytes_buffered
+        return max((reader.lag() for reader in self.__viewers()), default=(0, 0))
+
+    def get_id(self) -> str:
+        return self.job_id
+
+    def run(self) -> None:
+        """
+        Process the whole video. Called by a JobExecutor worker thread.
+        :return: None
+        """
+        if self.__cancelled():
+            self.logger.info(f'Skipping cancelled job {self.job_id}.')
+            self.state = 'cancelled'
+            return
+
+        self.state = 'running'
+        self.logger.info(
+            f'Starting processing frames for file {self.file_id} job id {self.job_id}...')
+
+        done = False
+        writer = None
+        if self.persisted:
+            writer = SegmentWriter(self.segment_path)
+            # Pinned while written, then evictable once the job is finished
+            self.storage.track(segment_paths(self.segment_path)[0], 'segments', pinned=True,
+                               on_evict=self.__segment_evicted)
+        try:
+            with self.app.app_context():
+                for data, progress in add_video_detections(self.file_path, file_id=self.job_id,
+                                                           start_frame=self.start_frame,
+                                                           cache_track=self.cache_track,
+                                                           output=self.output,
+                                                           encoding=self.encoding,
+                                                           profile=self.profile,
+                                                           backlog=self.backlog):
+                    self.progress = progress
+
+                    if data is None:
+                        self.frame_queue.put('DONE')
+                        done = True
+                        self.logger.info(
+                            f"Processing complete for {self.file_id}.")
+                        break
+                    elif self.__cancelled():
+                        break
+                    elif not data:
+                        # The MP4 encoder holds back output until a fragment is complete
+                        continue
+                    elif writer is not None:
+                        writer.append(data)
+                        self.storage.touch(segment_paths(self.segment_path)[0], size=writer.offset)
+                    elif not self.frame_queue.put(data, timeout=self.stall_timeout):
+                        self.logger.warning(
+                            f"No consumer read frames of {self.file_id} for {self.stall_timeout}s, aborting job.")
+                        break
+        finally:
+            # Always release streaming clients, even if processing failed
+            if writer is not None:
+                writer.finish()
+                self.storage.unpin(segment_paths(self.segment_path)[0])
+            if not done:
+                self.frame_queue.put('DONE')
+
+            if done:
+                self.state = 'done'
+            elif self.__cancelled():
+                self.state = 'cancelled'
+            else:
+                self.state = 'failed'
+            self.stop()
+            self.logger.info(
+                f'Stopping processing frames for file {self.file_id}...')
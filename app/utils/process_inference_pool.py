@@ -0,0 +1,425 @@
+import time
+import atexit
+import queue
+import itertools
+import threading
+import logging
+import multiprocessing as mp
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+from flask import Flask, current_app
+from app.utils.detections import Detections
+from app.utils.inference_profiles import create_profile_engines
+from app.utils.inference_priority import LoadShedder, DeadlineExceededError, InferenceUnavailableError
+from app.utils.startup import warm_up
+from app.utils.metrics import INFERENCE_BATCH_SIZE, ERRORS
+
+# Seconds between checks that every worker process is still alive
+WORKER_CHECK_INTERVAL = 0.5
+
+
+def _inference_worker(worker: int, shm_name: str, slot_shape: tuple, slots: int, engine_settings: dict,
+                      profiles: dict, max_batch_size: int, warmup: tuple[int, int],
+                      task_queue, result_queue) -> None:
+    """
+    Entry point of a model-hosting worker process. Frames are read in place
+    from the shared memory slots named in task_queue and only the small
+    detection arrays are sent back through result_queue, with the seconds
+    the batch took. Once the engines are warm, or failed to load, a message
+    without slots reports the worker's startup timings or error.
+    :return: None
+    """
+    shm = SharedMemory(name=shm_name)
+    frames = np.ndarray((slots, *slot_shape), dtype=np.uint8, buffer=shm.buf)
+
+    try:
+        start = time.perf_counter()
+        engines = create_profile_engines(engine_settings, profiles)
+        timings = {'engine_load': time.perf_counter() - start}
+        for name, profile in profiles.items():
+            timings[f'warm_up_{name}'] = warm_up(engines[name], *warmup, profile['size'])
+    except Exception as e:
+        result_queue.put((worker, None, None, str(e), None))
+        del frames
+        shm.close()
+        return
+
+    result_queue.put((worker, None, timings, None, None))
+    running = True
+
+    while running:
+        task = task_queue.get()
+        if task is None:
+            break
+
+        tasks = [task]
+        while len(tasks) < max_batch_size:
+            try:
+                task = task_queue.get_nowait()
+            except queue.Empty:
+                break
+            if task is None:
+                running = False
+                break
+            tasks.append(task)
+
+        # A slot holds a frame letterboxed to its profile's size in its top-left corner
+        by_profile = {}
+        for slot, profile in tasks:
+            by_profile.setdefault(profile, []).append(slot)
+
+        for profile, batch in by_profile.items():
+            size = profiles[profile]['size']
+            start = time.perf_counter()
+            try:
+                detections = engines[profile].predict([frames[s, :size, :size] for s in batch])
+                result_queue.put((worker, batch, detections, None, time.perf_counter() - start))
+            except Exception as e:
+                result_queue.put((worker, batch, None, str(e), None))
+
+    del frames
+    shm.close()
+
+
+class ProcessInferencePool:
+    def __init__(self, app: Flask):
+        self.logger = logging.getLogger(__name__)
+        self.app = app
+        self.lock = threading.Lock()
+        self.futures = {}
+        self.processes = []
+        self.stopped = False
+
+        # Set once the worker processes have loaded and warmed up their engines.
+        # `started` is also set when none could, with the reason in startup_error,
+        # which also explains a pool whose workers all died later.
+        self.ready = threading.Event()
+        self.started = threading.Event()
+        self.startup_error = None
+        self.startup_timings = {}
+        self.workers_ready = 0
+        self.workers_failed = 0
+        # Set once no worker is left to run frames, the reason new submits fail with
+        self.unavailable = None
+
+        self.batches_run = 0
+        self.frames_run = 0
+        self.batch_size_counts = {}
+
+        with self.app.app_context():
+            self.engine_settings = current_app.config['ENGINE_SETTINGS']
+            self.profiles = current_app.config['INFERENCE_PROFILES']
+            self.process_count = current_app.config['INFERENCE_PROCESSES']
+            self.max_batch_size = current_app.config['INFERENCE_MAX_BATCH_SIZE']
+            self.default_timeout = current_app.config['INFERENCE_TIMEOUT']
+            warmup = (current_app.config['WARMUP_BATCH_SIZE'], current_app.config['WARMUP_RUNS'])
+
+        # Enough slots for every worker to hold a full batch while the next one
+        # queues up, each sized for the largest profile
+        side = max(profile['size'] for profile in self.profiles.values())
+        self.slot_shape = (side, side, 3)
+        self.slots = self.process_count * self.max_batch_size * 2
+        slot_bytes = int(np.prod(self.slot_shape))
+        self.shm = SharedMemory(create=True, size=self.slots * slot_bytes)
+        self.frames = np.ndarray(
+            (self.slots, *self.slot_shape), dtype=np.uint8, buffer=self.shm.buf)
+
+        self.free_slots = queue.Queue()
+        for slot in range(self.slots):
+            self.free_slots.put(slot)
+
+        # Frames wait here, highest priority first, until a slot frees up
+        self.pending = queue.PriorityQueue()
+        self.sequence = itertools.count()
+        self.shedder = LoadShedder(batch_capacity=self.max_batch_size * self.process_count)
+
+        # Each worker has its own task queue, so the slots a worker holds are
+        # known and can be reclaimed if it dies
+        context = mp.get_context('spawn')
+        self.task_queues = [context.Queue() for _ in range(self.process_count)]
+        self.result_queue = context.Queue()
+        self.slot_owners = {}
+        self.outstanding = [0] * self.process_count
+        self.worker_states = ['starting'] * self.process_count
+
+        for worker in range(self.process_count):
+            self.processes.append(context.Process(
+                target=_inference_worker,
+                args=(worker, self.shm.name, self.slot_shape, self.slots, self.engine_settings,
+                      self.profiles, self.max_batch_size, warmup, self.task_queues[worker],
+                      self.result_queue),
+                daemon=True))
+
+        self.collector = threading.Thread(target=self.__collect, daemon=True)
+        self.dispatcher = threading.Thread(target=self.__dispatch, daemon=True)
+
+    def start(self) -> None:
+        for process in self.processes:
+            process.start()
+        self.collector.start()
+        self.dispatcher.start()
+        atexit.register(self.stop)
+
+        self.logger.info(
+            f'Started {self.process_count} inference processes with {self.slots} shared frame slots.')
+
+    def stop(self) -> None:
+        if self.stopped:
+            return
+        self.stopped = True
+
+        for task_queue in self.task_queues:
+            task_queue.put(None)
+        for process in self.processes:
+            process.join(timeout=5)
+        self.result_queue.put(None)
+
+        del self.frames
+        self.shm.close()
+        self.shm.unlink()
+        self.logger.info('Stopped inference processes.')
+
+    def submit(self, image, profile: str = 'quality', priority: str = 'image',
+               deadline: float = None) -> Future:
+        size = self.profiles[profile]['size']
+        if image.shape != (size, size, 3) or image.dtype != np.uint8:
+            raise ValueError(
+                f'Expected a {(size, size, 3)} uint8 frame for profile {profile}, '
+                f'got {image.shape} {image.dtype}.')
+
+        if self.unavailable is not None:
+            raise self.unavailable
+
+        with self.lock:
+            in_flight = len(self.futures)
+        rank = self.shedder.admit(priority, deadline, in_flight=in_flight)
+
+        # The caller keeps the image alive until the future resolves, it is copied on dispatch
+        future = Future()
+        self.pending.put((rank, next(self.sequence), deadline, image, future, profile))
+
+        return future
+
+    def infer(self, image, profile: str = 'quality', timeout: float = None,
+              priority: str = 'image', deadline: float = None) -> Detections:
+        """
+        :param timeout: seconds to wait for the result, INFERENCE_TIMEOUT by default
+        """
+        future = self.submit(image, profile, priority, deadline)
+        try:
+            return future.result(timeout=self.default_timeout if timeout is None else timeout)
+        except FutureTimeoutError:
+            raise InferenceUnavailableError('Inference did not answer in time.')
+
+    def __dispatch(self) -> None:
+        while not self.stopped:
+            try:
+                rank, _, deadline, image, future, profile = self.pending.get(timeout=0.5)
+            except queue.Empty:
+                continue
+
+            # Blocks while every slot is in flight, the queued frames stay ordered meanwhile
+            slot = self.__take_slot()
+            self.shedder.taken(rank)
+
+            if slot is None:
+                future.set_exception(self.unavailable)
+                continue
+
+            if self.shedder.expired(rank, deadline):
+                self.free_slots.put(slot)
+                future.set_exception(DeadlineExceededError('Deadline passed while queued for inference.'))
+                continue
+
+            size = image.shape[0]
+            self.frames[slot, :size, :size] = image
+
+            with self.lock:
+                # The live worker with the fewest frames in hand takes it
+                workers = [w for w, state in enumerate(self.worker_states) if state != 'dead']
+                if workers:
+                    worker = min(workers, key=lambda w: self.outstanding[w])
+                    self.futures[slot] = future
+                    self.slot_owners[slot] = worker
+                    self.outstanding[worker] += 1
+
+            if not workers:
+                self.free_slots.put(slot)
+                future.set_exception(self.unavailable)
+                continue
+            self.task_queues[worker].put((slot, profile))
+
+    def __take_slot(self):
+        """
+        :return: a free slot, None once no worker is left to run it
+        """
+        while self.unavailable is None:
+            try:
+                return self.free_slots.get(timeout=0.5)
+            except queue.Empty:
+                continue
+        return None
+
+    def __collect(self) -> None:
+        next_check = time.monotonic()
+        while True:
+            # Checked on a timer too, results from the other workers may never pause
+            if time.monotonic() >= next_check:
+                self.__check_workers()
+                next_check = time.monotonic() + WORKER_CHECK_INTERVAL
+
+            try:
+                message = self.result_queue.get(timeout=WORKER_CHECK_INTERVAL)
+            except queue.Empty:
+                continue
+            if message is None:
+                break
+            self.__handle(message)
+
+    def __handle(self, message) -> None:
+        worker, batch, detections, error, seconds = message
+        if batch is None:
+            self.__worker_started(worker, detections, error)
+            return
+
+        INFERENCE_BATCH_SIZE.observe(len(batch))
+        if error:
+            ERRORS.inc(where='inference')
+        else:
+            self.shedder.observe_batch(seconds)
+
+        with self.lock:
+            futures = [self.futures.pop(slot) for slot in batch]
+            for slot in batch:
+                self.outstanding[self.slot_owners.pop(slot)] -= 1
+            self.batches_run += 1
+            self.frames_run += len(batch)
+            self.batch_size_counts[len(batch)] = self.batch_size_counts.get(
+                len(batch), 0) + 1
+
+        for slot in batch:
+            self.free_slots.put(slot)
+
+        for i, future in enumerate(futures):
+            if error:
+                future.set_exception(RuntimeError(error))
+            else:
+                future.set_result(detections[i])
+
+    def __check_workers(self) -> None:
+        if self.stopped:
+            return
+
+        for worker, process in enumerate(self.processes):
+            if self.worker_states[worker] != 'dead' and not process.is_alive():
+                self.__worker_died(worker, f'exit code {process.exitcode}')
+
+    def __worker_died(self, worker: int, reason: str) -> None:
+        """
+        Fail the frames a dead worker held and give their slots back.
+        :return: None
+        """
+        # Results or a startup error it sent before dying are still valid
+        while True:
+            try:
+                message = self.result_queue.get_nowait()
+            except queue.Empty:
+                break
+            if message is None:
+                return
+            self.__handle(message)
+
+        if self.worker_states[worker] == 'dead':
+            return
+
+        ERRORS.inc(where='inference_process')
+        with self.lock:
+            was_starting = self.worker_states[worker] == 'starting'
+            self.worker_states[worker] = 'dead'
+            slots = [slot for slot, owner in self.slot_owners.items() if owner == worker]
+            futures = [self.futures.pop(slot) for slot in slots]
+            for slot in slots:
+                del self.slot_owners[slot]
+            self.outstanding[worker] = 0
+            all_dead = all(state == 'dead' for state in self.worker_states)
+
+        self.logger.error(
+            f'Inference process {worker} died ({reason}), failing {len(futures)} frames in flight.')
+
+        error = InferenceUnavailableError(f'Inference process died ({reason}).')
+        for slot, future in zip(slots, futures):
+            self.free_slots.put(slot)
+            future.set_exception(error)
+
+        if was_starting:
+            self.__worker_failed(reason)
+        if all_dead:
+            self.__all_workers_dead(f'No inference process is running ({reason}).')
+
+    def __worker_started(self, worker: int, timings: dict, error: str) -> None:
+        if error is not None:
+            self.logger.error(f'Inference process {worker} failed to start: {error}')
+            with self.lock:
+                self.worker_states[worker] = 'dead'
+            self.__worker_failed(error)
+            if all(state == 'dead' for state in self.worker_states):
+                self.__all_workers_dead(f'Inference engine failed to start: {error}')
+            return
+
+        # The pool is only as ready as its slowest worker
+        for stage, seconds in timings.items():
+            self.startup_timings[stage] = max(self.startup_timings.get(stage, 0), seconds)
+
+        with self.lock:
+            self.worker_states[worker] = 'ready'
+        self.workers_ready += 1
+        self.__startup_settled()
+
+    def __all_workers_dead(self, reason: str) -> None:
+        # Queued frames fail in the dispatcher, new ones in submit(), and /ready reports the reason
+        self.unavailable = InferenceUnavailableError(reason)
+        if self.startup_error is None:
+            self.startup_error = RuntimeError(reason)
+        self.ready.clear()
+        self.started.set()
+
+    def __worker_failed(self, error: str) -> None:
+        self.workers_failed += 1
+        if self.workers_ready == 0 and self.workers_failed == self.process_count:
+            self.startup_error = RuntimeError(error)
+        self.__startup_settled()
+
+    def __startup_settled(self) -> None:
+        if self.workers_ready + self.workers_failed < self.process_count or self.started.is_set():
+            return
+
+        self.started.set()
+        if self.workers_ready:
+            self.ready.set()
+            self.logger.info(
+                f'{self.workers_ready} of {self.process_count} inference processes ready: ' + ', '.join(
+                    f'{stage} {seconds * 1000:.0f}ms' for stage, seconds in self.startup_timings.items()))
+
+    def metrics(self) -> dict:
+        with self.lock:
+            return {
+                'backend': 'process',
+                'engine': self.engine_settings['engine'],
+                'profiles': {name: profile['size'] for name, profile in self.profiles.items()},
+                'ready': self.ready.is_set(),
+                'startup_error': str(self.startup_error) if self.startup_error else None,
+                'processes': self.process_count,
+                'processes_alive': sum(p.is_alive() for p in self.processes),
+                'processes_ready': self.workers_ready,
+                'processes_failed': self.workers_failed,
+                'queue_depth': len(self.futures) + self.pending.qsize(),
+                'free_slots': self.free_slots.qsize(),
+                'batches_run': self.batches_run,
+                'frames_run': self.frames_run,
+                'avg_batch_size': self.frames_run / self.batches_run if self.batches_run else 0,
+                'batch_size_counts': dict(self.batch_size_counts),
+                'max_batch_size': self.max_batch_size,
+                'scheduling': self.shedder.stats(),
+            }
@@ -0,0 +1,149 @@
+import os
+import hashlib
+import threading
+import logging
+from collections import OrderedDict
+
+import numpy as np
+from app.utils.detections import Detections
+
+
+class ResultCache:
+    """
+    Content-addressed cache of detection results and annotated JPEGs. The
+    JPEG is None for entries created by requests that only wanted the
+    detections. Entries live in an in-memory LRU bounded by bytes, and optionally in a
+    second tier of .npz files on disk that survives memory eviction.
+    """
+
+    def __init__(self, model_id: str, max_bytes: int, disk_dir: str = None, storage=None):
+        self.logger = logging.getLogger(__name__)
+        self.model_id = model_id
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.storage = storage
+        self.entries = OrderedDict()
+        self.bytes_used = 0
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            if self.storage:
+                self.storage.adopt(self.disk_dir, 'cache')
+
+    def key(self, data: bytes, **options) -> str:
+        digest = hashlib.sha256()
+        digest.update(self.model_id.encode())
+        for name in sorted(options):
+            digest.update(f'{name}={options[name]};'.encode())
+        digest.update(data)
+        return digest.hexdigest()
+
+    @staticmethod
+    def __size(detections: Detections, jpeg: bytes) -> int:
+        return len(jpeg or b'') + sum(array.nbytes for array in detections)
+
+    def get(self, key: str):
+        """
+        :return: (detections, jpeg bytes) or None on a miss
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry
+
+        entry = self.__read_disk(key)
+
+        with self.lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+
+        self.__put_memory(key, *entry)
+        return entry
+
+    def put(self, key: str, detections: Detections, jpeg: bytes) -> None:
+        self.__put_memory(key, detections, jpeg)
+        self.__write_disk(key, detections, jpeg)
+
+    def __put_memory(self, key: str, detections: Detections, jpeg: bytes) -> None:
+        size = self.__size(detections, jpeg)
+        if size > self.max_bytes:
+            return
+
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                old_detections, old_jpeg = self.entries[key]
+                if old_jpeg is not None or jpeg is None:
+                    return
+                self.bytes_used -= self.__size(old_detections, old_jpeg)
+
+            self.entries[key] = (detections, jpeg)
+            self.bytes_used += size
+
+            while self.bytes_used > self.max_bytes:
+                _, (old_detections, old_jpeg) = self.entries.popitem(last=False)
+                self.bytes_used -= self.__size(old_detections, old_jpeg)
+
+    def __disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, f'{key}.npz')
+
+    def __read_disk(self, key: str):
+        if not self.disk_dir:
+            return None
+
+        path = self.__disk_path(key)
+        if not os.path.exists(path):
+            return None
+
+        try:
+            with np.load(path) as data:
+                detections = Detections(
+                    data['boxes'], data['confidences'], data['class_ids'])
+                jpeg = data['jpeg'].tobytes()
+            if self.storage:
+                self.storage.touch(path)
+            return detections, jpeg or None
+        except Exception as e:
+            self.logger.error(f"Failed to read cached result {path}: {e}")
+            return None
+
+    def __write_disk(self, key: str, detections: Detections, jpeg: bytes) -> None:
+        if not self.disk_dir:
+            return
+
+        path = self.__disk_path(key)
+        if jpeg is None and os.path.exists(path):
+            return
+
+        temp_path = f'{path}.{threading.get_ident()}.tmp'
+
+        try:
+            with open(temp_path, 'wb') as f:
+                np.savez(f, boxes=detections.boxes, confidences=detections.confidences,
+                         class_ids=detections.class_ids,
+                         jpeg=np.frombuffer(jpeg or b'', dtype=np.uint8))
+            os.replace(temp_path, path)
+            if self.storage:
+                self.storage.track(path, 'cache')
+        except Exception as e:
+            self.logger.error(f"Failed to write cached result {path}: {e}")
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes_used': self.bytes_used,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+            }
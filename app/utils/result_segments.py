@@ -0,0 +1,262 @@
+import os
+import mmap
+import time
+import queue
+import asyncio
+import struct
+
+from .frame_buffer import POLICIES
+from .metrics import DROPPED_FRAMES
+
+# Index record: byte offset and length of one stored chunk in the segment file
+INDEX_RECORD = struct.Struct('<QI')
+# Length of the record that marks the segment as complete
+END_LENGTH = 0xFFFFFFFF
+
+# Seconds between checks while a reader waits for the writer
+POLL_INTERVAL = 0.02
+# Least seconds between two on_read calls of a reader
+ACCESS_INTERVAL = 1.0
+
+
+def segment_paths(path: str) -> tuple[str, str]:
+    """
+    :return: (segment file, index file) for a segment path prefix
+    """
+    return f'{path}.seg', f'{path}.idx'
+
+
+def remove_segment(path: str) -> None:
+    for file_path in segment_paths(path):
+        if os.path.exists(file_path):
+            os.remove(file_path)
+
+
+def finish_empty_segment(path: str) -> bool:
+    """
+    Write a complete segment with no chunks, for a job cancelled before it
+    started. A segment that already exists belongs to a writer that may be
+    running, so it is left for that writer to finish.
+    :return: whether the empty segment was written
+    """
+    data_path, index_path = segment_paths(path)
+    os.makedirs(os.path.dirname(data_path) or '.', exist_ok=True)
+
+    # Never truncates: a writer that already opened the data file keeps its chunks
+    os.close(os.open(data_path, os.O_WRONLY | os.O_CREAT))
+    try:
+        fd = os.open(index_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+    except FileExistsError:
+        return False
+
+    with os.fdopen(fd, 'wb') as index:
+        index.write(INDEX_RECORD.pack(0, END_LENGTH))
+    return True
+
+
+class SegmentWriter:
+    """
+    Appends a job's output chunks to a segment file and records each one in
+    a fixed-size index. The data is flushed before its index record, so a
+    reader never sees an entry whose bytes are not there yet.
+    """
+
+    def __init__(self, path: str):
+        data_path, index_path = segment_paths(path)
+        os.makedirs(os.path.dirname(data_path) or '.', exist_ok=True)
+
+        self.data = open(data_path, 'wb')
+        self.index = open(index_path, 'wb')
+        self.offset = 0
+        self.frames = 0
+
+    def append(self, chunk: bytes) -> None:
+        self.data.write(chunk)
+        self.data.flush()
+        self.index.write(INDEX_RECORD.pack(self.offset, len(chunk)))
+        self.index.flush()
+
+        self.offset += len(chunk)
+        self.frames += 1
+
+    def finish(self) -> None:
+        if self.index.closed:
+            return
+
+        self.index.write(INDEX_RECORD.pack(self.offset, END_LENGTH))
+        self.index.close()
+        self.data.close()
+
+
+class SegmentReader:
+    """
+    Independent cursor over a segment that may still be written, starting
+    at chunk `start`. It has the get/get_async/qsize/fill/stats interface of
+    FrameBuffer, so each viewer can stream a job at its own pace. The
+    segment is memory-mapped and remapped as it grows.
+
+    The writer never waits for a reader, so the buffer policy applies on
+    the reading side: while the job is still running, a reader lagging more
+    than max_frames or max_bytes behind skips ahead with drop_oldest, and
+    jumps to the newest chunk with latest. With block it reads every chunk.
+    `on_read`, if given, is called as chunks are read, at most every
+    ACCESS_INTERVAL seconds, so a job being streamed is not evicted.
+    """
+
+    def __init__(self, path: str, start: int = 0, policy: str = 'block',
+                 max_frames: int = 64, max_bytes: int = 32 * 1024 * 1024, on_read=None):
+        if policy not in POLICIES:
+            raise ValueError(
+                f"Unknown frame buffer policy '{policy}', expected one of {POLICIES}.")
+
+        self.data_path, self.index_path = segment_paths(path)
+        self.position = max(start, 0)
+        self.policy = policy
+        self.max_frames = max_frames
+        self.max_bytes = max_bytes
+        self.dropped = 0
+        self.on_read = on_read
+        self.last_read = 0.0
+        self.data_file = None
+        self.index_file = None
+        self.map = None
+
+    def __open(self) -> bool:
+        if self.index_file is None:
+            try:
+                self.index_file = open(self.index_path, 'rb')
+                self.data_file = open(self.data_path, 'rb')
+            except FileNotFoundError:
+                # The job has not started writing yet
+                self.index_file = None
+                return False
+        return True
+
+    def __entries(self) -> int:
+        if not self.__open():
+            return 0
+        return os.fstat(self.index_file.fileno()).st_size // INDEX_RECORD.size
+
+    def __record(self, index: int) -> tuple[int, int]:
+        return INDEX_RECORD.unpack(os.pread(
+            self.index_file.fileno(), INDEX_RECORD.size, index * INDEX_RECORD.size))
+
+    def __read(self, offset: int, length: int) -> bytes:
+        if length == 0:
+            return b''
+
+        if self.map is None or len(self.map) < offset + length:
+            if self.map is not None:
+                self.map.close()
+            self.map = mmap.mmap(self.data_file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.map[offset:offset + length]
+
+    def finished(self) -> bool:
+        entries = self.__entries()
+        return entries > 0 and self.__record(entries - 1)[1] == END_LENGTH
+
+    def __written(self) -> int:
+        # Stored chunks, without the end marker
+        entries = self.__entries()
+        if entries > 0 and self.__record(entries - 1)[1] == END_LENGTH:
+            return entries - 1
+        return entries
+
+    def lag(self) -> tuple[int, int]:
+        """
+        :return: chunks and bytes written but not read yet
+        """
+        written = self.__written()
+        if self.position >= written:
+            return 0, 0
+
+        offset, length = self.__record(written - 1)
+        return written - self.position, offset + length - self.__record(self.position)[0]
+
+    def __skip(self) -> None:
+        # A finished segment is replayed in full, whatever the policy
+        if self.policy == 'block' or self.finished():
+            return
+
+        frames, size = self.lag()
+        while frames > 1 and (self.policy == 'latest' or frames > self.max_frames
+                              or size > self.max_bytes):
+            size -= self.__record(self.position)[1]
+            frames -= 1
+            self.position += 1
+            self.dropped += 1
+            DROPPED_FRAMES.inc(policy=self.policy)
+
+    def next(self):
+        """
+        :return: the next chunk, 'DONE' at the end of a finished segment, None if nothing is ready
+        """
+        if self.position >= self.__entries():
+            return None
+
+        self.__skip()
+
+        offset, length = self.__record(self.position)
+        if length == END_LENGTH:
+            return 'DONE'
+
+        if self.on_read is not None and time.monotonic() - self.last_read >= ACCESS_INTERVAL:
+            self.last_read = time.monotonic()
+            self.on_read()
+
+        self.position += 1
+        return self.__read(offset, length)
+
+    def get(self, timeout: float = None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        while True:
+            data = self.next()
+            if data is not None:
+                return data
+            if deadline is not None and time.monotonic() >= deadline:
+                raise queue.Empty
+            time.sleep(POLL_INTERVAL)
+
+    async def get_async(self, timeout: float = None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        while True:
+            # Reads the files and may record the access in a shared job store
+            data = await asyncio.to_thread(self.next)
+            if data is not None:
+                return data
+            if deadline is not None and time.monotonic() >= deadline:
+                raise queue.Empty
+            await asyncio.sleep(POLL_INTERVAL)
+
+    def chunks(self):
+        """
+        Iterate over the remaining chunks of a finished segment.
+        """
+        while True:
+            data = self.next()
+            if data is None or data == 'DONE':
+                return
+            yield data
+
+    def qsize(self) -> int:
+        return self.lag()[0]
+
+    def fill(self) -> float:
+        """
+        :return: how far behind the writer this reader is, 0.0 to 1.0, like FrameBuffer.fill
+        """
+        frames, size = self.lag()
+        return min(max(frames / self.max_frames, size / self.max_bytes), 1.0)
+
+    def stats(self) -> dict:
+        entries = self.__entries()
+        finished = self.finished()
+        return {
+            'stored_frames': entries - 1 if finished else entries,
+            'stored_bytes': os.path.getsize(self.data_path) if os.path.exists(self.data_path) else 0,
+            'finished': finished,
+            'policy': self.policy,
+            'dropped_frames': self.dropped,
+        }
@@ -0,0 +1,65 @@
+import sys
+import threading
+import logging
+from collections import Counter
+
+from flask import Flask
+from app.utils.background_thread import BackgroundThread
+
+
+class SamplingProfiler(BackgroundThread):
+    """
+    Samples the stacks of every other thread at a fixed interval and counts
+    them in collapsed "frame;frame;frame count" form, ready for flamegraph tools.
+    """
+
+    def __init__(self, thread_id: str, app: Flask, interval_ms: float = 10, max_depth: int = 64):
+        super().__init__(thread_id, app)
+        self.logger = logging.getLogger(__name__)
+        self.interval = interval_ms / 1000
+        self.max_depth = max_depth
+        self.stacks = Counter()
+        self.samples = 0
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+
+    def startup(self) -> None:
+        self.logger.info(
+            f'Starting sampling profiler every {self.interval * 1000:.1f}ms...')
+
+    def shutdown(self) -> None:
+        self.logger.info(
+            f'Stopping sampling profiler after {self.samples} samples.')
+
+    def stop(self) -> None:
+        super().stop()
+        self.wakeup.set()
+
+    def handle(self) -> None:
+        own_id = threading.get_ident()
+        names = {t.ident: t.name for t in threading.enumerate()}
+
+        collected = []
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_id:
+                continue
+
+            stack = []
+            while frame is not None and len(stack) < self.max_depth:
+                code = frame.f_code
+                stack.append(
+                    f'{code.co_filename}:{code.co_name}:{frame.f_lineno}')
+                frame = frame.f_back
+
+            stack.append(names.get(thread_id, str(thread_id)))
+            collected.append(';'.join(reversed(stack)))
+
+        with self.lock:
+            self.stacks.update(collected)
+            self.samples += 1
+
+        self.wakeup.wait(self.interval)
+
+    def collapsed(self) -> str:
+        with self.lock:
+            return '\n'.join(f'{stack} {count}' for stack, count in self.stacks.most_common()) + '\n'
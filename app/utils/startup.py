@@ -0,0 +1,42 @@
+import time
+
+import numpy as np
+from .image_io import MODEL_SIZE
+
+
+class StartupTimer:
+    """
+    Records how long each named startup stage took, measured from the end
+    of the previous stage.
+    """
+
+    def __init__(self, start: float = None):
+        self.start = time.perf_counter() if start is None else start
+        self.last = self.start
+        self.stages = {}
+
+    def mark(self, stage: str) -> None:
+        now = time.perf_counter()
+        self.stages[stage] = now - self.last
+        self.last = now
+
+    def total(self) -> float:
+        return self.last - self.start
+
+    def summary(self) -> str:
+        return ', '.join(f'{stage} {seconds * 1000:.0f}ms' for stage, seconds in self.stages.items())
+
+
+def warm_up(engine, batch_size: int = 1, runs: int = 1, size: int = MODEL_SIZE) -> float:
+    """
+    Run blank batches through the engine, so session initialisation and the
+    first-run graph optimisations are paid before real traffic arrives.
+    :return: seconds spent
+    """
+    start = time.perf_counter()
+    batch = [np.full((size, size, 3), 114, dtype=np.uint8)] * batch_size
+
+    for _ in range(runs):
+        engine.predict(batch)
+
+    return time.perf_counter() - start
@@ -0,0 +1,237 @@
+import os
+import time
+import shutil
+import logging
+import threading
+from collections import OrderedDict
+
+STORAGE_CATEGORIES = ('uploads', 'cache', 'tracks', 'segments')
+
+
+class TempStorageManager:
+    """
+    In-memory index of the files the app writes under TEMP_DIR, with their
+    size and last access, oldest access first. The sweeper removes files
+    not accessed for max_age seconds, then least recently used ones until
+    the total fits in max_bytes. Pinned files, like the upload a job is
+    still reading, are never removed. Nothing is stat'ed on a sweep, owners
+    report growth through touch().
+    """
+
+    def __init__(self, root: str, max_bytes: int, max_age: float, scratch_dirs: tuple = ()):
+        self.logger = logging.getLogger(__name__)
+        self.root = root
+        self.scratch_dirs = (root, *scratch_dirs)
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.entries = OrderedDict()
+        self.bytes_used = 0
+        self.lock = threading.Lock()
+
+        # Set when the quota is exceeded, so the sweeper runs before its next tick
+        self.wakeup = threading.Event()
+
+        self.evicted_files = 0
+        self.evicted_bytes = 0
+        self.over_quota = False
+
+    def track(self, path: str, category: str, pinned: bool = False, on_evict=None,
+              in_use=None) -> None:
+        """
+        Add a file to the index, or refresh it if already tracked.
+        :param on_evict: called with the path after the sweeper removed the file
+        :param in_use: called with the path before the sweeper removes the file, True keeps
+            it as if just accessed, for files other processes may be using
+        :return: None
+        """
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            size = 0
+
+        with self.lock:
+            entry = self.entries.pop(path, None)
+            if entry is not None:
+                self.bytes_used -= entry['size']
+
+            self.entries[path] = {'size': size, 'category': category, 'pinned': pinned,
+                                  'accessed': time.time(), 'on_evict': on_evict, 'in_use': in_use}
+            self.bytes_used += size
+            self.__check_quota()
+
+    def touch(self, path: str, size: int = None) -> None:
+        """
+        Mark a tracked file as used now, and record its new size if it grew.
+        :return: None
+        """
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is None:
+                return
+
+            self.entries.move_to_end(path)
+            entry['accessed'] = time.time()
+            if size is not None:
+                self.bytes_used += size - entry['size']
+                entry['size'] = size
+                self.__check_quota()
+
+    def pin(self, path: str, pinned: bool = True) -> None:
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None:
+                entry['pinned'] = pinned
+
+    def unpin(self, path: str) -> None:
+        self.pin(path, pinned=False)
+
+    def release(self, path: str) -> None:
+        """
+        Forget a file its owner has removed or moved.
+        :return: None
+        """
+        with self.lock:
+            entry = self.entries.pop(path, None)
+            if entry is not None:
+                self.bytes_used -= entry['size']
+
+    def remove(self, path: str) -> None:
+        self.release(path)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def adopt(self, directory: str, category: str) -> None:
+        """
+        Index the files an earlier run left in directory, as last accessed
+        when they were modified.
+        :return: None
+        """
+        if not os.path.isdir(directory):
+            return
+
+        files = sorted(((entry.path, entry.stat()) for entry in os.scandir(directory) if entry.is_file()),
+                       key=lambda file: file[1].st_mtime)
+
+        with self.lock:
+            for path, stat in files:
+                if path in self.entries:
+                    continue
+                self.entries[path] = {'size': stat.st_size, 'category': category, 'pinned': False,
+                                      'accessed': stat.st_mtime, 'on_evict': None, 'in_use': None}
+                self.entries.move_to_end(path, last=False)
+                self.bytes_used += stat.st_size
+            self.__check_quota()
+
+    def __check_quota(self) -> None:
+        # While pinned files alone keep usage over the quota, the periodic sweep is enough
+        if self.bytes_used > self.max_bytes and not self.over_quota:
+            self.wakeup.set()
+
+    def __select_victims(self) -> list:
+        now = time.time()
+        victims = []
+
+        with self.lock:
+            bytes_left = self.bytes_used
+            for path, entry in self.entries.items():
+                if entry['pinned']:
+                    continue
+                if now - entry['accessed'] > self.max_age or bytes_left > self.max_bytes:
+                    victims.append((path, entry))
+                    bytes_left -= entry['size']
+
+            for path, entry in victims:
+                del self.entries[path]
+                self.bytes_used -= entry['size']
+
+        return victims
+
+    def sweep(self) -> int:
+        """
+        Remove expired files, then least recently used ones over the quota.
+        :return: number of files removed
+        """
+        self.wakeup.clear()
+        victims = self.__select_victims()
+        removed = 0
+
+        for path, entry in victims:
+            if entry['in_use'] is not None and entry['in_use'](path):
+                self.track(path, entry['category'], on_evict=entry['on_evict'], in_use=entry['in_use'])
+                continue
+
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                self.logger.error(f"Failed to delete {path}: {e}")
+                continue
+
+            removed += 1
+            self.evicted_files += 1
+            self.evicted_bytes += entry['size']
+            if entry['on_evict'] is not None:
+                try:
+                    entry['on_evict'](path)
+                except Exception as e:
+                    self.logger.error(f"Eviction callback for {path} failed: {e}")
+
+        with self.lock:
+            over_quota = self.bytes_used > self.max_bytes
+            bytes_used = self.bytes_used
+
+        # Warn once each time pinned files alone push usage over the quota
+        if over_quota and not self.over_quota:
+            self.logger.warning(
+                f"Temp storage holds {bytes_used} bytes, over its {self.max_bytes} byte quota, "
+                f"in files that are still in use.")
+        self.over_quota = over_quota
+
+        return removed
+
+    def remove_stale(self) -> int:
+        """
+        Remove files an earlier run left in root and the scratch directories
+        that were not modified for max_age seconds. Called once at startup.
+        :return: number of files removed
+        """
+        deadline = time.time() - self.max_age
+        removed = 0
+
+        for directory in self.scratch_dirs:
+            if not os.path.isdir(directory):
+                continue
+
+            for entry in os.scandir(directory):
+                if entry.is_file() and entry.stat().st_mtime < deadline:
+                    try:
+                        os.remove(entry.path)
+                        removed += 1
+                    except OSError as e:
+                        self.logger.error(f"Failed to delete {entry.path}: {e}")
+
+        return removed
+
+    def usage(self) -> dict:
+        with self.lock:
+            categories = {category: {'files': 0, 'bytes': 0} for category in STORAGE_CATEGORIES}
+            pinned_bytes = 0
+            for entry in self.entries.values():
+                usage = categories.setdefault(entry['category'], {'files': 0, 'bytes': 0})
+                usage['files'] += 1
+                usage['bytes'] += entry['size']
+                if entry['pinned']:
+                    pinned_bytes += entry['size']
+
+            report = {'files': len(self.entries), 'bytes_used': self.bytes_used,
+                      'pinned_bytes': pinned_bytes, 'max_bytes': self.max_bytes,
+                      'evicted_files': self.evicted_files, 'evicted_bytes': self.evicted_bytes,
+                      'categories': categories}
+
+        disk = shutil.disk_usage(self.root)
+        report['disk_free_bytes'] = disk.free
+        report['disk_total_bytes'] = disk.total
+        return report
@@ -0,0 +1,39 @@
+import logging
+
+from flask import Flask, current_app
+from app.utils.background_thread import BackgroundThread
+
+
+class TempStorageThread(BackgroundThread):
+    def __init__(self, thread_id: str, app: Flask):
+        super().__init__(thread_id, app)
+        self.logger = logging.getLogger(__name__)
+        self.app = app
+
+        with app.app_context():
+            self.storage = current_app.config['TEMP_STORAGE']
+            self.interval = current_app.config['TEMP_SWEEP_INTERVAL']
+
+    def stop(self) -> None:
+        super().stop()
+        self.storage.wakeup.set()
+
+    def startup(self) -> None:
+        self.logger.info('Starting temp storage sweeper...')
+
+        removed = self.storage.remove_stale()
+        if removed:
+            self.logger.info(f'Removed {removed} stale temp files.')
+
+    def shutdown(self) -> None:
+        self.logger.info('Stopping temp storage sweeper...')
+
+    def handle(self) -> None:
+        # Sleeps until the next tick, or until the quota is exceeded
+        self.storage.wakeup.wait(self.interval)
+        if self._stopped():
+            return
+
+        removed = self.storage.sweep()
+        if removed:
+            self.logger.info(f'Removed {removed} temp files.')
@@ -0,0 +1,117 @@
+import cv2
+import numpy as np
+from .detections import Detections
+
+TEMPORAL_MODES = ('off', 'interval', 'diff')
+MOTION_MODES = ('hold', 'velocity')
+
+# Side of the grayscale thumbnail frames are compared on
+DIFF_SIZE = 64
+
+# Minimum overlap for a box to count as the same object on the next keyframe
+MATCH_IOU = 0.3
+
+
+class KeyframeSelector:
+    """
+    Decides on the decode thread which frames go through the model.
+
+    - off: every frame
+    - interval: every `interval` frames
+    - diff: when the mean absolute difference to the last keyframe, measured
+      on a small grayscale thumbnail, exceeds `diff_threshold` (0-255), or
+      after `max_gap` frames without a keyframe
+    """
+
+    def __init__(self, mode: str = 'off', interval: int = 3, diff_threshold: float = 12.0,
+                 max_gap: int = 30):
+        if mode not in TEMPORAL_MODES:
+            raise ValueError(
+                f"Temporal mode must be one of {', '.join(TEMPORAL_MODES)}")
+
+        self.mode = mode
+        self.interval = max(interval, 1)
+        self.diff_threshold = diff_threshold
+        self.max_gap = max(max_gap, 1)
+        self.since_keyframe = None
+        self.keyframe_thumbnail = None
+
+    def should_detect(self, frame: np.ndarray) -> bool:
+        if self.mode == 'off':
+            return True
+
+        if self.mode == 'interval':
+            detect = self.since_keyframe is None or self.since_keyframe >= self.interval
+        else:
+            thumbnail = cv2.cvtColor(
+                cv2.resize(frame, (DIFF_SIZE, DIFF_SIZE),
+                           interpolation=cv2.INTER_AREA),
+                cv2.COLOR_BGR2GRAY)
+            detect = (self.keyframe_thumbnail is None
+                      or self.since_keyframe >= self.max_gap
+                      or cv2.absdiff(thumbnail, self.keyframe_thumbnail).mean() > self.diff_threshold)
+            if detect:
+                self.keyframe_thumbnail = thumbnail
+
+        self.since_keyframe = 1 if detect else self.since_keyframe + 1
+        return detect
+
+
+class BoxExtrapolator:
+    """
+    Fills in detections for frames between keyframes on the annotate thread.
+    'hold' repeats the last keyframe's boxes; 'velocity' matches each box to
+    the same class on the keyframe before it and keeps moving it at the
+    per-frame velocity between the two.
+    """
+
+    def __init__(self, motion: str = 'velocity', size: int = 640):
+        if motion not in MOTION_MODES:
+            raise ValueError(
+                f"Motion mode must be one of {', '.join(MOTION_MODES)}")
+
+        self.motion = motion
+        self.size = size
+        self.last = None
+        self.last_index = 0
+        self.velocity = None
+
+    def update(self, detections: Detections, index: int) -> None:
+        if self.motion == 'velocity' and self.last is not None and index > self.last_index:
+            self.velocity = self.__velocity(
+                self.last, detections, index - self.last_index)
+
+        self.last = detections
+        self.last_index = index
+
+    def predict(self, index: int) -> Detections:
+        if self.last is None:
+            return Detections.empty()
+
+        if self.velocity is None:
+            return self.last
+
+        boxes = self.last.boxes + self.velocity * (index - self.last_index)
+        return self.last._replace(boxes=np.clip(boxes, 0, self.size).astype(np.float32))
+
+    @staticmethod
+    def __velocity(previous: Detections, current: Detections, gap: int) -> np.ndarray:
+        velocity = np.zeros_like(current.boxes, dtype=np.float32)
+
+        if len(previous.boxes) == 0 or len(current.boxes) == 0:
+            return velocity
+
+        # IoU of every current box against every previous box
+        top_left = np.maximum(current.boxes[:, None, :2], previous.boxes[None, :, :2])
+        bottom_right = np.minimum(current.boxes[:, None, 2:], previous.boxes[None, :, 2:])
+        intersection = np.prod(np.clip(bottom_right - top_left, 0, None), axis=2)
+        current_area = np.prod(current.boxes[:, 2:] - current.boxes[:, :2], axis=1)
+        previous_area = np.prod(previous.boxes[:, 2:] - previous.boxes[:, :2], axis=1)
+        iou = intersection / np.maximum(
+            current_area[:, None] + previous_area[None, :] - intersection, 1e-6)
+        iou[current.class_ids[:, None] != previous.class_ids[None, :]] = 0
+
+        best = iou.argmax(axis=1)
+        matched = iou[np.arange(len(best)), best] >= MATCH_IOU
+        velocity[matched] = (current.boxes[matched] - previous.boxes[best[matched]]) / gap
+        return velocity
@@ -0,0 +1,224 @@
+import queue
+import threading
+import time
+import logging
+
+import cv2
+import numpy as np
+from concurrent.futures import Future
+from .image_io import MODEL_SIZE, letterbox
+from .metrics import STAGE_SECONDS, REUSED_FRAMES
+from .temporal_reuse import KeyframeSelector, BoxExtrapolator
+from .frame_encoders import JpegEncoder
+
+END = object()
+
+
+class VideoPipeline:
+    """
+    Runs a video through three overlapping stages connected by bounded queues:
+
+    - decode: reads frames, letterboxes them to the profile's input size and
+      submits them to the inference backend without waiting, so several
+      frames are in flight and can be batched together
+    - annotate: waits for each frame's detections, draws them and hands the
+      frame to the encoder, which sizes and encodes it for the stream
+    - the caller iterating over the pipeline consumes the encoded frames
+
+    Wall-clock time per video approaches the slowest stage rather than the
+    sum of all of them. With a precomputed DetectionTrack the inference
+    stage is skipped and detections are replayed from the track. Without an
+    annotate callable the pipeline yields detections scaled to the source
+    resolution instead of JPEG bytes.
+
+    `temporal` settings let the pipeline run the model only on keyframes and
+    carry boxes forward in between, see KeyframeSelector and BoxExtrapolator.
+    """
+
+    def __init__(self, video_path: str, inference_backend, annotate, depth: int = 16,
+                 track=None, start_frame: int = 0, record: bool = False, temporal: dict = None,
+                 encoder=None, profile: str = 'quality', input_size: int = MODEL_SIZE):
+        self.logger = logging.getLogger(__name__)
+        self.video_path = video_path
+        self.inference_backend = inference_backend
+        self.annotate = annotate
+        self.profile = profile
+        self.input_size = input_size
+        self.inflight = queue.Queue(maxsize=depth)
+        self.output = queue.Queue(maxsize=depth)
+        self.__stop_event = threading.Event()
+        self.lock = threading.Lock()
+        self.timings = {'decode': 0.0, 'inference': 0.0,
+                        'annotate': 0.0, 'encode': 0.0}
+        self.frames = 0
+        self.inferred_frames = 0
+        self.track = track
+
+        temporal = dict(temporal or {})
+        self.motion = temporal.pop('motion', 'velocity')
+        self.selector = KeyframeSelector(**temporal)
+        self.extrapolator = BoxExtrapolator(self.motion)
+        self.detections = [] if record else None
+
+        self.cap = cv2.VideoCapture(video_path)
+
+        if not self.cap.isOpened():
+            raise IOError(f"Cannot open video file: {video_path}")
+
+        self.width = int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        self.height = int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        self.total_frames = int(self.cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        self.fps = self.cap.get(cv2.CAP_PROP_FPS)
+
+        if self.total_frames == 0:
+            self.cap.release()
+            raise ValueError(f"Video file {video_path} has no frames.")
+
+        self.start_frame = min(max(start_frame, 0), self.total_frames)
+        if self.start_frame:
+            self.cap.set(cv2.CAP_PROP_POS_FRAMES, self.start_frame)
+
+        # Called with (width, height, fps), the default encodes full-size JPEGs
+        if annotate is None:
+            self.encoder = None
+        elif encoder is None:
+            self.encoder = JpegEncoder(self.width, self.height)
+        else:
+            self.encoder = encoder(self.width, self.height, self.fps)
+        # Output the encoder still held back when the last frame went through
+        self.tail = b''
+
+    def __put(self, target: queue.Queue, item) -> bool:
+        while not self.__stop_event.is_set():
+            try:
+                target.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def __get(self, source: queue.Queue):
+        while not self.__stop_event.is_set():
+            try:
+                return source.get(timeout=0.5)
+            except queue.Empty:
+                continue
+        return END
+
+    def __record(self, stage: str, elapsed: float) -> None:
+        STAGE_SECONDS.observe(elapsed, path='video', stage=stage)
+        with self.lock:
+            self.timings[stage] += elapsed
+
+    def __replay(self, index: int) -> Future:
+        future = Future()
+        future.set_result(self.track.frame(index))
+        return future
+
+    def __decode(self) -> None:
+        index = self.start_frame
+        try:
+            while not self.__stop_event.is_set():
+                start = time.perf_counter()
+                success, frame = self.cap.read()
+                if not success:
+                    break
+
+                # Boxes are drawn on the stretched frame, the model sees it letterboxed
+                small = cv2.resize(frame, (MODEL_SIZE, MODEL_SIZE))
+                box = None
+
+                if self.track is not None and index < self.track.frame_count:
+                    future = self.__replay(index)
+                elif self.selector.should_detect(small):
+                    # A fresh buffer per frame, the backend may still read it after submit returns
+                    model_input = np.empty((self.input_size, self.input_size, 3), dtype=np.uint8)
+                    box = letterbox(frame, model_input)
+                    # Lowest priority and no deadline, live frames and images overtake it
+                    future = self.inference_backend.submit(model_input, self.profile, priority='video')
+                else:
+                    # Filled in from the last keyframe by the annotate stage
+                    future = None
+                self.__record('decode', time.perf_counter() - start)
+
+                if not self.__put(self.inflight, (index, small, future, box)):
+                    break
+                index += 1
+        except Exception as e:
+            self.__put(self.inflight, e)
+        finally:
+            self.cap.release()
+            self.__put(self.inflight, END)
+
+    def __annotate(self) -> None:
+        try:
+            while True:
+                item = self.__get(self.inflight)
+                if item is END or isinstance(item, Exception):
+                    self.__put(self.output, item)
+                    break
+
+                index, small, future, box = item
+
+                start = time.perf_counter()
+                if future is None:
+                    detections = self.extrapolator.predict(index)
+                    REUSED_FRAMES.inc(motion=self.motion)
+                else:
+                    detections = future.result()
+                    if box is not None:
+                        detections = detections.unletterboxed(box)
+                    self.extrapolator.update(detections, index)
+                    self.inferred_frames += 1
+                self.__record('inference', time.perf_counter() - start)
+
+                if self.detections is not None:
+                    self.detections.append(detections)
+
+                if self.annotate is None:
+                    if not self.__put(self.output, detections.scaled(self.width, self.height)):
+                        break
+                    continue
+
+                start = time.perf_counter()
+                annotated = self.annotate(small, detections)
+                self.__record('annotate', time.perf_counter() - start)
+
+                start = time.perf_counter()
+                encoded = self.encoder.encode(annotated)
+                self.__record('encode', time.perf_counter() - start)
+
+                if not self.__put(self.output, encoded):
+                    break
+        except Exception as e:
+            self.__put(self.output, e)
+
+    def __iter__(self):
+        threading.Thread(target=self.__decode, daemon=True).start()
+        threading.Thread(target=self.__annotate, daemon=True).start()
+
+        try:
+            while True:
+                item = self.__get(self.output)
+                if item is END:
+                    if self.encoder is not None:
+                        self.tail = self.encoder.finish()
+                    break
+                if isinstance(item, Exception):
+                    raise item
+
+                self.frames += 1
+                yield item
+        finally:
+            self.__stop_event.set()
+            if self.encoder is not None:
+                self.encoder.close()
+
+    def stats(self) -> dict:
+        """
+        :return: average milliseconds per frame spent in each stage
+        """
+        with self.lock:
+            frames = max(self.frames, 1)
+            return {f'{stage}_ms': total / frames * 1000
+                    for stage, total in self.timings.items()}
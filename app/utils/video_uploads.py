@@ -0,0 +1,191 @@
+import os
+import time
+import uuid
+import fcntl
+import logging
+from contextlib import contextmanager
+
+from .job_store import MemoryJobStore
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class UploadTooLargeError(Exception):
+    pass
+
+
+class UnsupportedVideoError(Exception):
+    pass
+
+
+class UploadOffsetError(Exception):
+    pass
+
+
+class UploadNotFoundError(Exception):
+    pass
+
+
+def sniff_mp4(header: bytes) -> bool:
+    """
+    MP4/ISO-BMFF files start with a box whose type at bytes 4-8 is 'ftyp'.
+    :return: True if the header looks like an MP4 container
+    """
+    return len(header) >= 8 and header[4:8] == b'ftyp'
+
+
+def copy_stream(source, target, max_bytes: int, written: int = 0) -> int:
+    """
+    Copy source to target in fixed-size chunks, checking the container type
+    on the first chunk of a file and the size limit on every chunk.
+    :return: total bytes written to target
+    """
+    while True:
+        chunk = source.read(CHUNK_SIZE)
+        if not chunk:
+            return written
+
+        if written == 0 and not sniff_mp4(chunk):
+            raise UnsupportedVideoError('File is not an MP4 video')
+
+        written += len(chunk)
+        if written > max_bytes:
+            raise UploadTooLargeError(
+                f'Upload exceeds the {max_bytes} byte limit')
+
+        target.write(chunk)
+
+
+class ChunkedUploads:
+    """
+    Resumable uploads: a client creates an upload, appends raw chunks at
+    the offset the server reports, and completes it once all bytes arrived.
+    Sessions are kept in the job store and the offset is the size of the
+    partial file, so with a shared store any worker can take the next
+    chunk. Partial files live under upload_dir until completed, or until
+    temp storage evicts an abandoned one.
+    """
+
+    def __init__(self, upload_dir: str, max_bytes: int, storage=None, store=None):
+        self.logger = logging.getLogger(__name__)
+        self.upload_dir = upload_dir
+        self.max_bytes = max_bytes
+        self.storage = storage
+        self.store = store or MemoryJobStore()
+
+        os.makedirs(self.upload_dir, exist_ok=True)
+
+    def __path(self, upload_id: str) -> str:
+        return os.path.join(self.upload_dir, f'{upload_id}.mp4.part')
+
+    def __upload(self, upload_id: str) -> dict:
+        upload = self.store.get_upload(upload_id)
+        if upload is None:
+            raise UploadNotFoundError(f'Upload {upload_id} not found')
+        return upload
+
+    @contextmanager
+    def __locked(self, upload_id: str):
+        """
+        Open the partial file for appending, holding a lock that also excludes other processes.
+        :return: (file, upload session), once the upload is known to be still open
+        """
+        try:
+            # Never recreate the file of an upload that was completed or discarded
+            f = os.fdopen(os.open(self.__path(upload_id), os.O_WRONLY | os.O_APPEND), 'ab')
+        except FileNotFoundError:
+            raise UploadNotFoundError(f'Upload {upload_id} not found')
+
+        with f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            # Checked once the lock is held, as it may have been completed meanwhile
+            yield f, self.__upload(upload_id)
+
+    def __track(self, upload_id: str) -> None:
+        if self.storage:
+            self.storage.track(self.__path(upload_id), 'uploads',
+                               on_evict=lambda path: self.__evicted(upload_id),
+                               in_use=self.__in_use)
+
+    def __in_use(self, path: str) -> bool:
+        # Chunks may arrive at another worker, which only shows in the file's modification time
+        try:
+            return time.time() - os.path.getmtime(path) < self.storage.max_age
+        except OSError:
+            return False
+
+    def create(self, total_size: int = None) -> str:
+        if total_size is not None and total_size > self.max_bytes:
+            raise UploadTooLargeError(
+                f'Upload exceeds the {self.max_bytes} byte limit')
+
+        upload_id = uuid.uuid4().hex
+        open(self.__path(upload_id), 'wb').close()
+        self.store.create_upload(upload_id, total_size)
+
+        self.__track(upload_id)
+        return upload_id
+
+    def __evicted(self, upload_id: str) -> None:
+        self.store.delete_upload(upload_id)
+        self.logger.info(f"Evicted abandoned upload {upload_id}.")
+
+    def status(self, upload_id: str) -> dict:
+        upload = self.__upload(upload_id)
+        try:
+            offset = os.path.getsize(self.__path(upload_id))
+        except FileNotFoundError:
+            raise UploadNotFoundError(f'Upload {upload_id} not found')
+
+        return {'upload_id': upload_id, 'offset': offset,
+                'total_size': upload['total_size']}
+
+    def append(self, upload_id: str, offset: int, stream) -> int:
+        """
+        Append the request body at offset, which must equal the bytes received so far.
+        :return: the new offset
+        """
+        with self.__locked(upload_id) as (f, _):
+            received = os.fstat(f.fileno()).st_size
+            if offset != received:
+                raise UploadOffsetError(
+                    f"Expected offset {received}, got {offset}")
+
+            try:
+                copy_stream(stream, f, self.max_bytes, written=offset)
+            finally:
+                # Keep whatever was written so the client can resume from it
+                f.flush()
+                received = os.fstat(f.fileno()).st_size
+                self.__track(upload_id)
+
+            return received
+
+    def complete(self, upload_id: str, target_dir: str) -> str:
+        """
+        :return: path of the finished video inside target_dir
+        """
+        with self.__locked(upload_id) as (f, upload):
+            received = os.fstat(f.fileno()).st_size
+            if upload['total_size'] is not None and received != upload['total_size']:
+                raise UploadOffsetError(
+                    f"Received {received} of {upload['total_size']} bytes")
+
+            path = os.path.join(target_dir, f'{upload_id}.mp4')
+            os.replace(self.__path(upload_id), path)
+            self.store.delete_upload(upload_id)
+
+        # The finished video is pinned until its job removes it
+        if self.storage:
+            self.storage.release(self.__path(upload_id))
+            self.storage.track(path, 'uploads', pinned=True)
+        return path
+
+    def discard(self, upload_id: str) -> None:
+        self.store.delete_upload(upload_id)
+        if self.storage:
+            self.storage.release(self.__path(upload_id))
+        try:
+            os.remove(self.__path(upload_id))
+        except FileNotFoundError:
+            pass
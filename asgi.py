@@ -0,0 +1,6 @@
+from app.asgi import create_asgi_app
+from dotenv import load_dotenv
+
+load_dotenv()
+
+app = create_asgi_app()
@@ -0,0 +1,289 @@
+import os
+import io
+import sys
+import json
+import time
+import argparse
+import resource
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+IMAGE_DIR = './app/static/image-examples'
+VIDEO_PATH = './app/static/video-examples/hair_2.mp4'
+
+
+def summarize(samples: list[float]) -> dict:
+    """
+    :return: latency percentiles in milliseconds for a list of durations in seconds
+    """
+    if not samples:
+        return {'count': 0}
+
+    ms = np.array(samples) * 1000
+    return {
+        'count': len(samples),
+        'mean_ms': float(ms.mean()),
+        'p50_ms': float(np.percentile(ms, 50)),
+        'p95_ms': float(np.percentile(ms, 95)),
+        'p99_ms': float(np.percentile(ms, 99)),
+    }
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+def bench_stages(app, repeat: int) -> dict:
+    from app.utils.detector import annotate_img
+    from app.utils.image_io import buffer_pool, decode_image, letterbox
+
+    backend = app.config['INFERENCE_BACKEND']
+    if not backend.started.wait(app.config['ENGINE_STARTUP_TIMEOUT']):
+        raise RuntimeError(
+            f"Inference engine not ready after {app.config['ENGINE_STARTUP_TIMEOUT']}s.")
+    if backend.startup_error is not None:
+        raise RuntimeError(f'Inference engine failed to start: {backend.startup_error}')
+    profiles = app.config['INFERENCE_PROFILES']
+    class_names = app.config['CLASS_NAMES']
+
+    # The thread backend exposes its engines, the process pool is only reachable through infer()
+    engines = getattr(backend, 'engines', None)
+
+    def predict(images, profile):
+        if engines:
+            return engines[profile].predict(images)
+        return [backend.infer(image, profile) for image in images]
+
+    timings = {'decode': [],
+               **{f'{stage}_{profile}': [] for profile in profiles for stage in ('resize', 'forward')},
+               'annotate': [], 'encode': []}
+
+    images = [open(os.path.join(IMAGE_DIR, name), 'rb').read()
+              for name in sorted(os.listdir(IMAGE_DIR))]
+
+    for _ in range(repeat):
+        for data in images:
+            (image, width, height), elapsed = timed(decode_image, data)
+            timings['decode'].append(elapsed)
+
+            for profile, settings in profiles.items():
+                size = settings['size']
+                with buffer_pool.borrow((size, size, 3)) as small:
+                    box, elapsed = timed(letterbox, image, small)
+                    timings[f'resize_{profile}'].append(elapsed)
+
+                    detections, elapsed = timed(predict, [small], profile)
+                    timings[f'forward_{profile}'].append(elapsed)
+
+            # Drawn from the last profile's detections
+            annotated, elapsed = timed(
+                annotate_img, image, detections[0].unletterboxed(box).scaled(width, height),
+                class_names)
+            timings['annotate'].append(elapsed)
+
+            _, elapsed = timed(cv2.imencode, '.jpg', annotated)
+            timings['encode'].append(elapsed)
+
+    cap = cv2.VideoCapture(VIDEO_PATH)
+    video_decode = []
+    while True:
+        (success, _), elapsed = timed(cap.read)
+        if not success:
+            break
+        video_decode.append(elapsed)
+    cap.release()
+
+    result = {stage: summarize(samples) for stage, samples in timings.items()}
+    result['video_decode'] = summarize(video_decode)
+    return result
+
+
+def bench_endpoint(client_factory, path: str, field: str, requests: int, concurrency: int,
+                   extra: dict = None) -> dict:
+    images = [(name, open(os.path.join(IMAGE_DIR, name), 'rb').read())
+              for name in sorted(os.listdir(IMAGE_DIR))]
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+
+    def call(i: int) -> None:
+        nonlocal errors
+        name, data = images[i % len(images)]
+        client = client_factory()
+        start = time.perf_counter()
+        response = client.post(
+            path, data={field: (io.BytesIO(data), name), **(extra or {})})
+        elapsed = time.perf_counter() - start
+
+        with lock:
+            if response.status_code == 200:
+                latencies.append(elapsed)
+            else:
+                errors += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(call, range(requests)))
+    wall = time.perf_counter() - start
+
+    return {**summarize(latencies), 'errors': errors, 'concurrency': concurrency,
+            'requests_per_sec': len(latencies) / wall}
+
+
+def bench_video(client_factory, concurrency: int) -> dict:
+    video = open(VIDEO_PATH, 'rb').read()
+    total_frames = int(cv2.VideoCapture(
+        VIDEO_PATH).get(cv2.CAP_PROP_FRAME_COUNT))
+
+    first_frame = []
+    totals = []
+    errors = 0
+    lock = threading.Lock()
+
+    def run(_) -> None:
+        nonlocal errors
+        client = client_factory()
+        start = time.perf_counter()
+        response = client.post('/api/upload_video', data={
+            'video': (io.BytesIO(video), 'bench.mp4', 'video/mp4')})
+
+        if response.status_code != 200:
+            with lock:
+                errors += 1
+            return
+
+        stream = client.get(
+            f"/api/stream_frames?id={response.json['id']}", buffered=False)
+        got_first = None
+        for _ in stream.response:
+            if got_first is None:
+                got_first = time.perf_counter() - start
+        stream.close()
+
+        with lock:
+            first_frame.append(got_first or 0)
+            totals.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(run, range(concurrency)))
+    wall = time.perf_counter() - start
+
+    return {
+        'concurrency': concurrency,
+        'errors': errors,
+        'time_to_first_frame': summarize(first_frame),
+        'job_duration': summarize(totals),
+        'frames_per_sec': total_frames * len(totals) / wall,
+    }
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return 'unknown'
+
+
+def compare(current: dict, baseline: dict, threshold: float) -> list[str]:
+    """
+    :return: descriptions of every p95 latency that regressed by more than threshold
+    """
+    regressions = []
+
+    def walk(path: str, now, before) -> None:
+        if not isinstance(now, dict) or not isinstance(before, dict):
+            return
+        for key, value in now.items():
+            if key == 'p95_ms' and before.get(key):
+                change = value / before[key] - 1
+                if change > threshold:
+                    regressions.append(
+                        f'{path}: p95 {before[key]:.1f}ms -> {value:.1f}ms (+{change:.0%})')
+            else:
+                walk(f'{path}.{key}' if path else key, value, before.get(key))
+
+    walk('', current, baseline)
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description='Benchmark the detection hot paths and HTTP endpoints.')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='passes over the example images for the stage timings')
+    parser.add_argument('--requests', type=int, default=50,
+                        help='requests per endpoint benchmark')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--video-concurrency', type=int, default=2)
+    parser.add_argument('--with-cache', action='store_true',
+                        help='keep the result cache enabled for endpoint runs')
+    parser.add_argument('--output', default=None,
+                        help='result file, defaults to benchmarks/results/<commit>.json')
+    parser.add_argument('--compare', default=None,
+                        help='baseline result file to check for regressions')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='allowed relative p95 regression when comparing')
+    args = parser.parse_args()
+
+    if not args.with_cache:
+        os.environ['RESULT_CACHE_MAX_BYTES'] = '0'
+        os.environ['RESULT_CACHE_DISK'] = 'false'
+
+    from app import create_app
+
+    start = time.perf_counter()
+    app = create_app()
+    startup = time.perf_counter() - start
+
+    results = {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'config': {
+            'engine': app.config['ENGINE_SETTINGS']['engine'],
+            'backend': app.config['INFERENCE_BACKEND_TYPE'],
+            'max_batch_size': app.config['INFERENCE_MAX_BATCH_SIZE'],
+            'concurrency': args.concurrency,
+        },
+        'startup_sec': startup,
+        'stages': bench_stages(app, args.repeat),
+        'endpoints': {
+            'process_image': bench_endpoint(app.test_client, '/api/process_image', 'image',
+                                            args.requests, args.concurrency),
+            'process_image_json': bench_endpoint(app.test_client, '/api/process_image', 'image',
+                                                 args.requests, args.concurrency, {'output': 'json'}),
+            'process_image_live': bench_endpoint(app.test_client, '/api/process_image', 'image',
+                                                 args.requests, args.concurrency, {'profile': 'live'}),
+            'process_frame': bench_endpoint(app.test_client, '/api/process_frame', 'frame',
+                                            args.requests, args.concurrency),
+        },
+        'video': bench_video(app.test_client, args.video_concurrency),
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+    output = args.output or os.path.join(
+        'benchmarks', 'results', f"{results['commit']}.json")
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'Wrote {output}')
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        return 1 if regressions else 0
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+
+from app.utils.detection_tracks import DetectionTrack, DetectionTrackStore
+
+PROFILE_IDS = {'live': 'onnxruntime:live.onnx:416', 'quality': 'onnxruntime:quality.onnx:640'}
+
+
+@pytest.fixture
+def video(tmp_path):
+    path = tmp_path / 'example.mp4'
+    path.write_bytes(b'video')
+    return str(path)
+
+
+def track() -> DetectionTrack:
+    return DetectionTrack(offsets=np.array([0, 1], dtype=np.int64),
+                          boxes=np.array([[1, 2, 3, 4]], dtype=np.float32),
+                          confidences=np.array([0.5], dtype=np.float32),
+                          class_ids=np.array([0], dtype=np.int32))
+
+
+def test_round_trip(tmp_path, video):
+    DetectionTrackStore(PROFILE_IDS, str(tmp_path / 'tracks')).put(video, track(), profile='live')
+
+    loaded = DetectionTrackStore(PROFILE_IDS, str(tmp_path / 'tracks')).get(video, profile='live')
+    assert loaded.frame_count == 1
+    np.testing.assert_array_equal(loaded.boxes, track().boxes)
+
+
+def test_tracks_per_profile(tmp_path, video):
+    store = DetectionTrackStore(PROFILE_IDS, str(tmp_path / 'tracks'))
+    store.put(video, track(), profile='live')
+
+    assert store.get(video, profile='quality') is None
+
+
+@pytest.mark.parametrize('profile_id', ['onnxruntime:other.onnx:416', 'onnxruntime:live.onnx:320'])
+def test_tracks_change_with_model_and_size(tmp_path, video, profile_id):
+    DetectionTrackStore(PROFILE_IDS, str(tmp_path / 'tracks')).put(video, track(), profile='live')
+
+    changed = DetectionTrackStore({**PROFILE_IDS, 'live': profile_id}, str(tmp_path / 'tracks'))
+    assert changed.get(video, profile='live') is None
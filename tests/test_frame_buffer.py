@@ -0,0 +1,71 @@
+import queue
+
+import pytest
+
+from app.utils.frame_buffer import FrameBuffer
+
+
+def drain(buffer: FrameBuffer) -> list:
+    frames = []
+    while True:
+        try:
+            frames.append(buffer.get(timeout=0))
+        except queue.Empty:
+            return frames
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        FrameBuffer(policy='newest')
+
+
+def test_drop_oldest_by_frames():
+    buffer = FrameBuffer(policy='drop_oldest', max_frames=3)
+    for i in range(5):
+        assert buffer.put(str(i).encode())
+
+    assert buffer.dropped == 2
+    assert drain(buffer) == [b'2', b'3', b'4']
+    assert buffer.bytes_buffered == 0
+
+
+def test_drop_oldest_by_bytes():
+    buffer = FrameBuffer(policy='drop_oldest', max_bytes=10)
+    for chunk in (b'a' * 4, b'b' * 4, b'c' * 4):
+        buffer.put(chunk)
+
+    assert drain(buffer) == [b'b' * 4, b'c' * 4]
+
+
+def test_oversized_frame_into_empty_buffer():
+    buffer = FrameBuffer(policy='drop_oldest', max_bytes=4)
+    buffer.put(b'a' * 8)
+
+    assert drain(buffer) == [b'a' * 8]
+    assert buffer.dropped == 0
+
+
+def test_latest_keeps_one_frame():
+    buffer = FrameBuffer(policy='latest')
+    for i in range(5):
+        buffer.put(str(i).encode())
+
+    assert buffer.qsize() == 1
+    assert buffer.dropped == 4
+    assert drain(buffer) == [b'4']
+
+
+@pytest.mark.parametrize('policy', ['drop_oldest', 'latest'])
+def test_done_is_never_dropped(policy):
+    buffer = FrameBuffer(policy=policy, max_frames=1)
+    buffer.put(b'frame')
+    buffer.put('DONE')
+
+    assert drain(buffer) == [b'frame', 'DONE']
+
+
+def test_block_times_out_when_full():
+    buffer = FrameBuffer(policy='block', max_frames=1)
+    assert buffer.put(b'a')
+    assert not buffer.put(b'b', timeout=0.05)
+    assert drain(buffer) == [b'a']
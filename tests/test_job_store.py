@@ -0,0 +1,93 @@
+import pytest
+
+from app.utils.job_store import SqliteJobStore, create_job_store
+from app.utils.result_segments import SegmentReader, SegmentWriter
+
+
+@pytest.fixture
+def stores(tmp_path):
+    """
+    Two handles on one database, like two worker processes on a host.
+    """
+    path = str(tmp_path / 'jobs.sqlite3')
+    return SqliteJobStore(path), SqliteJobStore(path)
+
+
+def create(store, tmp_path, job_id: str = 'job', persisted: bool = False):
+    segment_path = str(tmp_path / 'segments' / job_id) if persisted else None
+    store.create(job_id, 'file', str(tmp_path / 'video.mp4'), 'mjpeg',
+                 delete_source=False, policy='block', segment_path=segment_path)
+    return segment_path
+
+
+def test_unknown_job_store():
+    with pytest.raises(ValueError):
+        create_job_store('redis')
+
+
+def test_cancel_queued_job_from_other_handle(stores, tmp_path):
+    owner, other = stores
+    create(owner, tmp_path)
+
+    job = other.load('job')
+    assert job.state == 'queued'
+    job.cancel()
+
+    assert owner.cancel_requested('job')
+    assert job.state == 'cancelling'
+    # Nobody will run the job, so its viewers are released right away
+    assert owner.load('job').get_frame_queue().get(timeout=1) == 'DONE'
+
+    owner.update('job', state='cancelled')
+    assert other.load('job').state == 'cancelled'
+
+
+def test_cancel_queued_persisted_job_finishes_segment(stores, tmp_path):
+    owner, other = stores
+    create(owner, tmp_path, persisted=True)
+
+    job = other.load('job')
+    job.cancel()
+
+    assert owner.cancel_requested('job')
+    assert job.open_stream().get(timeout=1) == 'DONE'
+
+
+def test_cancel_running_job_leaves_it_to_owner(stores, tmp_path):
+    owner, other = stores
+    segment_path = create(owner, tmp_path, persisted=True)
+    owner.update('job', state='running')
+    writer = SegmentWriter(segment_path)
+    writer.append(b'frame')
+
+    other.load('job').cancel()
+
+    assert owner.cancel_requested('job')
+    assert other.load('job').state == 'cancelling'
+
+    # The running worker notices between frames and ends the segment itself
+    writer.finish()
+    owner.update('job', state='cancelled')
+    assert list(SegmentReader(segment_path).chunks()) == [b'frame']
+    assert other.load('job').state == 'cancelled'
+
+
+def test_frames_cross_handles(stores, tmp_path):
+    owner, other = stores
+    create(owner, tmp_path)
+
+    producer = owner.frame_buffer('job', 'block', max_frames=4, max_bytes=1024)
+    consumer = other.load('job').get_frame_queue()
+    producer.put(b'a')
+    producer.put(b'b')
+    producer.put('DONE')
+
+    assert [consumer.get(timeout=1) for _ in range(3)] == [b'a', b'b', 'DONE']
+
+
+def test_deleted_job(stores, tmp_path):
+    owner, other = stores
+    create(owner, tmp_path)
+
+    owner.delete('job')
+    assert other.load('job') is None
@@ -0,0 +1,86 @@
+import os
+
+import numpy as np
+import pytest
+from flask import Flask
+
+from app import model_identity
+from app.utils.detections import Detections
+from app.utils.detector import cache_options
+from app.utils.result_cache import ResultCache
+
+IMAGE = b'image bytes'
+
+
+@pytest.fixture
+def app():
+    app = Flask(__name__)
+    app.config['INFERENCE_PROFILES'] = {'live': {'size': 416, 'model_path': 'live.onnx'},
+                                        'quality': {'size': 640, 'model_path': 'quality.onnx'}}
+    app.config['PROFILE_MODEL_IDS'] = {'live': 'onnxruntime:live.onnx',
+                                       'quality': 'onnxruntime:quality.onnx'}
+    with app.app_context():
+        yield app
+
+
+@pytest.fixture
+def cache():
+    return ResultCache(model_id='onnxruntime:model.onnx', max_bytes=1024 * 1024)
+
+
+def test_key_depends_on_image(app, cache):
+    assert cache.key(IMAGE, **cache_options('quality')) == cache.key(IMAGE, **cache_options('quality'))
+    assert cache.key(IMAGE, **cache_options('quality')) != cache.key(b'other', **cache_options('quality'))
+
+
+def test_key_changes_with_profile(app, cache):
+    assert cache.key(IMAGE, **cache_options('live')) != cache.key(IMAGE, **cache_options('quality'))
+
+
+def test_key_changes_with_size(app, cache):
+    before = cache.key(IMAGE, **cache_options('quality'))
+    app.config['INFERENCE_PROFILES']['quality']['size'] = 320
+
+    assert cache.key(IMAGE, **cache_options('quality')) != before
+
+
+def test_key_changes_with_profile_model(app, cache):
+    before = cache.key(IMAGE, **cache_options('quality'))
+    app.config['PROFILE_MODEL_IDS']['quality'] = 'onnxruntime:other.onnx'
+
+    assert cache.key(IMAGE, **cache_options('quality')) != before
+
+
+def test_key_changes_with_cache_model(app):
+    first = ResultCache(model_id='onnxruntime:model.onnx', max_bytes=1024)
+    second = ResultCache(model_id='ultralytics:model.onnx', max_bytes=1024)
+
+    assert first.key(IMAGE, **cache_options('quality')) != second.key(IMAGE, **cache_options('quality'))
+
+
+def test_model_identity_changes_with_file(tmp_path):
+    model_path = tmp_path / 'model.onnx'
+    model_path.write_bytes(b'weights')
+    before = model_identity('onnxruntime', str(model_path))
+
+    model_path.write_bytes(b'new weights')
+    stat = os.stat(model_path)
+    os.utime(model_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+
+    assert model_identity('onnxruntime', str(model_path)) != before
+    assert model_identity('ultralytics', str(model_path)) != model_identity('onnxruntime', str(model_path))
+
+
+def test_get_put(app, cache):
+    detections = Detections(np.array([[1, 2, 3, 4]], dtype=np.float32),
+                            np.array([0.9], dtype=np.float32),
+                            np.array([0], dtype=np.int32))
+    key = cache.key(IMAGE, **cache_options('quality'))
+
+    assert cache.get(key) is None
+    cache.put(key, detections, b'jpeg')
+
+    cached, jpeg = cache.get(key)
+    assert jpeg == b'jpeg'
+    np.testing.assert_array_equal(cached.boxes, detections.boxes)
+    assert cache.get(cache.key(IMAGE, **cache_options('live'))) is None
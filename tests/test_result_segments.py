@@ -0,0 +1,111 @@
+import os
+import queue
+
+import pytest
+
+from app.utils.result_segments import (INDEX_RECORD, END_LENGTH, SegmentReader, SegmentWriter,
+                                       finish_empty_segment, segment_paths)
+
+
+@pytest.fixture
+def segment(tmp_path):
+    return str(tmp_path / 'job')
+
+
+def write(path: str, chunks: list, finish: bool = True) -> SegmentWriter:
+    writer = SegmentWriter(path)
+    for chunk in chunks:
+        writer.append(chunk)
+    if finish:
+        writer.finish()
+    return writer
+
+
+def test_round_trip(segment):
+    chunks = [b'first', b'', b'x' * 10000, b'last']
+    write(segment, chunks)
+
+    reader = SegmentReader(segment)
+    assert [reader.get(timeout=1) for _ in chunks] == chunks
+    assert reader.get(timeout=1) == 'DONE'
+
+
+def test_end_marker(segment):
+    write(segment, [b'abc', b'de'])
+
+    _, index_path = segment_paths(segment)
+    with open(index_path, 'rb') as f:
+        records = list(INDEX_RECORD.iter_unpack(f.read()))
+    assert records == [(0, 3), (3, 2), (5, END_LENGTH)]
+
+
+def test_reader_waits_for_writer(segment):
+    writer = write(segment, [b'abc'], finish=False)
+
+    reader = SegmentReader(segment)
+    assert not reader.finished()
+    assert reader.get(timeout=1) == b'abc'
+    with pytest.raises(queue.Empty):
+        reader.get(timeout=0.1)
+
+    writer.append(b'de')
+    writer.finish()
+    assert reader.get(timeout=1) == b'de'
+    assert reader.get(timeout=1) == 'DONE'
+    assert reader.finished()
+
+
+def test_reader_before_segment_exists(segment):
+    reader = SegmentReader(segment)
+    assert reader.next() is None
+    assert reader.lag() == (0, 0)
+
+
+def test_start_position(segment):
+    write(segment, [b'a', b'b', b'c'])
+
+    reader = SegmentReader(segment, start=2)
+    assert list(reader.chunks()) == [b'c']
+
+
+@pytest.mark.parametrize('policy, expected', [
+    ('block', [b'0', b'1', b'2', b'3', b'4', b'5']),
+    ('drop_oldest', [b'3', b'4', b'5']),
+    ('latest', [b'5']),
+])
+def test_lagging_reader_policy(segment, policy, expected):
+    writer = write(segment, [str(i).encode() for i in range(6)], finish=False)
+
+    reader = SegmentReader(segment, policy=policy, max_frames=3)
+    read = []
+    while (data := reader.next()) is not None:
+        read.append(data)
+    writer.finish()
+
+    assert read == expected
+    assert reader.dropped == 6 - len(expected)
+
+
+def test_finished_segment_is_replayed_in_full(segment):
+    write(segment, [str(i).encode() for i in range(6)])
+
+    reader = SegmentReader(segment, policy='latest', max_frames=1)
+    assert len(list(reader.chunks())) == 6
+    assert reader.dropped == 0
+
+
+def test_finish_empty_segment(segment):
+    assert finish_empty_segment(segment)
+    assert SegmentReader(segment).get(timeout=1) == 'DONE'
+
+
+def test_finish_empty_segment_keeps_live_segment(segment):
+    writer = write(segment, [b'abc'], finish=False)
+
+    assert not finish_empty_segment(segment)
+    writer.append(b'de')
+    writer.finish()
+
+    reader = SegmentReader(segment)
+    assert list(reader.chunks()) == [b'abc', b'de']
+    assert os.path.getsize(segment_paths(segment)[0]) == 5